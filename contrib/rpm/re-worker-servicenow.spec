@@ -20,6 +20,8 @@ Url: https://github.com/rhinception/re-worker-servicenow
 BuildArch: noarch
 BuildRequires: python2-devel, python-setuptools
 Requires: re-worker, python-requests
+# http.session and dns_cache also need python-urllib3 >= 1.26, which is
+# left optional so the default requests transport installs without it
 
 %description
 A ServiceNow worker for Rease Engine provides basic change record
@@ -17,14 +17,39 @@
 ServiceNow worker.
 """
 import os
+import cProfile
 import datetime
 import json
+import math
+import signal
+import sys
+import threading
+import time
+import zlib
 import requests
 
+from collections import deque
 from urllib import quote_plus
+from urlparse import urlsplit
 
 from reworker.worker import Worker
 
+from replugin.servicenowworker.auth import OAuthTokenAuth, SessionCookieAuth
+from replugin.servicenowworker.batching import Batcher
+from replugin.servicenowworker.cache import (
+    MemorySysIdCache, RedisSysIdCache, SysIdCache)
+from replugin.servicenowworker.capture import CaptureWriter, redact_url
+from replugin.servicenowworker.concurrency import AIMDLimiter
+from replugin.servicenowworker.deadline import Deadline
+from replugin.servicenowworker.endpoints import EndpointPool
+from replugin.servicenowworker.hedging import HedgePolicy, hedged_call
+from replugin.servicenowworker.journal import Journal, JournalLocked
+from replugin.servicenowworker.lanes import Lane
+from replugin.servicenowworker.metrics import Metrics
+from replugin.servicenowworker.output import BufferedOutput, IoloopOutput
+from replugin.servicenowworker.profiling import StackSampler
+from replugin.servicenowworker.supervisor import METRICS_DIR_ENV, SLOT_ENV
+
 
 class ServiceNowWorkerError(Exception):
     """
@@ -41,32 +66,1452 @@ class ServiceNowWorker(Worker):
     #: All allowed subcommands
     subcommands = (
         'DoesChangeRecordExist', 'UpdateStartTime',
-        'UpdateEndTime', 'CreateChangeRecord', 'DoesCTaskExist', 'CreateCTask')
+        'UpdateEndTime', 'CreateChangeRecord', 'DoesCTaskExist', 'CreateCTask',
+        'QueryChangeRecords', 'QueryChangeTasks', 'EnsureChangeAndCTask')
+
+    #: Fields returned by the query subcommands when none are given
+    default_query_fields = ('number', 'sys_id', 'state', 'short_description')
+
+    #: HTTP methods which are safe to retry against another endpoint
+    idempotent_methods = ('get', 'head', 'put')
+
+    #: Share of a message deadline a lookup may use when a write follows
+    lookup_share = 0.5
+
+    #: Seconds between checks of the ioloop for a drain requested by SIGTERM
+    drain_check_interval = 0.5
+
+    #: Seconds between checks of the ioloop for sampling requested by signal
+    sampling_check_interval = 0.5
+
+    def __init__(self, *args, **kwargs):
+        Worker.__init__(self, *args, **kwargs)
+        self._setup()
+
+    def _setup(self):
+        """
+        Sets up everything the worker needs beyond the bus connection.
+        Requires _config and app_logger.
+        """
+        self._local = threading.local()
+        self.metrics = Metrics()
+        self._metrics_dumped = 0
+        self._in_flight = 0
+        self._flight_lock = threading.Lock()
+        self._draining = False
+        self._drained = False
+        self._drain_begun = False
+        self._drain_deadline = None
+        self._gzip_unsupported = set()
+        self._setup_transport()
+        self._setup_endpoints()
+        self._setup_auth()
+        self._setup_hedging()
+        self._setup_limiter()
+        self._setup_lanes()
+        self._setup_bulk_import()
+        self._setup_cache()
+        self._setup_journal()
+        self._setup_capture()
+        self._setup_profiling()
+        self._start_warm_up()
+        self._start_keepalive()
+        self._start_journal()
+        self._install_drain_handler()
+
+    def _setup_transport(self):
+        """
+        Sends requests through a TimedSession if http.session is set, so
+        connections are kept alive and each phase of a request is timed.
+        Otherwise the requests module functions are used. With the
+        session dns_cache can put a Resolver in front of the system's.
+        Both need urllib3 1.26 or later, an optional dependency, so they
+        are only imported when http.session is set.
+        """
+        http = self._config.get('http', {})
+        # Anything with requests' get/put/post/head functions
+        self._transport = requests
+        self._resolver = None
+        if not http.get('session', False):
+            return
+
+        try:
+            import urllib3
+            from replugin.servicenowworker.resolver import Resolver
+            from replugin.servicenowworker.transport import TimedSession
+        except ImportError, ex:
+            raise ServiceNowWorkerError(
+                'http.session needs urllib3 1.26 or later: %s' % ex)
+        if tuple(map(int, urllib3.__version__.split('.')[:2])) < (1, 26):
+            raise ServiceNowWorkerError(
+                'http.session needs urllib3 1.26 or later, found %s' % (
+                    urllib3.__version__))
+
+        dns_cache = self._config.get('dns_cache', {})
+        if dns_cache.get('enabled', False):
+            self._resolver = Resolver(
+                ttl=dns_cache.get('ttl', 60),
+                min_ttl=dns_cache.get('min_ttl', 5),
+                refresh_ahead=dns_cache.get('refresh_ahead', 0.75),
+                spread=dns_cache.get('spread', False),
+                metrics=self.metrics)
+            hosts = set()
+            for api in ('root', 'import'):
+                urls = self._config['api_%s_url' % api]
+                if isinstance(urls, basestring):
+                    urls = [urls]
+                hosts.update(urlsplit(url).hostname for url in urls)
+            self._resolver.start(
+                sorted(hosts), dns_cache.get('refresh_interval', 1.0))
+
+        self._transport = TimedSession(
+            pool_connections=http.get('pool_connections', 10),
+            pool_maxsize=http.get('pool_maxsize', 10),
+            retries=http.get('stale_retries', 1),
+            resolver=self._resolver)
+
+    def _setup_capture(self):
+        """
+        Opens the capture file if capture.path is configured.
+        """
+        self._capture = None
+        path = self._config.get('capture', {}).get('path')
+        if path:
+            self._capture = CaptureWriter(path)
+            self.app_logger.info('Capturing traffic to %s' % path)
+
+    def _setup_endpoints(self):
+        """
+        Builds the endpoint pools for the root and import apis. Both
+        api_root_url and api_import_url may be a single url or a list
+        of urls with the primary first.
+        """
+        routing = self._config.get('endpoint_routing', {})
+        self._endpoints = {}
+        for api in ('root', 'import'):
+            self._endpoints[api] = EndpointPool(
+                self._config['api_%s_url' % api],
+                ewma_alpha=routing.get('ewma_alpha', 0.3),
+                failure_threshold=routing.get('failure_threshold', 3),
+                retry_after=routing.get('retry_after', 30),
+                pin_writes_to_primary=routing.get(
+                    'pin_writes_to_primary', True))
+
+    def _setup_auth(self):
+        """
+        Picks how requests authenticate from auth.mode. basic sends the
+        user and password on every call, session reuses the session
+        cookies ServiceNow hands back and oauth sends a bearer token
+        from the instance's token endpoint. Both fall back to Basic auth
+        on a 401.
+        """
+        auth = self._config.get('auth', {})
+        mode = auth.get('mode', 'basic')
+        user = self._config['servicenow_user']
+        password = self._config['servicenow_password']
+        if mode == 'basic':
+            self._auth = (user, password)
+        elif mode == 'session':
+            self._auth = SessionCookieAuth(
+                user, password,
+                lifetime=auth.get('session_lifetime', 1500),
+                refresh_margin=auth.get('refresh_margin', 60))
+        elif mode == 'oauth':
+            if not auth.get('client_id') or not auth.get('client_secret'):
+                raise ServiceNowWorkerError(
+                    'auth.client_id and auth.client_secret are required '
+                    'for oauth.')
+            token_url = auth.get('token_url')
+            if not token_url:
+                root = urlsplit(self._endpoints['root'].primary.url)
+                token_url = '%s://%s/oauth_token.do' % (
+                    root.scheme, root.netloc)
+            timeouts = self._config.get('timeouts', {})
+            self._auth = OAuthTokenAuth(
+                user, password, auth['client_id'], auth['client_secret'],
+                token_url,
+                # Looked up per call so a replaced transport is used
+                post=lambda *args, **kwargs: self._transport.post(
+                    *args, **kwargs),
+                timeout=(timeouts.get('connect', 5), timeouts.get('read', 30)),
+                refresh_margin=auth.get('refresh_margin', 60),
+                retry_after=auth.get('retry_after', 60))
+        else:
+            raise ServiceNowWorkerError('Unknown auth.mode %r.' % mode)
+
+    def _setup_limiter(self):
+        """
+        Creates the adaptive concurrency limiter if enabled. Its limit
+        bounds the messages processed at once and is applied as the
+        channel prefetch.
+        """
+        self._limiter = None
+        self._pending_prefetch = None
+        adaptive = self._config.get('adaptive_concurrency', {})
+        if adaptive.get('enabled', False):
+            self._limiter = AIMDLimiter(
+                initial=adaptive.get('initial', 1),
+                minimum=adaptive.get('minimum', 1),
+                maximum=adaptive.get('maximum', 50),
+                latency_target=adaptive.get('latency_target', 1.0),
+                error_threshold=adaptive.get('error_threshold', 0.1),
+                increase=adaptive.get('increase', 1),
+                decrease=adaptive.get('decrease', 0.5),
+                window=adaptive.get('window', 20))
+
+    def _setup_lanes(self):
+        """
+        Creates a read and a write Lane if lanes is enabled. Messages
+        are then processed on the lane threads, so read-only checks
+        never wait for a slow write, and anything touching the channel
+        or the output is handed back to the thread running the ioloop.
+        pika 0.12 and later wake the ioloop for those calls with
+        add_callback_threadsafe. Older versions have no thread safe way
+        in, so the ioloop picks them up every lanes.poll_interval
+        seconds instead.
+        """
+        self._lanes = None
+        self._lane_pending = 0
+        self._ioloop_thread = threading.current_thread()
+        self._ioloop_calls = deque()
+        self._wake_ioloop = None
+        lanes = self._config.get('lanes', {})
+        if not lanes.get('enabled', False):
+            return
+        ioloop = getattr(getattr(self, '_connection', None), 'ioloop', None)
+        self._wake_ioloop = getattr(ioloop, 'add_callback_threadsafe', None)
+        self._lane_poll_interval = float(lanes.get('poll_interval', 0.05))
+        read = lanes.get('read', {})
+        write = lanes.get('write', {})
+        self._lanes = {
+            'read': Lane('read', read.get('workers', 4), self.metrics),
+            'write': Lane('write', write.get('workers', 2), self.metrics),
+        }
+        self._read_subcommands = set(read.get('subcommands', [
+            'DoesChangeRecordExist', 'DoesCTaskExist',
+            'QueryChangeRecords', 'QueryChangeTasks']))
+        # Enough unacked messages that reads are delivered during a
+        # burst of writes
+        self._lane_prefetch = lanes.get('prefetch') or 2 * sum(
+            lane.workers for lane in self._lanes.values())
+
+    def _lane_for(self, body):
+        """
+        Returns the Lane a message is processed in.
+        """
+        try:
+            subcommand = str(body['parameters']['subcommand'])
+        except (KeyError, TypeError):
+            subcommand = None
+        if subcommand in self._read_subcommands:
+            return self._lanes['read']
+        return self._lanes['write']
+
+    def _on_ioloop(self, func, *args, **kwargs):
+        """
+        Calls func on the thread running the ioloop, right away if that
+        is this thread. Calls made from other threads run in order.
+        """
+        connection = getattr(self, '_connection', None)
+        if (threading.current_thread() is self._ioloop_thread or
+                connection is None):
+            return func(*args, **kwargs)
+        self._ioloop_calls.append((func, args, kwargs))
+        if self._wake_ioloop is not None:
+            self._wake_ioloop(self._run_ioloop_calls)
+
+    def _run_ioloop_calls(self):
+        """
+        Runs the calls queued by _on_ioloop.
+        """
+        while True:
+            try:
+                func, args, kwargs = self._ioloop_calls.popleft()
+            except IndexError:
+                return
+            try:
+                func(*args, **kwargs)
+            except Exception, ex:
+                self.app_logger.error(
+                    'Call to %s from a lane failed: %s' % (
+                        getattr(func, '__name__', func), ex))
+
+    def _poll_ioloop_calls(self):
+        """
+        Runs the calls queued by _on_ioloop and checks again in
+        lanes.poll_interval seconds. Used when pika cannot be woken from
+        other threads. Runs on the ioloop.
+        """
+        self._run_ioloop_calls()
+        if self._drained:
+            return
+        self._connection.add_timeout(
+            self._lane_poll_interval, self._poll_ioloop_calls)
+
+    def send(self, *args, **kwargs):
+        """
+        Publishes a reply, from the ioloop thread.
+        """
+        self._on_ioloop(Worker.send, self, *args, **kwargs)
+
+    def notify(self, *args, **kwargs):
+        """
+        Publishes a notification, from the ioloop thread.
+        """
+        self._on_ioloop(Worker.notify, self, *args, **kwargs)
+
+    def ack(self, *args, **kwargs):
+        """
+        Acknowledges a message, from the ioloop thread.
+        """
+        self._on_ioloop(Worker.ack, self, *args, **kwargs)
+
+    def _setup_bulk_import(self):
+        """
+        Creates the Batcher which sends change rows to the import set's
+        insertMultiple endpoint if bulk_import is enabled.
+        """
+        self._import_batcher = None
+        bulk = self._config.get('bulk_import', {})
+        if bulk.get('enabled', False):
+            self._import_batcher = Batcher(
+                self._insert_multiple,
+                max_items=bulk.get('max_rows', 50),
+                max_wait=bulk.get('max_wait', 0.05))
+
+    def _on_channel_open(self, channel):
+        """
+        Sets the starting prefetch once the channel is open and starts
+        watching for a drain or sampling if one may be requested, and for
+        calls from the lanes if pika cannot be woken for them.
+        """
+        Worker._on_channel_open(self, channel)
+        if self._config.get('shutdown', {}).get('drain_timeout'):
+            self._watch_drain()
+        if self._sampling_signal is not None:
+            self._watch_sampling()
+        if self._lanes is not None and self._wake_ioloop is None:
+            self._poll_ioloop_calls()
+        if self._limiter is not None or self._lanes is not None:
+            self._pending_prefetch = self._prefetch_for(
+                self._limiter.limit if self._limiter is not None else 0)
+            self._apply_prefetch()
+
+    def _prefetch_for(self, limit):
+        """
+        Returns the prefetch for a concurrency limit. The read lane does
+        not take limiter slots, so with lanes it gets lanes.prefetch on
+        top of the limit and a slow write cannot hold reads back at the
+        broker.
+
+        *Parameters*:
+            * limit: The limiter's limit or 0 without a limiter.
+        """
+        if self._lanes is None:
+            return limit
+        return limit + self._lane_prefetch
+
+    def _record_call(self, elapsed, error):
+        """
+        Feeds a ServiceNow call outcome to the limiter. A new limit is
+        applied by the consuming thread after the current message. Calls
+        made outside a message, such as warm-up and sync pages or
+        journal deliveries, are left out so slow background work does
+        not cut the prefetch.
+        """
+        if self._limiter is None or not getattr(
+                self._local, 'in_message', False):
+            return
+        limit = self._limiter.record(elapsed, error)
+        if limit is not None:
+            self.app_logger.info(
+                'Concurrency limit now %s: %s' % (
+                    limit, self._limiter.last_decision))
+            self.metrics.incr(
+                'concurrency.%s' % self._limiter.last_decision['action'])
+            self.metrics.gauge('concurrency.limit', limit)
+            self._pending_prefetch = self._prefetch_for(limit)
+
+    def _apply_prefetch(self):
+        """
+        Sets basic_qos prefetch to a changed limit. Must run on the
+        thread which owns the channel.
+        """
+        limit = self._pending_prefetch
+        if limit is None:
+            return
+        self._pending_prefetch = None
+        try:
+            # Consuming already started in Worker._on_channel_open and a
+            # per consumer prefetch only applies to later consumers, the
+            # channel wide one applies to the running consumer as well
+            self._channel.basic_qos(prefetch_count=limit, all_channels=True)
+        except Exception, ex:
+            self.app_logger.warn('Unable to set prefetch: %s' % ex)
+        self.metrics.gauge('prefetch', limit)
+
+    def _setup_cache(self):
+        """
+        Opens the sys_id cache picked by sys_id_cache.backend:
+
+            * memory: in process
+            * file: a sqlite file at sys_id_cache.path shared by the
+              workers on a host
+            * redis: a Redis server shared by the whole fleet, with an
+              in process cache to fall back on while it is unreachable
+
+        Without a backend a path means file, and warm up without a path
+        means memory.
+        """
+        self._sys_id_cache = None
+        cache_config = self._config.get('sys_id_cache', {})
+        max_entries = cache_config.get('max_entries', 50000)
+        backend = cache_config.get('backend')
+        if backend is None:
+            if cache_config.get('path'):
+                backend = 'file'
+            elif self._config.get('cache_warm_up', {}).get('query'):
+                backend = 'memory'
+            else:
+                return
+
+        if backend == 'memory':
+            self._sys_id_cache = MemorySysIdCache(max_entries=max_entries)
+        elif backend == 'file':
+            if not cache_config.get('path'):
+                raise ServiceNowWorkerError(
+                    'sys_id_cache.path is required for the file backend.')
+            self._sys_id_cache = SysIdCache(
+                cache_config['path'],
+                max_entries=max_entries,
+                timeout=cache_config.get('timeout', 5.0))
+        elif backend == 'redis':
+            redis = cache_config.get('redis', {})
+            self._sys_id_cache = RedisSysIdCache(
+                host=redis.get('host', '127.0.0.1'),
+                port=redis.get('port', 6379),
+                db=redis.get('db', 0),
+                password=redis.get('password'),
+                ttl=cache_config.get('ttl', 86400),
+                prefix=redis.get('prefix', 'servicenow:'),
+                timeout=redis.get('timeout', 0.5),
+                retry_after=redis.get('retry_after', 30),
+                fallback=MemorySysIdCache(max_entries=max_entries))
+        else:
+            raise ServiceNowWorkerError(
+                'Unknown sys_id_cache.backend %r.' % backend)
+
+    def _setup_journal(self):
+        """
+        Opens the time update journal if time_journal has a directory.
+        Each supervisor slot starts with its own file so a restarted slot
+        replays what it left behind. A journal is only ever open in one
+        process, so workers sharing a slot, such as separate services on
+        a host, each take the next free file.
+        """
+        self._journal = None
+        directory = self._config.get('time_journal', {}).get('directory')
+        if not directory:
+            return
+        name = 'time-updates-%s' % os.environ.get(SLOT_ENV, '0')
+        suffix = ''
+        number = 0
+        while self._journal is None:
+            path = os.path.join(directory, '%s%s.journal' % (name, suffix))
+            try:
+                self._journal = Journal(path)
+            except JournalLocked:
+                number += 1
+                suffix = '-%s' % number
+        pending = len(self._journal.pending())
+        if pending:
+            self.app_logger.info(
+                'Replaying %s journaled time updates' % pending)
+
+    def _start_journal(self):
+        """
+        Starts the background thread delivering journaled time updates.
+        """
+        self._journal_stop = threading.Event()
+        self._journal_wake = threading.Event()
+        if self._journal is None:
+            return
+        thread = threading.Thread(
+            target=self._journal_loop, name='servicenow-journal')
+        thread.daemon = True
+        thread.start()
+
+    def _journal_loop(self):
+        """
+        Delivers journaled time updates as they are added. Failed ones
+        are retried after time_journal.retry_interval seconds, doubling
+        up to time_journal.max_retry_interval. Runs until _journal_stop
+        is set.
+        """
+        journal_config = self._config.get('time_journal', {})
+        retry_interval = float(journal_config.get('retry_interval', 5))
+        max_retry_interval = float(
+            journal_config.get('max_retry_interval', 300))
+        wait = None
+        while not self._journal_stop.is_set():
+            self._journal_wake.clear()
+            try:
+                failed = self.deliver_journal()
+            except Exception, ex:
+                self.app_logger.error('Journal delivery failed: %s' % ex)
+                failed = True
+            if failed:
+                wait = retry_interval if wait is None else min(
+                    max_retry_interval, wait * 2)
+            else:
+                wait = None
+            self._journal_wake.wait(wait)
+
+    def deliver_journal(self):
+        """
+        Tries to deliver every pending time update once, oldest first.
+        An update is not tried while an older one for the same field
+        failed, so they land in order. Compacts the journal once
+        time_journal.compact_every updates were confirmed. Returns the
+        number of updates which failed.
+        """
+        compact_every = self._config.get('time_journal', {}).get(
+            'compact_every', 100)
+        blocked = set()
+        for entry_id, entry in self._journal.pending():
+            if self._journal_stop.is_set():
+                break
+            field = (entry['change_record'], entry['environment'],
+                     entry['kind'])
+            if field in blocked:
+                continue
+            if self._deliver_time(entry):
+                self._journal.confirm(entry_id)
+            else:
+                blocked.add(field)
+        if self._journal.confirmed >= compact_every or (
+                self._journal.confirmed and not self._journal.pending()):
+            self._journal.compact()
+        self.metrics.gauge('journal.pending', len(self._journal.pending()))
+        return len(blocked)
+
+    def _deliver_time(self, entry):
+        """
+        Writes a journaled time update to ServiceNow with its original
+        time. Returns False if it should be tried again. Updates for a
+        change record which does not exist are logged and dropped.
+        """
+        self._local.corr_id = entry.get('corr_id')
+        try:
+            sys_id = self._get_crq_ids(
+                entry['change_record'], strict=True)['sys_id']
+            if not sys_id:
+                self.app_logger.error(
+                    'Dropping journaled %s %s time for missing change '
+                    'record %s' % (entry['environment'], entry['kind'],
+                                   entry['change_record']))
+                self.metrics.incr('journal.dropped')
+                return True
+            self._put_time(
+                sys_id, entry['environment'], entry['kind'], entry['time'])
+        except ServiceNowWorkerError, ex:
+            self.app_logger.warn(
+                'Unable to deliver journaled %s %s time for %s: %s' % (
+                    entry['environment'], entry['kind'],
+                    entry['change_record'], ex))
+            self.metrics.incr('journal.retries')
+            return False
+        finally:
+            self._local.corr_id = None
+        self.metrics.incr('journal.delivered')
+        self.metrics.timing(
+            'journal.delay', time.time() - entry.get('accepted', time.time()))
+        return True
+
+    def _start_warm_up(self):
+        """
+        Starts the background cache warm up thread if cache_warm_up has
+        a query configured.
+        """
+        self._warm_up_stop = threading.Event()
+        warm_up = self._config.get('cache_warm_up', {})
+        if not warm_up.get('query') or self._sys_id_cache is None:
+            return
+        # Under the supervisor children sharing a cache only need one
+        # of them to warm it
+        if (isinstance(self._sys_id_cache, (SysIdCache, RedisSysIdCache)) and
+                os.environ.get(SLOT_ENV, '0') != '0'):
+            return
+        thread = threading.Thread(
+            target=self._warm_up_loop, name='servicenow-warm-up')
+        thread.daemon = True
+        thread.start()
+
+    def _warm_up_loop(self):
+        """
+        Preloads the cache now and then keeps it fresh until
+        _warm_up_stop is set. With incremental set only records updated
+        since the last watermark are fetched every sync_interval seconds,
+        otherwise everything is fetched again every interval seconds.
+        """
+        warm_up = self._config['cache_warm_up']
+        incremental = warm_up.get('incremental', False)
+        if incremental:
+            interval = warm_up.get('sync_interval', 60)
+        else:
+            interval = warm_up.get('interval', 900)
+        while not self._warm_up_stop.is_set():
+            try:
+                if incremental:
+                    self.sync_cache()
+                else:
+                    self.warm_up()
+            except Exception, ex:
+                self.app_logger.error('Cache warm up failed: %s' % ex)
+            self._warm_up_stop.wait(interval)
+
+    def _start_keepalive(self):
+        """
+        Starts the background connection keep-alive thread when the
+        http.session transport is used and http.prewarm_connections or
+        http.keepalive_interval is set.
+        """
+        self._keepalive_stop = threading.Event()
+        http = self._config.get('http', {})
+        if self._transport is requests:
+            return
+        if not (http.get('prewarm_connections') or
+                http.get('keepalive_interval')):
+            return
+        thread = threading.Thread(
+            target=self._keepalive_loop, name='servicenow-keepalive')
+        thread.daemon = True
+        thread.start()
+
+    def _keepalive_loop(self):
+        """
+        Opens http.prewarm_connections connections to every endpoint,
+        then every http.keepalive_interval seconds reconnects pooled
+        connections idle for longer than http.max_idle so a load
+        balancer's idle timeout never catches one. Runs until
+        _keepalive_stop is set.
+        """
+        http = self._config.get('http', {})
+        timeout = self._config.get('timeouts', {}).get('connect', 5)
+        count = http.get('prewarm_connections', 0)
+        if count:
+            for pool in self._endpoints.values():
+                for endpoint in pool.endpoints:
+                    try:
+                        opened = self._transport.prewarm(
+                            endpoint.url, count, timeout)
+                    except Exception, ex:
+                        self.app_logger.warn(
+                            'Unable to pre-warm connections to %s: %s' % (
+                                redact_url(endpoint.url), ex))
+                        continue
+                    self.metrics.incr('http.connections.prewarmed', opened)
+
+        interval = http.get('keepalive_interval')
+        if not interval:
+            return
+        while not self._keepalive_stop.wait(interval):
+            try:
+                refreshed = self._transport.refresh_idle(
+                    http.get('max_idle', 50), timeout)
+            except Exception, ex:
+                self.app_logger.warn('Connection keep-alive failed: %s' % ex)
+                continue
+            self.metrics.incr('http.connections.refreshed', refreshed)
+
+    def warm_up(self):
+        """
+        Pages through the configured tables for records matching the
+        cache_warm_up query and stores their sys_ids. Returns the number
+        of records applied.
+        """
+        warm_up = self._config['cache_warm_up']
+        total = 0
+        for table in warm_up.get('tables', SysIdCache.tables):
+            total += self._load_records(table, warm_up['query'])
+        self.app_logger.info('Cache warm up loaded %s records' % total)
+        return total
+
+    def sync_cache(self):
+        """
+        Applies records updated since each table's sys_updated_on
+        watermark to the cache. Tables without a watermark get a full
+        warm up instead. Returns the number of records applied.
+        """
+        warm_up = self._config['cache_warm_up']
+        total = 0
+        for table in warm_up.get('tables', SysIdCache.tables):
+            watermark = self._sys_id_cache.get_meta('watermark:' + table)
+            if watermark is None:
+                query = warm_up['query']
+            else:
+                # >= so records sharing the watermark second are not missed
+                query = '^'.join(q for q in (
+                    warm_up.get('sync_query', ''),
+                    'sys_updated_on>=' + watermark) if q)
+            total += self._load_records(table, query)
+        self.app_logger.debug('Cache sync applied %s records' % total)
+        return total
+
+    def _load_records(self, table, query):
+        """
+        Stores the records matching a query in the cache. Inactive
+        records are treated as closed and dropped. The newest
+        sys_updated_on seen becomes the table's watermark.
+
+        *Parameters*:
+            * table: The table to query.
+            * query: An encoded query.
+        """
+        page_size = self._config['cache_warm_up'].get('page_size', 500)
+        key = 'watermark:' + table
+        newest = self._sys_id_cache.get_meta(key) or ''
+        upserts = []
+        total = 0
+        for record in self._iter_records(
+                table, query,
+                ('number', 'sys_id', 'sys_updated_on', 'active'),
+                page_size=page_size):
+            total += 1
+            newest = max(newest, record.get('sys_updated_on') or '')
+            if record.get('active') == 'false':
+                self._sys_id_cache.delete(table, record['number'])
+                continue
+            upserts.append((record['number'], record['sys_id']))
+            if len(upserts) >= page_size:
+                self._sys_id_cache.set_many(table, upserts)
+                upserts = []
+        self._sys_id_cache.set_many(table, upserts)
+        if newest:
+            self._sys_id_cache.set_meta(key, newest)
+        return total
+
+    def _iter_records(self, table, query, fields, page_size=500):
+        """
+        Yields the records matching an encoded query a page at a time
+        using sysparm_offset and sysparm_limit.
+
+        *Parameters*:
+            * table: The table to query.
+            * query: An encoded query.
+            * fields: The fields to return for each record, as a list or
+              a comma separated string.
+            * page_size: Records to request per page.
+        """
+        if isinstance(fields, basestring):
+            fields = fields.split(',')
+        if not isinstance(fields, (list, tuple)) or not all(
+                isinstance(field, basestring) for field in fields):
+            raise ServiceNowWorkerError(
+                'fields must be a list or a comma separated string.')
+        fields = [field.strip() for field in fields if field.strip()]
+        if not fields:
+            raise ServiceNowWorkerError('No fields were given.')
+        # Paging needs a stable order
+        if 'ORDERBY' not in query:
+            query = '^'.join(q for q in (query, 'ORDERBYsys_id') if q)
+        offset = 0
+        while True:
+            path = '/table/%s?sysparm_query=%s&sysparm_fields=%s' % (
+                table, quote_plus(query), quote_plus(','.join(fields)))
+            path += '&sysparm_limit=%s&sysparm_offset=%s' % (
+                page_size, offset)
+            response = self._request(
+                'get', 'root', path,
+                headers={'Accept': 'application/json'})
+            # Older instances answer an empty query with a 404
+            if response.status_code == 404:
+                return
+            if response.status_code != 200:
+                raise ServiceNowWorkerError(
+                    'api returned %s instead of 200' % (
+                        response.status_code))
+            page = response.json()['result']
+            for record in page:
+                yield record
+            if len(page) < page_size:
+                return
+            offset += page_size
+
+    def _cache_get(self, table, number):
+        """
+        Returns a cached sys_id or None. Cache errors are logged and
+        treated as a miss.
+        """
+        if self._sys_id_cache is None:
+            return None
+        try:
+            return self._sys_id_cache.get(table, number)
+        except Exception, ex:
+            self.app_logger.warn('sys_id cache read failed: %s' % ex)
+            return None
+
+    def _cache_get_many(self, keys):
+        """
+        Returns a dict of cached sys_ids by (table, number). Cache
+        errors are logged and treated as misses.
+        """
+        if self._sys_id_cache is None:
+            return {}
+        try:
+            return self._sys_id_cache.get_many(keys)
+        except Exception, ex:
+            self.app_logger.warn('sys_id cache read failed: %s' % ex)
+            return {}
+
+    def _cache_set(self, table, number, sys_id):
+        """
+        Stores a sys_id in the cache if one is configured.
+        """
+        if self._sys_id_cache is None or not (number and sys_id):
+            return
+        try:
+            self._sys_id_cache.set(table, number, sys_id)
+        except Exception, ex:
+            self.app_logger.warn('sys_id cache write failed: %s' % ex)
+
+    def _setup_hedging(self):
+        """
+        Creates the hedge policy for reads if hedging is enabled.
+        """
+        self._hedge_policy = None
+        hedging = self._config.get('hedging', {})
+        if hedging.get('enabled', False):
+            self._hedge_policy = HedgePolicy(
+                percentile=hedging.get('percentile', 95),
+                min_delay=hedging.get('min_delay', 0.05),
+                max_delay=hedging.get('max_delay', 5.0),
+                window=hedging.get('window', 200),
+                min_samples=hedging.get('min_samples', 20),
+                budget_ratio=hedging.get('budget_ratio', 0.05),
+                max_budget=hedging.get('max_budget', 10))
+
+    def _install_drain_handler(self):
+        """
+        Drains on SIGTERM if shutdown.drain_timeout is configured.
+        Signal handlers can only be set from the main thread.
+        """
+        if not self._config.get('shutdown', {}).get('drain_timeout'):
+            return
+        if threading.current_thread().name != 'MainThread':
+            return
+        signal.signal(signal.SIGTERM, self.request_drain)
+        # Let in flight socket calls carry on rather than fail with EINTR
+        signal.siginterrupt(signal.SIGTERM, False)
+
+    def _setup_profiling(self):
+        """
+        Sets up profiling if profiling.directory is configured. Every
+        Nth process call is profiled with cProfile when profiling.every
+        is set, and profiling.signal starts the stack sampler for
+        profiling.window seconds.
+        """
+        profiling = self._config.get('profiling', {})
+        self._profile_dir = profiling.get('directory')
+        self._profile_every = int(profiling.get('every') or 0)
+        self._process_count = 0
+        self._sampler = None
+        self._sampling_requested = False
+        self._sampling_signal = None
+        #: (subcommand, correlation id) by the ident of the thread on it
+        self._thread_messages = {}
+        if not self._profile_dir or not profiling.get('window'):
+            return
+        if threading.current_thread().name != 'MainThread':
+            return
+        signum = getattr(signal, profiling.get('signal', 'SIGUSR2'))
+        signal.signal(signum, self.request_sampling)
+        signal.siginterrupt(signum, False)
+        self._sampling_signal = signum
+
+    def _profile_path(self, *tags):
+        """
+        Returns a path in the profiling directory named after the time,
+        the pid and the tags.
+        """
+        name = '-'.join(
+            [str(int(time.time())), str(os.getpid())] + [
+                ''.join(c if c.isalnum() or c in '._' else '_'
+                        for c in str(tag))
+                for tag in tags])
+        return os.path.join(self._profile_dir, name)
+
+    def request_sampling(self, signum=None, frame=None):
+        """
+        profiling.signal handler. Like request_drain it may interrupt
+        the ioloop in the middle of anything, so it only flags the
+        request and _watch_sampling starts the sampler on the ioloop.
+        """
+        self._sampling_requested = True
+
+    def _watch_sampling(self):
+        """
+        Starts the sampler once it is requested and stops it once its
+        window is over, then checks again in sampling_check_interval
+        seconds. Runs on the ioloop.
+        """
+        if self._sampling_requested:
+            self._sampling_requested = False
+            self.start_sampling()
+        self.stop_sampling()
+        connection = getattr(self, '_connection', None)
+        if connection is not None and hasattr(connection, 'add_timeout'):
+            connection.add_timeout(
+                self.sampling_check_interval, self._watch_sampling)
+
+    def start_sampling(self):
+        """
+        Samples stacks for profiling.window seconds. Each stack is rooted
+        at the subcommand and correlation id being processed, or idle
+        between messages. With lanes the lane threads processing a
+        message are sampled as well as the ioloop thread. Must run on
+        the ioloop.
+        """
+        if self._sampler is not None:
+            return
+        profiling = self._config.get('profiling', {})
+        window = float(profiling.get('window', 30))
+
+        def tag(ident):
+            message = self._thread_messages.get(ident)
+            if message is not None:
+                return [message[0], str(message[1])]
+            if ident == self._ioloop_thread.ident:
+                return ['idle']
+            # Idle lane and background threads are left out
+            return None
+
+        self.app_logger.info('Sampling stacks for %ss' % window)
+        self._sampler = StackSampler(
+            interval=profiling.get('interval', 0.005), tag=tag,
+            all_threads=self._lanes is not None)
+        self._sampler_until = time.time() + window
+        self._sampler.start()
+
+    def stop_sampling(self, force=False):
+        """
+        Stops the stack sampler once its window is over, or right away
+        if force is set, and writes the folded stacks out.
+        """
+        sampler = self._sampler
+        if sampler is None:
+            return
+        if not force and time.time() < self._sampler_until:
+            return
+        sampler.stop()
+        self._sampler = None
+        path = self._profile_path('sampled') + '.folded'
+        try:
+            sampler.write(path)
+        except (IOError, OSError), ex:
+            self.app_logger.warn('Unable to write profile: %s' % ex)
+            return
+        self.metrics.incr('profiles.written')
+        self.app_logger.info('Wrote %s stack samples to %s' % (
+            sampler.samples, path))
+
+    def request_drain(self, signum=None, frame=None):
+        """
+        SIGTERM handler. It may interrupt the ioloop in the middle of
+        anything, including a message's HTTP calls, so it only sets the
+        drain deadline and the hard stop alarm, which bound those calls
+        and the shutdown from now on. New messages are requeued and
+        _watch_drain does the rest on the ioloop.
+        """
+        if self._drain_deadline is None:
+            drain_timeout = self._drain_timeout()
+            self._drain_deadline = Deadline(drain_timeout)
+            # Hard stop if draining somehow overruns the limit
+            signal.alarm(int(math.ceil(drain_timeout)) + 5)
+        self._draining = True
+
+    def _drain_timeout(self):
+        """
+        Returns shutdown.drain_timeout in seconds.
+        """
+        return float(
+            self._config.get('shutdown', {}).get('drain_timeout', 30))
+
+    def _watch_drain(self):
+        """
+        Begins a drain once one is requested, otherwise checks again in
+        drain_check_interval seconds. Runs on the ioloop.
+        """
+        if self._draining:
+            self.begin_drain()
+            return
+        connection = getattr(self, '_connection', None)
+        if connection is not None and hasattr(connection, 'add_timeout'):
+            connection.add_timeout(
+                self.drain_check_interval, self._watch_drain)
+
+    def begin_drain(self):
+        """
+        Stops consuming and lets in flight work finish within
+        shutdown.drain_timeout seconds. Calls still running at the limit
+        hit their deadline and the message gets a failure reply. Must
+        run on the ioloop.
+        """
+        if self._drain_begun:
+            return
+        self._drain_begun = True
+        self.request_drain()
+        self.app_logger.info(
+            'Draining with %s messages in flight, %.1fs left' % (
+                self._in_flight, self._drain_deadline.remaining()))
+        self._warm_up_stop.set()
+        self._keepalive_stop.set()
+        self._journal_stop.set()
+        self._journal_wake.set()
+        if self._resolver is not None:
+            self._resolver.stop()
+
+        channel = getattr(self, '_channel', None)
+        if channel is not None:
+            for tag in list(getattr(channel, 'consumer_tags', [])):
+                try:
+                    channel.basic_cancel(
+                        consumer_tag=tag, callback=lambda frame: None)
+                except Exception, ex:
+                    self.app_logger.warn(
+                        'Unable to cancel consumer %s: %s' % (tag, ex))
+
+        if not self._in_flight and not self._lane_pending:
+            self._finish_drain()
+
+    def _maybe_finish_drain(self):
+        """
+        Finishes draining once nothing is in flight or waiting in a lane.
+        """
+        if (self._drain_begun and not self._in_flight and
+                not self._lane_pending):
+            self._on_ioloop(self._finish_drain)
+
+    def _finish_drain(self):
+        """
+        Flushes what is left and closes the connection so run_forever
+        returns.
+        """
+        if self._drained:
+            return
+        self._drained = True
+        self.app_logger.info('Drain complete, shutting down')
+        self._dump_metrics(force=True)
+        signal.alarm(0)
+        connection = getattr(self, '_connection', None)
+        if connection is None:
+            return
+        try:
+            # Closing sends anything still buffered before the close frame
+            connection.close()
+        finally:
+            connection.ioloop.stop()
+
+    def _dump_metrics(self, force=False):
+        """
+        Writes a metrics snapshot to <directory>/<pid>.json at most once
+        per metrics.interval seconds. The directory comes from the
+        supervisor or from metrics.directory in the config.
+        """
+        metrics_config = self._config.get('metrics', {})
+        directory = os.environ.get(
+            METRICS_DIR_ENV, metrics_config.get('directory'))
+        if not directory:
+            return
+        now = time.time()
+        if not force and (
+                now - self._metrics_dumped < metrics_config.get(
+                    'interval', 10)):
+            return
+        self._metrics_dumped = now
+        if self._limiter is not None:
+            status = self._limiter.status()
+            self.metrics.gauge('concurrency.limit', status['limit'])
+            self.metrics.gauge('concurrency.in_flight', status['in_flight'])
+        if self._hedge_policy is not None:
+            self.metrics.gauge('hedge.sent', self._hedge_policy.hedged)
+            self.metrics.gauge('hedge.denied', self._hedge_policy.denied)
+        if self._import_batcher is not None:
+            self.metrics.gauge(
+                'bulk_import.batches', self._import_batcher.batches)
+            self.metrics.gauge('bulk_import.rows', self._import_batcher.items)
+        if isinstance(self._sys_id_cache, RedisSysIdCache):
+            self.metrics.gauge(
+                'cache.unavailable', self._sys_id_cache.unavailable)
+        if self._journal is not None:
+            self.metrics.gauge('journal.pending', len(self._journal.pending()))
+        if self._lanes is not None:
+            for name, lane in self._lanes.items():
+                for key, value in lane.status().items():
+                    self.metrics.gauge('lanes.%s.%s' % (name, key), value)
+        if not isinstance(self._auth, tuple):
+            self.metrics.gauge('auth.fallbacks', self._auth.fallbacks)
+            self.metrics.gauge('auth.refreshes', self._auth.refreshes)
+        try:
+            self.metrics.dump(
+                os.path.join(directory, '%s.json' % os.getpid()))
+        except (IOError, OSError), ex:
+            self.app_logger.warn('Unable to write metrics: %s' % ex)
 
-    def _get_crq_ids(self, crq):
+    def _make_deadline(self, body):
+        """
+        Returns the Deadline for a message or None. A deadline in the
+        message parameters wins over timeouts.deadline in the config.
+
+        *Parameters*:
+            * body: The message body.
+        """
+        budget = body.get('parameters', {}).get(
+            'deadline', self._config.get('timeouts', {}).get('deadline'))
+        if not budget:
+            return None
+        try:
+            return Deadline(float(budget))
+        except (TypeError, ValueError):
+            raise ServiceNowWorkerError('Invalid deadline %r given.' % budget)
+
+    def _current_deadline(self):
+        """
+        Returns the Deadline of the message being processed by this
+        thread, or the drain deadline if it is sooner, or None.
+        """
+        deadline = getattr(self._local, 'deadline', None)
+        drain = self._drain_deadline
+        if drain is not None and (
+                deadline is None or drain.expires < deadline.expires):
+            return drain
+        return deadline
+
+    def _request(self, method, api, path='', hedge=False, share=None,
+                 **kwargs):
+        """
+        Issues an HTTP request against the best endpoint for an api and
+        fails over to the next endpoint if it errors.
+
+        *Parameters*:
+            * method: The lowercase HTTP method.
+            * api: Either root or import.
+            * path: Path to append to the endpoint url.
+            * hedge: If a slow idempotent read may be duplicated.
+            * share: Fraction of the remaining deadline this call may use.
+            * kwargs: Passed through to requests.
+        """
+        kwargs.setdefault('auth', self._auth)
+        headers = dict(kwargs.get('headers') or {})
+        headers.setdefault('Accept-Encoding', 'gzip, deflate')
+        kwargs['headers'] = headers
+        uncompressed = self._compress_body(method, api, kwargs)
+
+        timeouts = self._config.get('timeouts', {})
+        connect = timeouts.get('connect', 5)
+        read = timeouts.get('read', 30)
+        deadline = self._current_deadline()
+        if deadline is not None:
+            if deadline.expired():
+                raise ServiceNowWorkerError(
+                    'Deadline of %ss exceeded before %s %s' % (
+                        deadline.budget, method.upper(), path or api))
+            if share is not None:
+                # Give this call its own slice of what is left
+                deadline = Deadline(deadline.remaining() * share)
+            kwargs.setdefault('timeout', deadline.timeout(connect, read))
+        else:
+            kwargs.setdefault('timeout', (connect, read))
+
+        policy = self._hedge_policy
+        if not (hedge and policy and method in self.idempotent_methods):
+            response = self._send(
+                method, api, path, kwargs, deadline=deadline)
+            if uncompressed is not None and response.status_code == 415:
+                # The endpoint does not take gzip bodies, stop trying
+                self.app_logger.warn(
+                    'The %s api rejected a gzip body, sending plain' % api)
+                self._gzip_unsupported.add(api)
+                kwargs['data'] = uncompressed
+                del kwargs['headers']['Content-Encoding']
+                response = self._send(
+                    method, api, path, kwargs, deadline=deadline)
+            return response
+
+        corr_id = getattr(self._local, 'corr_id', None)
+        in_message = getattr(self._local, 'in_message', False)
+
+        def primary():
+            self._local.corr_id = corr_id
+            self._local.in_message = in_message
+            start = time.time()
+            response = self._send(
+                method, api, path, kwargs, deadline=deadline)
+            policy.record(time.time() - start)
+            return response
+
+        def backup():
+            self._local.corr_id = corr_id
+            self._local.in_message = in_message
+            # The duplicate prefers the next best endpoint
+            return self._send(
+                method, api, path, kwargs, skip=1, deadline=deadline)
+
+        return hedged_call(primary, backup, policy)
+
+    def _compress_body(self, method, api, kwargs):
+        """
+        Gzips a large request body in place if compression.gzip_requests
+        is set. Returns the original body when it was compressed so it
+        can be resent, else None.
+
+        *Parameters*:
+            * method: The lowercase HTTP method.
+            * api: Either root or import.
+            * kwargs: The requests keyword arguments.
+        """
+        compression = self._config.get('compression', {})
+        data = kwargs.get('data')
+        if (not compression.get('gzip_requests', False) or
+                method not in ('post', 'put') or
+                not isinstance(data, basestring) or
+                api in self._gzip_unsupported or
+                len(data) < compression.get('min_size', 1024)):
+            return None
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        # wbits of 31 gives a gzip container
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        kwargs['data'] = compressor.compress(data) + compressor.flush()
+        kwargs['headers']['Content-Encoding'] = 'gzip'
+        self.metrics.incr('bytes.request.raw', len(data))
+        self.metrics.incr('bytes.request.wire', len(kwargs['data']))
+        return data
+
+    def _count_response_bytes(self, response):
+        """
+        Records the bytes a response took on the wire and after decoding.
+        """
+        content = response.content or ''
+        wire = getattr(response.raw, '_fp_bytes_read', None)
+        if not wire:
+            wire = response.headers.get('Content-Length') or len(content)
+        self.metrics.incr('bytes.response.wire', int(wire))
+        self.metrics.incr('bytes.response.decoded', len(content))
+
+    def _observe_phases(self, method, api, url, response, elapsed):
+        """
+        Records the phase timings of a response and logs it as a slow
+        request if it took longer than http.slow_request_threshold.
+
+        *Parameters*:
+            * method: The lowercase HTTP method.
+            * api: Either root or import.
+            * url: The url requested.
+            * response: The response, with its body read.
+            * elapsed: Seconds the request took.
+        """
+        phases = None
+        if self._transport is not requests:
+            # Only a TimedSession records phases
+            from replugin.servicenowworker.transport import response_phases
+            phases = response_phases(response, elapsed)
+        if phases is not None:
+            for name, value in phases.items():
+                if name != 'reused':
+                    self.metrics.timing('http.phase.%s' % name, value)
+            if phases['reused']:
+                self.metrics.incr('http.connections.reused')
+            else:
+                self.metrics.incr('http.connections.new')
+
+        threshold = self._config.get('http', {}).get('slow_request_threshold')
+        if threshold is None or elapsed < threshold:
+            return
+        self.metrics.incr('http.slow')
+        path = url.split('?')[0]
+        table = None
+        for marker in ('/table/', '/stats/', '/import/'):
+            if marker in path:
+                table = path.split(marker, 1)[1].split('/')[0]
+                break
+        entry = {
+            'event': 'slow_request',
+            'correlation_id': getattr(self._local, 'corr_id', None),
+            'method': method.upper(),
+            'api': api,
+            'table': table,
+            'url': redact_url(url),
+            'status': response.status_code,
+            'bytes': len(response.content or ''),
+            'elapsed': round(elapsed, 6),
+            'phases': dict(
+                (name, value if name == 'reused' else round(value, 6))
+                for name, value in (phases or {}).items()) or None,
+        }
+        self.app_logger.warn('Slow request: %s' % json.dumps(
+            entry, sort_keys=True))
+
+    def _send(self, method, api, path, kwargs, skip=0, deadline=None):
+        """
+        Tries each candidate endpoint in turn until one answers.
+
+        *Parameters*:
+            * method: The lowercase HTTP method.
+            * api: Either root or import.
+            * path: Path to append to the endpoint url.
+            * kwargs: Passed through to requests.
+            * skip: Number of candidates to rotate to the back.
+            * deadline: Deadline which bounds the attempts.
+        """
+        # Hedged attempts share the caller's kwargs
+        kwargs = dict(kwargs)
+        pool = self._endpoints[api]
+        if method == 'get':
+            candidates = pool.read_candidates()
+        else:
+            candidates = pool.write_candidates()
+        if skip:
+            skip = skip % len(candidates)
+            candidates = candidates[skip:] + candidates[:skip]
+        # Non idempotent calls only get a single attempt
+        if method not in self.idempotent_methods:
+            candidates = candidates[:1]
+
+        last_error = None
+        for endpoint in candidates:
+            if deadline is not None:
+                if deadline.expired():
+                    raise ServiceNowWorkerError(
+                        'Deadline of %ss exceeded during %s %s' % (
+                            deadline.budget, method.upper(), path or api))
+                kwargs['timeout'] = deadline.timeout(*kwargs['timeout'])
+            start = time.time()
+            try:
+                response = getattr(self._transport, method)(
+                    endpoint.url + path, **kwargs)
+            except requests.exceptions.RequestException, ex:
+                self.metrics.incr('http.errors')
+                self._record_call(time.time() - start, True)
+                pool.record_failure(endpoint)
+                self.app_logger.warn(
+                    'Request to %s failed: %s' % (endpoint.url, ex))
+                last_error = ex
+                continue
+
+            self.metrics.timing('http.%s' % method, time.time() - start)
+            self._count_response_bytes(response)
+            self._observe_phases(
+                method, api, endpoint.url + path, response,
+                time.time() - start)
+            if self._capture is not None:
+                self._capture.http(
+                    getattr(self._local, 'corr_id', None), method, api,
+                    path, kwargs, response, time.time() - start)
+            self._record_call(
+                time.time() - start, response.status_code >= 500)
+            if response.status_code >= 500:
+                self.metrics.incr('http.errors')
+                pool.record_failure(endpoint)
+                if endpoint is not candidates[-1]:
+                    self.app_logger.warn(
+                        'Endpoint %s returned %s, failing over' % (
+                            endpoint.url, response.status_code))
+                    continue
+            else:
+                pool.record_success(endpoint, time.time() - start)
+            return response
+
+        raise ServiceNowWorkerError(
+            'Unable to reach any ServiceNow endpoint: %s' % last_error)
+
+    def _get_crq_ids(self, crq, share=None, strict=False):
         """
         Returns the sys_id and number for a crq.
 
         *Parameters*:
             * crq: The Change Record name.
+            * share: Fraction of the remaining deadline the lookup may use.
+            * strict: Raise on an error response instead of treating it
+              as not found.
         """
-        url = self._config['api_root_url'] + '/table/change_request'
-        url += '?sysparm_query=%s&sysparm_fields=number,sys_id&sysparm_limit=1' % (
+        sys_id = self._cache_get('change_request', crq)
+        if sys_id:
+            return {'number': crq, 'sys_id': sys_id}
+
+        path = '/table/change_request'
+        path += '?sysparm_query=%s&sysparm_fields=number,sys_id&sysparm_limit=1' % (
             quote_plus('number=' + crq))
 
-        response = requests.get(
-            url,
-            auth=(
-                self._config['servicenow_user'],
-                self._config['servicenow_password']),
+        response = self._request(
+            'get', 'root', path, hedge=True, share=share,
             headers={'Accept': 'application/json'})
 
+        if strict and response.status_code != 200:
+            raise ServiceNowWorkerError('API returned %s instead of 200' % (
+                response.status_code))
         # we should get a 200, else it doesn't exist or server issue
-        if response.status_code == 200:
+        if response.status_code == 200 and response.json()['result']:
             result = response.json()['result'][0]
+            self._cache_set(
+                'change_request', result['number'], result['sys_id'])
             return {'number': result['number'], 'sys_id': result['sys_id']}
         return {'number': None, 'sys_id': None}
 
+    def _record_exists(self, table, number, share=None):
+        """
+        Returns True if a record with the given number exists. How the
+        check is made depends on existence_check in the config:
+
+            * record: fetch the record (default)
+            * probe: fetch only the sys_id of at most one record
+            * aggregate: ask the Aggregate API for a count
+
+        *Parameters*:
+            * table: The table to look in.
+            * number: The record number.
+            * share: Fraction of the remaining deadline the call may use.
+        """
+        mode = self._config.get('existence_check', 'record')
+        query = quote_plus('number=' + number)
+        if mode == 'aggregate':
+            path = '/stats/%s?sysparm_count=true&sysparm_query=%s' % (
+                table, query)
+        elif mode == 'probe':
+            path = '/table/%s?sysparm_query=%s' % (table, query)
+            path += '&sysparm_fields=number,sys_id&sysparm_limit=1'
+        elif table == 'change_request':
+            path = '/table/change_request'
+            path += '?sysparm_query=%s&sysparm_fields=number&sysparm_limit=2' % (
+                query)
+        else:
+            path = '/table/%s?sysparm_limit=1&sysparm_query=%s' % (
+                table, query)
+
+        self.app_logger.info('Checking for %s at %s' % (number, path))
+
+        response = self._request(
+            'get', 'root', path, hedge=True, share=share,
+            headers={'Accept': 'application/json'})
+
+        # 404 means it can't be found
+        if response.status_code == 404:
+            return False
+        # anything else but a 200 is an error
+        if response.status_code != 200:
+            raise ServiceNowWorkerError('api returned %s instead of 200' % (
+                response.status_code))
+
+        result = response.json()['result']
+        if mode == 'aggregate':
+            return int(result['stats']['count']) > 0
+        # An empty result is a miss, not an error
+        for record in result:
+            if record.get('number') == number:
+                self._cache_set(table, number, record.get('sys_id'))
+                return True
+        return False
+
     def does_change_record_exist(self, body, output):
         """
         Subcommand which checks to see if a change record exists.
@@ -74,7 +1519,6 @@ class ServiceNowWorker(Worker):
         *Dynamic Parameters Requires*:
             * change_record: the record to look for.
         """
-        # TODO: Use _get_crq_ids
         expected_record = body.get('dynamic', {}).get('change_record', None)
         if not expected_record:
             raise ServiceNowWorkerError(
@@ -82,42 +1526,31 @@ class ServiceNowWorker(Worker):
 
         output.info('Checking for change record %s ...' % expected_record)
 
-        # service now call
-        url = self._config['api_root_url'] + '/table/change_request'
-        url += '?sysparm_query=%s&sysparm_fields=number&sysparm_limit=2' % (
-            quote_plus('number=' + expected_record))
-
-        response = requests.get(
-            url,
-            auth=(
-                self._config['servicenow_user'],
-                self._config['servicenow_password']),
-            headers={'Accept': 'application/json'})
-
-        # we should get a 200, else it doesn't exist or server issue
-        if response.status_code == 200:
-            change_record = response.json()['result'][0]['number']
-            if change_record == expected_record:
-                output.info('found change record %s' % change_record)
-                return {'status': 'completed', 'data': {'exists': True}}
-        # 404 means it can't be found
-        elif response.status_code == 404:
-            output.info('change record %s does not exist.' % expected_record)
-            if self._config.get('auto_create_change_if_missing', False):
-                output.info('Automatically creating a change record')
-                (chg, url) = self.create_change_record(self._config)
-                output.info('Created change %s' % str(chg))
-                _data = {
-                    'exists': True,
-                    'new_record': str(chg),
-                    'new_record_url': str(url)
-                }
-                return {'status': 'completed', 'data': _data}
-            else:
-                return {'status': 'completed', 'data': {'exists': False}}
-        # anything else is an error
-        raise ServiceNowWorkerError('api returned %s instead of 200' % (
-            response.status_code))
+        if self._cache_get('change_request', expected_record):
+            output.info('found change record %s' % expected_record)
+            return {'status': 'completed', 'data': {'exists': True}}
+
+        # Leave time for the create call if one may follow
+        share = None
+        if self._config.get('auto_create_change_if_missing', False):
+            share = self.lookup_share
+
+        if self._record_exists('change_request', expected_record, share):
+            output.info('found change record %s' % expected_record)
+            return {'status': 'completed', 'data': {'exists': True}}
+
+        output.info('change record %s does not exist.' % expected_record)
+        if self._config.get('auto_create_change_if_missing', False):
+            output.info('Automatically creating a change record')
+            (chg, url) = self.create_change_record(self._config)
+            output.info('Created change %s' % str(chg))
+            _data = {
+                'exists': True,
+                'new_record': str(chg),
+                'new_record_url': str(url)
+            }
+            return {'status': 'completed', 'data': _data}
+        return {'status': 'completed', 'data': {'exists': False}}
 
     def does_c_task_exist(self, body, output):
         """
@@ -126,7 +1559,6 @@ class ServiceNowWorker(Worker):
         *Dynamic Parameters Requires*:
             * change_record: the record to look for.
         """
-        # TODO: Use _get_crq_ids
         expected_record = body.get('dynamic', {}).get('ctask', None)
         if not expected_record:
             raise ServiceNowWorkerError(
@@ -138,47 +1570,84 @@ class ServiceNowWorker(Worker):
 
         output.info('Checking for CTask %s ...' % expected_record)
 
-        # service now call
-        url = self._config['api_root_url'] + '/table/change_task'
-        url += '?sysparm_limit=1&sysparm_query=%s' % (
-            quote_plus('number=' + expected_record))
+        if self._cache_get('change_task', expected_record):
+            output.info('found CTask record %s' % expected_record)
+            return {'status': 'completed', 'data': {'exists': True}}
+
+        # Leave time for the create call if one may follow
+        share = None
+        if self._config.get('auto_create_c_task_if_missing', False):
+            share = self.lookup_share
+
+        if self._record_exists('change_task', expected_record, share):
+            output.info('found CTask record %s' % expected_record)
+            return {'status': 'completed', 'data': {'exists': True}}
+
+        output.info('ctask record %s does not exist.' % expected_record)
+        if self._config.get('auto_create_c_task_if_missing', False):
+            output.info('Automatically creating a ctask record')
+            body['dynamic']['change_record'] = change_record
+            result = self.create_c_task(body, output)
+            new_ctask = str(result['data']['ctask'])
+
+            output.info('Created ctask %s' % new_ctask)
+            _data = {
+                'exists': True,
+                'new_ctask': new_ctask,
+            }
+            return {'status': 'completed', 'data': _data}
+        return {'status': 'completed', 'data': {'exists': False}}
 
-        self.app_logger.info('Checking for CTask at %s' % url)
+    def query_records(self, body, output, table, reply):
+        """
+        Subcommand which streams back the records matching an encoded
+        query. Pages are fetched and parsed one at a time and sent back
+        in chunks so memory use does not grow with the result size.
 
-        response = requests.get(
-            url,
-            auth=(
-                self._config['servicenow_user'],
-                self._config['servicenow_password']),
-            headers={'Accept': 'application/json'})
+        *Parameters*:
+            * body: The message body.
+            * output: The output instance back to the user.
+            * table: change_request or change_task
+            * reply: Callable which sends a chunk message back.
 
-        # we should get a 200, else it doesn't exist or server issue
-        if response.status_code == 200:
-            ctask_record = response.json()['result'][0]['number']
-            if ctask_record == expected_record:
-                output.info('found CTask record %s' % ctask_record)
-                return {'status': 'completed', 'data': {'exists': True}}
-        # 404 means it can't be found
-        elif response.status_code == 404:
-            output.info('ctask record %s does not exist.' % expected_record)
-            if self._config.get('auto_create_c_task_if_missing', False):
-                output.info('Automatically creating a ctask record')
-                body['dynamic']['change_record'] = change_record
-                result = self.create_c_task(body, output)
-                new_ctask = str(result['data']['ctask'])
-
-                output.info('Created ctask %s' % new_ctask)
-                _data = {
-                    'exists': True,
-                    'new_ctask': new_ctask,
-                }
-                return {'status': 'completed', 'data': _data}
-            else:
-                return {'status': 'completed', 'data': {'exists': False}}
+        *Dynamic Parameters Requires*:
+            * query: the encoded query to run.
 
-        # anything else is an error
-        raise ServiceNowWorkerError('api returned %s instead of 200' % (
-            response.status_code))
+        *Dynamic Parameters Optional*:
+            * fields: list or comma separated string of fields to return
+              for each record.
+        """
+        query = body.get('dynamic', {}).get('query', None)
+        if not query:
+            raise ServiceNowWorkerError('No query was given.')
+        fields = body.get('dynamic', {}).get(
+            'fields', self.default_query_fields)
+        query_config = self._config.get('query', {})
+        page_size = query_config.get('page_size', 500)
+        chunk_size = query_config.get('chunk_size', 100)
+
+        output.info('Querying %s for %s ...' % (table, query))
+
+        chunk = []
+        chunks = 0
+        count = 0
+        for record in self._iter_records(
+                table, query, fields, page_size=page_size):
+            chunk.append(record)
+            count += 1
+            if len(chunk) >= chunk_size:
+                reply({'status': 'running', 'data': {
+                    'chunk': chunks, 'records': chunk}})
+                chunks += 1
+                chunk = []
+        if chunk:
+            reply({'status': 'running', 'data': {
+                'chunk': chunks, 'records': chunk}})
+            chunks += 1
+
+        output.info('Found %s records in %s' % (count, table))
+        return {'status': 'completed', 'data': {
+            'count': count, 'chunks': chunks}}
 
     def update_time(self, body, output, kind):
         """
@@ -200,67 +1669,298 @@ class ServiceNowWorker(Worker):
         if not environment:
             raise ServiceNowWorkerError('No environment was given.')
 
+        if self._journal is not None:
+            # Durably accepted now, delivered in the background
+            value = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            self._journal.append({
+                'change_record': change_record,
+                'environment': environment,
+                'kind': kind,
+                'time': value,
+                'accepted': time.time(),
+                'corr_id': getattr(self._local, 'corr_id', None),
+            })
+            self._journal_wake.set()
+            self.metrics.incr('journal.accepted')
+            output.info('Journaled the %s %s time %s for %s' % (
+                environment, kind, value, change_record))
+            return {'status': 'completed', 'data': {
+                'time': value, 'journaled': True}}
+
         output.info('Updating the %s %s time for %s ...' % (
             environment, kind, change_record))
 
         # Get the sys_id
-        sys_id = self._get_crq_ids(change_record)['sys_id']
+        sys_id = self._get_crq_ids(
+            change_record, share=self.lookup_share)['sys_id']
 
         # We should get a 200, else it doesn't exist or server issue
         if sys_id:
             output.info('Found change record %s with sys_id %s' % (
                 change_record, sys_id))
             # Now we have the sys_id, we should be able to update the time
-            key = 'u_%s_%s_time' % (environment, kind)
-            value = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            payload = {
-                key: value,
-            }
-            record_url = self._config['api_root_url'] + '%s%s' % (
-                '/table/change_request/', sys_id)
-            response = requests.put(
-                record_url,
-                auth=(
-                    self._config['servicenow_user'],
-                    self._config['servicenow_password']),
-                headers={'Accept': 'application/json'},
-                data=json.dumps(payload))
-            # Return success if we have a 200, else fall into the
-            # "Anything else is an error" below
-            if response.status_code == 200:
-                return {'status': 'completed'}
-            else:
-                raise ServiceNowWorkerError('API returned %s instead of 200' % (
-                    response.status_code))
+            self._put_time(sys_id, environment, kind)
+            return {'status': 'completed'}
 
         # Anything else is an error
         output.error('Could not update timing due to missing change record')
         raise ServiceNowWorkerError('Could not update timing due to missing change record')
 
-    def create_change_record(self, config):
+    def _put_time(self, sys_id, environment, kind, value=None):
+        """
+        Sets an environment's start or end time on a change record, to
+        now unless a time is given. Returns the time written.
+
+        *Parameters*:
+            * sys_id: The sys_id of the change record.
+            * environment: the environment record to update
+            * kind: start or end
+            * value: The time as YYYY-MM-DD HH:MM:SS.
+        """
+        key = 'u_%s_%s_time' % (environment, kind)
+        if value is None:
+            value = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        payload = {
+            key: value,
+        }
+        record_path = '%s%s' % ('/table/change_request/', sys_id)
+        response = self._request(
+            'put', 'root', record_path,
+            headers={'Accept': 'application/json'},
+            data=json.dumps(payload))
+        if response.status_code != 200:
+            raise ServiceNowWorkerError('API returned %s instead of 200' % (
+                response.status_code))
+        return value
+
+    def _parallel(self, *calls):
+        """
+        Runs callables at the same time and returns their results in
+        order. The message's deadline and correlation id carry over to
+        each call. If any call raises, the first error is re-raised
+        once they have all finished.
+
+        *Parameters*:
+            * calls: The callables to run.
+        """
+        corr_id = getattr(self._local, 'corr_id', None)
+        deadline = getattr(self._local, 'deadline', None)
+        in_message = getattr(self._local, 'in_message', False)
+        results = [None] * len(calls)
+        errors = [None] * len(calls)
+
+        def run(index, call):
+            self._local.corr_id = corr_id
+            self._local.deadline = deadline
+            self._local.in_message = in_message
+            try:
+                results[index] = call()
+            except Exception:
+                errors[index] = sys.exc_info()
+
+        threads = []
+        for index, call in enumerate(calls[1:], 1):
+            thread = threading.Thread(target=run, args=(index, call))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        # The first call runs here rather than on a thread of its own
+        run(0, calls[0])
+        for thread in threads:
+            thread.join()
+
+        for exc_info in errors:
+            if exc_info is not None:
+                raise exc_info[0], exc_info[1], exc_info[2]
+        return results
+
+    def ensure_change_and_c_task(self, body, output):
+        """
+        Subcommand which does the work of DoesChangeRecordExist,
+        DoesCTaskExist, CreateCTask and UpdateStartTime in one message.
+        The change record and CTask lookups run in parallel, as do the
+        CTask creation and the start time update. The change record's
+        sys_id is looked up once and reused.
+
+        *Dynamic Parameters Requires*:
+            * change_record: the change record to ensure.
+
+        *Dynamic Parameters Optional*:
+            * ctask: a CTask to look for. It is created if it is missing
+              or not given.
+            * ctask_description: description for a created CTask.
+            * environment: the environment whose start time to update.
+        """
+        dynamic = body.get('dynamic', {})
+        change_record = dynamic.get('change_record', None)
+        if not change_record:
+            raise ServiceNowWorkerError('No change_record was given.')
+        ctask = dynamic.get('ctask', None)
+        environment = dynamic.get('environment', None)
+
+        output.info('Ensuring change record %s and its CTask ...' % (
+            change_record))
+
+        keys = [('change_request', change_record)]
+        if ctask:
+            keys.append(('change_task', ctask))
+        # One round trip to the cache for both records
+        cached = self._cache_get_many(keys)
+        sys_id = cached.get(keys[0])
+        ctask_found = len(keys) > 1 and keys[1] in cached
+
+        lookups = []
+        if not sys_id:
+            # An error response must not pass for a missing change, or
+            # auto creation would make a duplicate
+            lookups.append(lambda: self._get_crq_ids(
+                change_record, share=self.lookup_share,
+                strict=True)['sys_id'])
+        if ctask and not ctask_found:
+            lookups.append(lambda: self._record_exists(
+                'change_task', ctask, self.lookup_share))
+        if lookups:
+            found = self._parallel(*lookups)
+            if not sys_id:
+                sys_id = found.pop(0)
+            if ctask and not ctask_found:
+                ctask_found = found.pop(0)
+
+        data = {'change_record': change_record, 'new_record': False}
+        if not sys_id:
+            if not self._config.get('auto_create_change_if_missing', False):
+                raise ServiceNowWorkerError(
+                    'Change record %s does not exist.' % change_record)
+            output.info('Automatically creating a change record')
+            # The import result already holds the new sys_id
+            (chg, url, sys_id) = self._create_change(self._config)
+            output.info('Created change %s' % str(chg))
+            change_record = str(chg)
+            data.update({
+                'change_record': change_record,
+                'new_record': True,
+                'new_record_url': str(url),
+            })
+        data['sys_id'] = sys_id
+        output.info('Found change record %s with sys_id %s' % (
+            change_record, sys_id))
+
+        updates = []
+        if ctask_found:
+            output.info('found CTask record %s' % ctask)
+            data.update({'ctask': ctask, 'new_ctask': False})
+        else:
+            ctask_body = {'dynamic': {
+                'change_record': change_record,
+                'ctask_description': dynamic.get('ctask_description')}}
+            updates.append(lambda: self.create_c_task(ctask_body, output))
+        if environment:
+            updates.append(
+                lambda: self._put_time(sys_id, environment, 'start'))
+        if updates:
+            results = self._parallel(*updates)
+            if not ctask_found:
+                data.update({
+                    'ctask': str(results.pop(0)['data']['ctask']),
+                    'new_ctask': True})
+            if environment:
+                data['start_time'] = results[0]
+
+        return {'status': 'completed', 'data': data}
+
+    def create_change_records(self, body, output):
+        """
+        Subcommand which creates change records. With bulk_import
+        enabled a list of changes is sent to insertMultiple in as few
+        requests as max_rows allows.
+
+        *Dynamic Parameters Optional*:
+            * change: fields to set on the change record over the
+              change_record_payload template.
+            * changes: a list of such fields, one change record is
+              created for each.
+        """
+        dynamic = body.get('dynamic', {})
+        changes = dynamic.get('changes', None)
+        if changes is None:
+            output.info('Creating a change record ...')
+            (chg, url) = self.create_change_record(
+                self._config, dynamic.get('change', None))
+            output.info('Created change %s' % chg)
+            return {
+                'status': 'completed',
+                'data': {'change_record': chg, 'new_record_url': url}}
+
+        if not isinstance(changes, list) or not changes:
+            raise ServiceNowWorkerError('changes must be a non-empty list.')
+        output.info('Creating %s change records ...' % len(changes))
+        rows = [self._change_row(self._config, change) for change in changes]
+        if self._import_batcher is not None:
+            results = self._import_batcher.send_all(rows)
+        else:
+            results = []
+            for row in rows:
+                try:
+                    results.append(self._post_change_row(row))
+                except ServiceNowWorkerError, ex:
+                    results.append(ex)
+
+        records = []
+        failed = 0
+        for result in results:
+            if isinstance(result, Exception):
+                failed += 1
+                records.append({'error': str(result)})
+            else:
+                records.append({
+                    'change_record': result[0], 'new_record_url': result[1]})
+        if failed == len(records):
+            raise ServiceNowWorkerError(
+                'No change records could be created: %s' % (
+                    records[0]['error']))
+        output.info('Created %s of %s change records' % (
+            len(records) - failed, len(records)))
+        return {
+            'status': 'completed',
+            'data': {'change_records': records, 'failed': failed}}
+
+    def create_change_record(self, config, overrides=None):
         """
         Create a new change record. Adds a record to the import table
-        which is later processed by transformation maps.
+        which is later processed by transformation maps. With
+        bulk_import enabled the row is sent together with rows from
+        other threads.
+
+        *Parameters*:
+            * config: The config holding the change record template.
+            * overrides: Fields to set over the template.
+        """
+        return self._create_change(config, overrides)[:2]
+
+    def _create_change(self, config, overrides=None):
+        """
+        Does the work of create_change_record. Returns the change
+        number, url and sys_id.
+        """
+        row = self._change_row(config, overrides)
+        if self._import_batcher is not None:
+            return self._import_batcher.submit(row)
+        return self._post_change_row(row)
+
+    def _post_change_row(self, row):
+        """
+        Posts a single change row to the import table. Returns the
+        change number, url and sys_id.
         """
-        url = config['api_import_url']
-        auth = (
-            config['servicenow_user'],
-            config['servicenow_password']
-        )
         headers = {
             'content-type': 'application/json',
             'Accept': 'application/json'
         }
 
-        # Process the change record template into a handy-dandy string
-        # to send in the API POST call
-        payload = self._do_change_template(config)
-
-        response = requests.post(
-            url,
-            data=payload,
-            headers=headers,
-            auth=auth)
+        response = self._request(
+            'post', 'import',
+            data=json.dumps(row),
+            headers=headers)
 
         if response.status_code == 201:
             """
@@ -279,32 +1979,150 @@ class ServiceNowWorker(Worker):
                  'staging_table': 'u_test_change_creation'
             }
             """
-            result = response.json()['result'][0]
-            change_record = result['display_value']
-            change_url = result['record_link']
+            return self._change_result(response.json()['result'][0])
+        self._import_failed(response)
 
-            self.app_logger.info("Change record {CHG_NUM} created: {CHG_URL}".format(
-                CHG_NUM=change_record,
-                CHG_URL=change_url)
-            )
-            return (change_record, change_url)
+    def _insert_multiple(self, rows):
+        """
+        Posts change rows to the import table's insertMultiple endpoint.
+        Returns for each row, in order, the change number, url and
+        sys_id or a ServiceNowWorkerError if that row was not transformed.
 
-        elif response.status_code == 403:
+        *Parameters*:
+            * rows: The change rows.
+        """
+        headers = {
+            'content-type': 'application/json',
+            'Accept': 'application/json'
+        }
+        response = self._request(
+            'post', 'import', '/insertMultiple',
+            data=json.dumps({'records': rows}),
+            headers=headers)
+        if response.status_code not in (200, 201):
+            self._import_failed(response)
+        self.metrics.incr('bulk_import.requests')
+
+        # Only the import set comes back, the outcome of each row is on
+        # its staging record
+        import_set = response.json().get('import_set_id')
+        if not import_set:
+            raise ServiceNowWorkerError(
+                'insertMultiple returned no import_set_id: %s' % (
+                    response.text))
+        staged = self._staged_rows(import_set, len(rows))
+        if len(staged) != len(rows):
+            raise ServiceNowWorkerError(
+                'Import set %s has %s rows for %s sent' % (
+                    import_set, len(staged), len(rows)))
+
+        targets = [row['sys_target_sys_id'] for row in staged
+                   if row['sys_target_sys_id']]
+        numbers = {}
+        if targets:
+            for record in self._iter_records(
+                    'change_request', 'sys_idIN' + ','.join(targets),
+                    ('number', 'sys_id'), page_size=len(targets) + 1):
+                numbers[record['sys_id']] = record['number']
+
+        root = self._endpoints['root'].primary.url.rstrip('/')
+        mapped = []
+        for row in staged:
+            sys_id = row['sys_target_sys_id']
+            try:
+                mapped.append(self._change_result({
+                    'status': row['sys_import_state'],
+                    'status_message': row.get('sys_import_state_comment'),
+                    'sys_id': sys_id if sys_id in numbers else '',
+                    'display_value': numbers.get(sys_id),
+                    'record_link': '%s/table/change_request/%s' % (
+                        root, sys_id),
+                }))
+            except ServiceNowWorkerError, ex:
+                mapped.append(ex)
+        return mapped
+
+    def _staged_rows(self, import_set, count):
+        """
+        Returns the staging rows of an import set in the order they were
+        sent, waiting up to bulk_import.transform_timeout seconds for
+        them to be transformed. Rows still not transformed are returned
+        as errors.
+
+        *Parameters*:
+            * import_set: The import set sys_id.
+            * count: The number of rows sent.
+        """
+        bulk = self._config.get('bulk_import', {})
+        poll_interval = bulk.get('poll_interval', 0.25)
+        give_up = time.time() + bulk.get('transform_timeout', 10)
+        query = 'sys_import_set=%s^ORDERBYsys_import_row' % import_set
+        while True:
+            staged = []
+            for record in self._iter_records(
+                    'sys_import_set_row', query,
+                    ('sys_import_row', 'sys_import_state',
+                     'sys_import_state_comment', 'sys_target_sys_id'),
+                    page_size=count + 1):
+                target = record.get('sys_target_sys_id') or ''
+                if isinstance(target, dict):
+                    target = target.get('value') or ''
+                record['sys_target_sys_id'] = target
+                staged.append(record)
+            waiting = len(staged) < count or any(
+                row.get('sys_import_state') == 'pending' for row in staged)
+            deadline = self._current_deadline()
+            if not waiting or time.time() >= give_up or (
+                    deadline is not None and
+                    deadline.remaining() <= poll_interval):
+                break
+            time.sleep(poll_interval)
+        for row in staged:
+            if row.get('sys_import_state') == 'pending':
+                row['sys_import_state'] = 'error'
+                row['sys_import_state_comment'] = (
+                    'not transformed within the time allowed')
+        return staged
+
+    def _change_result(self, result):
+        """
+        Returns the change number, url and sys_id from an import set
+        result.
+        """
+        if result.get('status') == 'error' or not result.get('sys_id'):
+            raise ServiceNowWorkerError(
+                'Change record was not created: %s' % result.get(
+                    'status_message', result.get('error_message', result)))
+        change_record = result['display_value']
+        change_url = result['record_link']
+        sys_id = result['sys_id']
+        self._cache_set('change_request', change_record, sys_id)
+
+        self.app_logger.info("Change record {CHG_NUM} created: {CHG_URL}".format(
+            CHG_NUM=change_record,
+            CHG_URL=change_url)
+        )
+        return (change_record, change_url, sys_id)
+
+    def _import_failed(self, response):
+        """
+        Raises a ServiceNowWorkerError for a failed import request.
+        """
+        if response.status_code == 403:
             self.app_logger.info("Service Now API account unauthorized to create change record")
             raise ServiceNowWorkerError(
                 "403 unauthorized response when creating change record: {ERR_MSG}".format(
                     ERR_MSG=response.text)
             )
 
-        else:
-            self.app_logger.info("Unexpected response [{CODE}] when creating change record {ERR_MSG}".format(
-                CODE=response.status_code,
-                ERR_MSG=response.text)
-            )
-            raise ServiceNowWorkerError("Unexpected response [{CODE}] when creating change record {ERR_MSG}".format(
-                CODE=response.status_code,
-                ERR_MSG=response.text)
-            )
+        self.app_logger.info("Unexpected response [{CODE}] when creating change record {ERR_MSG}".format(
+            CODE=response.status_code,
+            ERR_MSG=response.text)
+        )
+        raise ServiceNowWorkerError("Unexpected response [{CODE}] when creating change record {ERR_MSG}".format(
+            CODE=response.status_code,
+            ERR_MSG=response.text)
+        )
 
     def create_c_task(self, body, output):
         """
@@ -316,12 +2134,6 @@ class ServiceNowWorker(Worker):
             raise ServiceNowWorkerError(
                 'No change_record given for CTask creation.')
 
-        url = self._config['api_root_url'] + '/table/change_task'
-
-        auth = (
-            self._config['servicenow_user'],
-            self._config['servicenow_password']
-        )
         headers = {
             'content-type': 'application/json',
             'Accept': 'application/json'
@@ -334,16 +2146,16 @@ class ServiceNowWorker(Worker):
             payload['short_description'] = body['dynamic']['ctask_description']
         payload['description'] = payload['short_description']
 
-        response = requests.post(
-            url,
+        response = self._request(
+            'post', 'root', '/table/change_task',
             data=json.dumps(payload),
-            headers=headers,
-            auth=auth)
+            headers=headers)
 
         if response.status_code == 201:
             result = response.json()['result']
             ctask = result['number']
             change_url = result['change_request']['link']
+            self._cache_set('change_task', ctask, result.get('sys_id'))
             self.app_logger.info(
                 "CTask {CTASK} created for CHG {CHG_NUM}: {CHG_URL}".format(
                     CTASK=ctask,
@@ -372,12 +2184,19 @@ class ServiceNowWorker(Worker):
             )
 
     # Skip covering this, it mostly calls the date method (below)
-    def _do_change_template(self, config):  # pragma: no cover
+    def _do_change_template(self, config, overrides=None):  # pragma: no cover
         """Processes a change record payload template. Makes a fresh copy
 (object) from our config file, and then calculates and inserts dynamic
 data (like dates, etc)
 
 Returns a serialized dictionary representing the JSON payload for our POST """
+        return json.dumps(self._change_row(config, overrides))
+
+    def _change_row(self, config, overrides=None):
+        """
+        Returns the change record payload template with dates filled in
+        and overrides applied as a dict.
+        """
         # Get our base payload datastructure and make a copy for manipulating
         payload = config['change_record_payload'].copy()
 
@@ -386,7 +2205,9 @@ Returns a serialized dictionary representing the JSON payload for our POST """
             config['start_date_diff'],
             config['end_date_diff'])
         )
-        return json.dumps(payload)
+        if overrides:
+            payload.update(overrides)
+        return payload
 
     def _make_start_end_dates(self, start_date_diff, end_date_diff):
         """Calculate the correct start/end dates for the new change record."""
@@ -413,14 +2234,114 @@ Returns a serialized dictionary representing the JSON payload for our POST """
 
     def process(self, channel, basic_deliver, properties, body, output):
         """
-        Writes out output messages from the bus.
+        Writes out output messages from the bus. With lanes enabled the
+        message is handed to its lane and processed there.
 
         *Keys Requires*:
             * subcommand: the subcommand to execute.
         """
+        if self._lanes is None:
+            self._run(channel, basic_deliver, properties, body, output)
+            return
+        lane = self._lane_for(body)
+        with self._flight_lock:
+            self._lane_pending += 1
+        # Output may publish on the bus, which only the ioloop may do
+        output = IoloopOutput(output, self._on_ioloop)
+        lane.submit(
+            self._run_in_lane, lane, channel, basic_deliver, properties,
+            body, output)
+
+    def _run_in_lane(self, lane, channel, basic_deliver, properties, body,
+                     output):
+        """
+        Runs a message on a lane thread. Reads do not take limiter slots
+        so they never wait behind writes.
+        """
+        try:
+            self._run(
+                channel, basic_deliver, properties, body, output,
+                limited=lane is not self._lanes['read'])
+        except Exception, ex:
+            self.app_logger.error(
+                'Unhandled error processing %s: %s' % (
+                    properties.correlation_id, ex))
+        finally:
+            with self._flight_lock:
+                self._lane_pending -= 1
+            self._maybe_finish_drain()
+
+    def _run(self, channel, basic_deliver, properties, body, output,
+             limited=True):
+        """
+        Processes a message, profiling it if it is the Nth. Holds a
+        limiter slot meanwhile if limited is set.
+        """
+        profiler = None
+        with self._flight_lock:
+            self._process_count += 1
+            count = self._process_count
+        if (self._profile_dir and self._profile_every and
+                count % self._profile_every == 0):
+            profiler = cProfile.Profile()
+            profiler.enable()
+        limiter = self._limiter
+        limited = limited and limiter is not None
+        if limited:
+            waited = time.time()
+            limiter.acquire()
+            self.metrics.timing('concurrency.wait', time.time() - waited)
+        try:
+            self._handle_message(
+                channel, basic_deliver, properties, body, output)
+        finally:
+            if limited:
+                limiter.release()
+            self._thread_messages.pop(threading.current_thread().ident, None)
+            if profiler is not None:
+                profiler.disable()
+                path = self._profile_path(
+                    count,
+                    body.get('parameters', {}).get('subcommand', 'unknown'),
+                    properties.correlation_id) + '.pstats'
+                try:
+                    profiler.dump_stats(path)
+                    self.metrics.incr('profiles.written')
+                except (IOError, OSError), ex:
+                    self.app_logger.warn('Unable to write profile: %s' % ex)
+            self._on_ioloop(self.stop_sampling)
+
+    def _handle_message(self, channel, basic_deliver, properties, body,
+                        output):
+        """
+        Does the work of process.
+        """
+        if self._draining:
+            # Hand messages which arrive while draining back to the
+            # broker so another worker can take them
+            self._on_ioloop(
+                channel.basic_reject,
+                delivery_tag=basic_deliver.delivery_tag, requeue=True)
+            return
+
         # Ack the original message
         self.ack(basic_deliver)
         corr_id = str(properties.correlation_id)
+        started = time.time()
+        self.metrics.incr('messages')
+        self._local.corr_id = corr_id
+        self._local.in_message = True
+        if self._capture is not None:
+            self._capture.message(corr_id, body)
+        with self._flight_lock:
+            self._in_flight += 1
+
+        buffering = self._config.get('buffered_output', {})
+        if buffering.get('enabled', False):
+            output = BufferedOutput(
+                output,
+                max_lines=buffering.get('max_lines', 20),
+                max_age=buffering.get('max_age', 2.0))
 
         self.send(
             properties.reply_to,
@@ -447,6 +2368,11 @@ Returns a serialized dictionary representing the JSON payload for our POST """
                 raise ServiceNowWorkerError(
                     'No valid subcommand given. Nothing to do!')
 
+            self.metrics.incr('subcommand.%s' % subcommand)
+            self._thread_messages[threading.current_thread().ident] = (
+                subcommand, corr_id)
+            self._local.deadline = self._make_deadline(body)
+
             if subcommand == 'DoesChangeRecordExist':
                 self.app_logger.info(
                     'Executing subcommand %s for correlation_id %s' % (
@@ -466,7 +2392,7 @@ Returns a serialized dictionary representing the JSON payload for our POST """
                 self.app_logger.info(
                     'Executing subcommand %s for correlation_id %s' % (
                         subcommand, corr_id))
-                result = self.create_change_record(self._config, output)
+                result = self.create_change_records(body, output)
             elif subcommand == 'CreateCTask':
                 self.app_logger.info(
                     'Executing subcommand %s for correlation_id %s' % (
@@ -477,6 +2403,23 @@ Returns a serialized dictionary representing the JSON payload for our POST """
                     'Executing subcommand %s for correlation_id %s' % (
                         subcommand, corr_id))
                 result = self.does_c_task_exist(body, output)
+            elif subcommand == 'EnsureChangeAndCTask':
+                self.app_logger.info(
+                    'Executing subcommand %s for correlation_id %s' % (
+                        subcommand, corr_id))
+                result = self.ensure_change_and_c_task(body, output)
+            elif subcommand in ('QueryChangeRecords', 'QueryChangeTasks'):
+                self.app_logger.info(
+                    'Executing subcommand %s for correlation_id %s' % (
+                        subcommand, corr_id))
+                if subcommand == 'QueryChangeRecords':
+                    table = 'change_request'
+                else:
+                    table = 'change_task'
+                result = self.query_records(
+                    body, output, table,
+                    lambda chunk: self.send(
+                        properties.reply_to, corr_id, chunk, exchange=''))
             else:
                 self.app_logger.warn(
                     'Could not the implementation of subcommand %s' % (
@@ -507,6 +2450,7 @@ Returns a serialized dictionary representing the JSON payload for our POST """
 
         except ServiceNowWorkerError, fwe:
             # If a ServiceNowWorkerError happens send a failure log it.
+            self.metrics.incr('failures')
             self.app_logger.error('Failure: %s' % fwe)
             self.send(
                 properties.reply_to,
@@ -520,6 +2464,17 @@ Returns a serialized dictionary representing the JSON payload for our POST """
                 'failed',
                 corr_id)
             output.error(str(fwe))
+        finally:
+            self._local.deadline = None
+            self._local.in_message = False
+            if isinstance(output, BufferedOutput):
+                output.flush()
+            self.metrics.timing('process', time.time() - started)
+            self._dump_metrics()
+            with self._flight_lock:
+                self._in_flight -= 1
+            self._on_ioloop(self._apply_prefetch)
+            self._maybe_finish_drain()
 
 
 def main():  # pragma: no cover
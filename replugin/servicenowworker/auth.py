@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Authentication which reuses a ServiceNow session or OAuth token rather
+than sending Basic auth on every call.
+"""
+import threading
+import time
+
+import requests
+
+from urlparse import urlsplit
+
+from requests.auth import AuthBase, HTTPBasicAuth
+
+
+class _ReusingAuth(AuthBase):
+    """
+    Base for auth which sends a reusable credential when it has a fresh
+    one and Basic auth otherwise. A 401 for a reused credential drops
+    it and the request is sent again once with Basic auth.
+    """
+
+    def __init__(self, user, password, refresh_margin=60):
+        """
+        *Parameters*:
+            * user: The ServiceNow user.
+            * password: The ServiceNow password.
+            * refresh_margin: Seconds before expiry a credential is
+              replaced.
+        """
+        self._basic = HTTPBasicAuth(user, password)
+        self.refresh_margin = float(refresh_margin)
+        self._lock = threading.Lock()
+        #: Requests sent again with Basic auth after a 401
+        self.fallbacks = 0
+        #: Times a new credential was obtained
+        self.refreshes = 0
+
+    def _apply(self, request):
+        """
+        Adds the reusable credential to request. Returns False if there
+        is none and Basic auth should be used.
+        """
+        raise NotImplementedError()
+
+    def _invalidate(self, request):
+        """
+        Forgets the reusable credential sent with request.
+        """
+        raise NotImplementedError()
+
+    def _learn(self, response):
+        """
+        Picks up a credential from a response sent with Basic auth.
+        """
+        pass
+
+    def __call__(self, request):
+        if not self._apply(request):
+            self._basic(request)
+        request.register_hook('response', self._on_response)
+        return request
+
+    @staticmethod
+    def _used_basic(request):
+        return request.headers.get('Authorization', '').startswith('Basic ')
+
+    def _on_response(self, response, **kwargs):
+        if not self._used_basic(response.request):
+            if response.status_code != 401:
+                return response
+            self._invalidate(response.request)
+            with self._lock:
+                self.fallbacks += 1
+            response = self._resend_basic(response, **kwargs)
+        if response.ok:
+            self._learn(response)
+        return response
+
+    def _resend_basic(self, response, **kwargs):
+        """
+        Sends the request of response again with Basic auth only.
+        """
+        # Let the connection go back to the pool first
+        response.content
+        response.close()
+        request = response.request.copy()
+        request.headers.pop('Cookie', None)
+        request.headers.pop('Authorization', None)
+        self._basic(request)
+        retried = response.connection.send(request, **kwargs)
+        retried.history.append(response)
+        retried.request = request
+        return retried
+
+
+class SessionCookieAuth(_ReusingAuth):
+    """
+    Uses Basic auth until ServiceNow hands back a session, then sends
+    its cookies (JSESSIONID, glide_user_route, ...) instead so the
+    instance does not authenticate and create a session for every call.
+    The session is replaced refresh_margin seconds before lifetime runs
+    out. Sessions are kept per host, as each node or instance behind the
+    endpoints has its own.
+    """
+
+    def __init__(self, user, password, lifetime=1500, refresh_margin=60):
+        """
+        Creates a SessionCookieAuth.
+
+        *Parameters*:
+            * user: The ServiceNow user.
+            * password: The ServiceNow password.
+            * lifetime: Seconds a session is trusted for. Keep it below
+              the instance's session timeout.
+            * refresh_margin: Seconds before lifetime runs out that a
+              new session is started.
+        """
+        _ReusingAuth.__init__(self, user, password, refresh_margin)
+        self.lifetime = float(lifetime)
+        #: host -> (cookies, expiry time)
+        self._sessions = {}
+
+    def _apply(self, request):
+        with self._lock:
+            cookies, expires = self._sessions.get(
+                urlsplit(request.url).netloc, (None, 0))
+            if not cookies or (
+                    time.time() >= expires - self.refresh_margin):
+                return False
+            request.headers['Cookie'] = '; '.join(
+                '%s=%s' % item for item in sorted(cookies.items()))
+        return True
+
+    def _invalidate(self, request):
+        with self._lock:
+            self._sessions.pop(urlsplit(request.url).netloc, None)
+
+    def _learn(self, response):
+        cookies = response.cookies.get_dict()
+        if 'JSESSIONID' not in cookies:
+            return
+        with self._lock:
+            self._sessions[urlsplit(response.request.url).netloc] = (
+                cookies, time.time() + self.lifetime)
+            self.refreshes += 1
+
+
+class OAuthTokenAuth(_ReusingAuth):
+    """
+    Sends an OAuth bearer token from the instance's token endpoint. The
+    token is refreshed refresh_margin seconds before it expires, with
+    the refresh token when there is one. Basic auth is used while no
+    token can be had.
+    """
+
+    def __init__(self, user, password, client_id, client_secret, token_url,
+                 post=None, timeout=(5, 30), refresh_margin=60,
+                 retry_after=60):
+        """
+        Creates an OAuthTokenAuth.
+
+        *Parameters*:
+            * user: The ServiceNow user.
+            * password: The ServiceNow password.
+            * client_id: The OAuth client id.
+            * client_secret: The OAuth client secret.
+            * token_url: The instance's oauth_token.do url.
+            * post: Callable used to request tokens, requests.post by
+              default.
+            * timeout: Timeout for token requests.
+            * refresh_margin: Seconds before expiry a token is refreshed.
+            * retry_after: Seconds to use Basic auth for after no token
+              could be had.
+        """
+        _ReusingAuth.__init__(self, user, password, refresh_margin)
+        self._user = user
+        self._password = password
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.token_url = token_url
+        self._post = post or requests.post
+        self.timeout = timeout
+        self._token = None
+        self._refresh_token = None
+        self._expires = 0
+        self.retry_after = float(retry_after)
+        self._retry_at = 0
+
+    def _fetch(self):
+        """
+        Gets a new token, by refresh token if possible. Must be called
+        with the lock held. Returns False if no token could be had.
+        """
+        data = {
+            'client_id': self.client_id,
+            'client_secret': self.client_secret,
+        }
+        grants = []
+        if self._refresh_token:
+            grants.append({
+                'grant_type': 'refresh_token',
+                'refresh_token': self._refresh_token})
+        grants.append({
+            'grant_type': 'password',
+            'username': self._user,
+            'password': self._password})
+        for grant in grants:
+            grant.update(data)
+            try:
+                response = self._post(
+                    self.token_url, data=grant, timeout=self.timeout,
+                    headers={'Accept': 'application/json'})
+                if response.status_code != 200:
+                    continue
+                token = response.json()
+            except (requests.exceptions.RequestException, ValueError):
+                continue
+            if not token.get('access_token'):
+                continue
+            self._token = token['access_token']
+            self._refresh_token = token.get(
+                'refresh_token', self._refresh_token)
+            self._expires = time.time() + float(token.get('expires_in', 1800))
+            self.refreshes += 1
+            return True
+        self._token = self._refresh_token = None
+        self._retry_at = time.time() + self.retry_after
+        return False
+
+    def _apply(self, request):
+        with self._lock:
+            if self._token is None or (
+                    time.time() >= self._expires - self.refresh_margin):
+                if time.time() < self._retry_at or not self._fetch():
+                    return False
+            request.headers['Authorization'] = 'Bearer %s' % self._token
+        return True
+
+    def _invalidate(self, request):
+        with self._lock:
+            self._token = None
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Batching of items submitted by concurrent callers.
+"""
+import sys
+import threading
+
+
+class _Batch(object):
+
+    def __init__(self):
+        self.items = []
+        self.results = None
+        self.error = None
+        #: Set once the batch should be sent without waiting longer
+        self.full = threading.Event()
+        #: Set once results or error are in
+        self.done = threading.Event()
+
+
+class Batcher(object):
+    """
+    Collects items submitted from several threads and sends them
+    together. The first caller into an empty batch waits up to max_wait
+    seconds for others to join, then sends the batch on its own thread.
+    It only waits while other callers are submitting, a lone caller is
+    sent right away. A batch is sent as soon as it holds max_items.
+    """
+
+    def __init__(self, send, max_items=50, max_wait=0.05):
+        """
+        Creates a Batcher.
+
+        *Parameters*:
+            * send: Callable taking a list of items and returning a list
+              with a result for each, in the same order. An exception in
+              the list is raised to the caller of that item only.
+            * max_items: Most items to send at once.
+            * max_wait: Seconds the first caller waits for more items.
+        """
+        self._send = send
+        self.max_items = int(max_items)
+        self.max_wait = float(max_wait)
+        self._lock = threading.Lock()
+        self._batch = None
+        self._callers = 0
+        #: Batches sent
+        self.batches = 0
+        #: Items sent
+        self.items = 0
+
+    def submit(self, item):
+        """
+        Adds item to the next batch and returns its result once sent.
+
+        *Parameters*:
+            * item: The item to send.
+        """
+        with self._lock:
+            self._callers += 1
+            batch = self._batch
+            leader = batch is None
+            if leader:
+                batch = self._batch = _Batch()
+            index = len(batch.items)
+            batch.items.append(item)
+            # Others submitting, including ones waiting on a batch in
+            # flight, are likely to be followed by more
+            alone = self._callers == 1
+            if alone or len(batch.items) >= self.max_items:
+                # Nobody else may join, the leader sends it right away
+                self._batch = None
+                batch.full.set()
+
+        try:
+            if leader:
+                batch.full.wait(self.max_wait)
+                with self._lock:
+                    if self._batch is batch:
+                        self._batch = None
+                self._flush(batch)
+            else:
+                batch.done.wait()
+        finally:
+            with self._lock:
+                self._callers -= 1
+
+        if batch.error is not None:
+            raise batch.error[0], batch.error[1], batch.error[2]
+        result = batch.results[index]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def send_all(self, items):
+        """
+        Sends items in chunks of max_items without waiting for other
+        callers. Returns the results in order, an exception in the list
+        stands for an item which failed.
+
+        *Parameters*:
+            * items: The items to send.
+        """
+        results = []
+        for start in range(0, len(items), self.max_items):
+            chunk = items[start:start + self.max_items]
+            results.extend(self._call(chunk))
+        return results
+
+    def _call(self, items):
+        results = list(self._send(items))
+        if len(results) != len(items):
+            raise ValueError(
+                'Got %s results for %s items' % (len(results), len(items)))
+        with self._lock:
+            self.batches += 1
+            self.items += len(items)
+        return results
+
+    def _flush(self, batch):
+        try:
+            batch.results = self._call(batch.items)
+        except Exception:
+            batch.error = sys.exc_info()
+        finally:
+            batch.done.set()
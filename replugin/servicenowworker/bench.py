@@ -0,0 +1,439 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Microbenchmarks for the worker's own CPU and memory cost per message.
+ServiceNow is replaced by an in-memory transport so network latency
+does not hide the time spent building urls, parsing responses and
+dispatching.
+
+Allocations per message are counted with the gc module, which works on
+any interpreter: the objects alive when a message returns, which
+includes the reference cycles it left for the collector, and the
+objects still alive after a collection. Only container objects are
+tracked by gc, and temporaries freed by reference counting are not
+seen. Bytes per message
+are measured with tracemalloc as well when it is available. Python 2.7,
+which the worker runs on, only has it when built with the pytracemalloc
+patch, so on a stock interpreter the byte columns read n/a.
+
+Run with: python -m replugin.servicenowworker.bench --help
+"""
+import gc
+import json
+import logging
+import timeit
+
+import requests
+
+from replugin.servicenowworker.profiling import StackSampler
+from replugin.servicenowworker.replay import ReplayWorker
+
+try:
+    import tracemalloc
+except ImportError:  # pragma: no cover
+    # Python 2 only has it when built with the pytracemalloc patch
+    tracemalloc = None
+
+SYS_ID = '9d385017c611228701d22104cc95c371'
+
+#: Default routes for FakeTransport: (method, url fragment, status, json)
+ROUTES = (
+    ('get', '/stats/', 200, {'result': {'stats': {'count': '1'}}}),
+    ('get', 'sysparm_offset=', 200, {'result': [
+        {'number': 'CHG%07d' % i, 'sys_id': SYS_ID, 'state': '1',
+         'short_description': 'Benchmark change %s' % i}
+        for i in range(50)]}),
+    ('get', '/table/change_request', 200, {'result': [
+        {'number': 'CHG0000001', 'sys_id': SYS_ID}]}),
+    ('get', '/table/change_task', 200, {'result': [
+        {'number': 'CTASK0000001', 'sys_id': SYS_ID}]}),
+    ('put', '/table/change_request/', 200, {'result': {'sys_id': SYS_ID}}),
+    ('post', '/table/change_task', 201, {'result': {
+        'number': 'CTASK0000002', 'sys_id': SYS_ID,
+        'change_request': {
+            'link': 'https://bench/api/now/table/change_request/' + SYS_ID,
+            'value': SYS_ID}}}),
+    ('post', '/import', 201, {'result': [{
+        'display_value': 'CHG0000002', 'sys_id': SYS_ID,
+        'record_link': 'https://bench/api/now/table/change_request/' + SYS_ID,
+        'status': 'inserted', 'table': 'change_request'}]}),
+)
+
+#: Worker config used for the benchmarks
+CONFIG = {
+    'api_root_url': 'https://bench/api/now/v1',
+    'api_import_url': 'https://bench/api/now/import',
+    'servicenow_user': 'bench',
+    'servicenow_password': 'bench',
+    'start_date_diff': {'days': 1},
+    'end_date_diff': {'days': 2},
+    'change_record_payload': {
+        'u_short_description': 'Benchmark change',
+        'u_category': 'Software',
+    },
+    'c_task_payload': {
+        'short_description': 'Benchmark ctask',
+        'u_task_type': 'Implementation',
+    },
+}
+
+#: Message bodies benchmarked through process, by subcommand
+MESSAGES = {
+    'DoesChangeRecordExist': {'dynamic': {'change_record': 'CHG0000001'}},
+    'DoesCTaskExist': {'dynamic': {
+        'change_record': 'CHG0000001', 'ctask': 'CTASK0000001'}},
+    'UpdateStartTime': {'dynamic': {
+        'change_record': 'CHG0000001', 'environment': 'qa'}},
+    'UpdateEndTime': {'dynamic': {
+        'change_record': 'CHG0000001', 'environment': 'qa'}},
+    'CreateChangeRecord': {'dynamic': {}},
+    'CreateCTask': {'dynamic': {'change_record': 'CHG0000001'}},
+    'EnsureChangeAndCTask': {'dynamic': {
+        'change_record': 'CHG0000001', 'ctask': 'CTASK0000001',
+        'environment': 'qa'}},
+    'QueryChangeRecords': {'dynamic': {'query': 'active=true'}},
+    'QueryChangeTasks': {'dynamic': {'query': 'active=true'}},
+}
+
+
+class FakeTransport(object):
+    """
+    Stands in for the requests module. Answers from a list of routes
+    with responses built from pre-serialized bodies, so parsing them is
+    still measured but producing them is not.
+    """
+
+    def __init__(self, routes=ROUTES):
+        """
+        Creates a FakeTransport.
+
+        *Parameters*:
+            * routes: Iterable of (method, url fragment, status, json).
+              The first route whose method matches and whose fragment
+              is in the url answers.
+        """
+        self.routes = [
+            (method, fragment, status, json.dumps(payload))
+            for method, fragment, status, payload in routes]
+        self.calls = 0
+
+    def request(self, method, url, **kwargs):
+        """
+        Returns a requests.Response for the first matching route or a
+        404 if none match.
+        """
+        self.calls += 1
+        response = requests.Response()
+        response.url = url
+        response.encoding = 'utf-8'
+        response.headers['Content-Type'] = 'application/json'
+        for route_method, fragment, status, content in self.routes:
+            if route_method == method and fragment in url:
+                response.status_code = status
+                response._content = content
+                return response
+        response.status_code = 404
+        response._content = ''
+        return response
+
+    def get(self, url, **kwargs):
+        return self.request('get', url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request('put', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('post', url, **kwargs)
+
+    def head(self, url, **kwargs):
+        return self.request('head', url, **kwargs)
+
+
+class BenchWorker(ReplayWorker):
+    """
+    A ReplayWorker which drops its replies so they do not pile up
+    between iterations.
+    """
+
+    def send(self, topic, corr_id, message_struct, exchange=''):
+        pass
+
+
+class _NullOutput(object):
+
+    def debug(self, *args, **kwargs):
+        pass
+
+    info = warn = error = debug
+
+
+class _Deliver(object):
+    delivery_tag = None
+
+
+class _Properties(object):
+    correlation_id = 'bench'
+    reply_to = 'bench'
+
+
+def make_worker(config=None, transport=None):
+    """
+    Returns a BenchWorker answered by a FakeTransport.
+
+    *Parameters*:
+        * config: Worker config, defaults to CONFIG.
+        * transport: Transport to use, defaults to a new FakeTransport.
+    """
+    logger = logging.getLogger('bench')
+    logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+    worker = BenchWorker(dict(config or CONFIG), logger=logger)
+    worker._transport = transport or FakeTransport()
+    return worker
+
+
+def cases(worker):
+    """
+    Returns (name, callable) pairs covering each subcommand plus the
+    helpers which do not go through process on their own.
+
+    *Parameters*:
+        * worker: The worker to benchmark.
+    """
+    output = _NullOutput()
+    deliver = _Deliver()
+    properties = _Properties()
+    result = []
+    for subcommand in sorted(MESSAGES):
+        body = dict(MESSAGES[subcommand])
+        body['parameters'] = {'subcommand': subcommand}
+
+        def run(body=body):
+            # process may write into dynamic so hand it a fresh copy
+            message = dict(body, dynamic=dict(body['dynamic']))
+            worker.process(None, deliver, properties, message, output)
+        result.append((subcommand, run))
+
+    config = worker._config
+    result.extend([
+        ('create_change_record',
+         lambda: worker.create_change_record(config)),
+        ('_do_change_template',
+         lambda: worker._do_change_template(config)),
+        ('_make_start_end_dates',
+         lambda: worker._make_start_end_dates(
+             config['start_date_diff'], config['end_date_diff'])),
+    ])
+    return result
+
+
+def measure(func, iterations, samples=50):
+    """
+    Times func, counts the gc tracked objects it allocates and, when
+    tracemalloc is available, measures the memory it allocates. Returns
+    a dict of per call figures.
+
+    *Parameters*:
+        * func: The callable to measure.
+        * iterations: Number of timed calls.
+        * samples: Number of calls measured for allocations.
+    """
+    for _ in xrange(min(iterations, 100)):
+        func()
+    gc.collect()
+    timer = timeit.default_timer
+    start = timer()
+    for _ in xrange(iterations):
+        func()
+    elapsed = timer() - start
+
+    result = {
+        'iterations': iterations,
+        'ns_per_call': elapsed * 1e9 / iterations,
+        'objects_per_call': None,
+        'retained_objects_per_call': None,
+        'peak_bytes_per_call': None,
+        'retained_bytes_per_call': None,
+    }
+    if not samples:
+        return result
+
+    result.update(count_objects(func, samples))
+    if tracemalloc is None:
+        return result
+
+    peak_total = retained_total = 0
+    tracemalloc.start()
+    try:
+        for _ in xrange(samples):
+            tracemalloc.clear_traces()
+            before = tracemalloc.get_traced_memory()[0]
+            func()
+            current, peak = tracemalloc.get_traced_memory()
+            peak_total += peak - before
+            retained_total += current - before
+    finally:
+        tracemalloc.stop()
+    result['peak_bytes_per_call'] = peak_total / samples
+    result['retained_bytes_per_call'] = retained_total / samples
+    return result
+
+
+def count_objects(func, samples):
+    """
+    Counts the gc tracked objects func allocates per call, comparing
+    len(gc.get_objects()) around each call with collection paused. The
+    objects alive when the call returns are the ones it retains plus the
+    reference cycles it left for the collector, and a collection then
+    leaves only the retained ones. gc.get_count() is no help here as
+    objects reused from the dict and list free lists do not move it.
+
+    *Parameters*:
+        * func: The callable to measure.
+        * samples: Number of calls measured.
+    """
+    def run(func):
+        left_total = retained_total = 0
+        # The first round fills caches and is left out
+        for sample in xrange(samples + 1):
+            gc.collect()
+            objects = len(gc.get_objects())
+            func()
+            left = len(gc.get_objects()) - objects
+            gc.collect()
+            if sample:
+                left_total += left
+                retained_total += len(gc.get_objects()) - objects
+        return left_total, retained_total
+
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        left, retained = run(func)
+        # Whatever the counting itself allocates
+        left_base, retained_base = run(lambda: None)
+    finally:
+        if enabled:
+            gc.enable()
+    return {
+        'objects_per_call': float(left - left_base) / samples,
+        'retained_objects_per_call': float(retained - retained_base) / samples,
+    }
+
+
+def run_benchmarks(worker, iterations=2000, names=None, samples=50):
+    """
+    Runs the benchmark cases and returns a list of result dicts.
+
+    *Parameters*:
+        * worker: The worker to benchmark.
+        * iterations: Timed calls per case.
+        * names: Only run cases with these names.
+        * samples: Calls per case measured for allocations.
+    """
+    results = []
+    for name, func in cases(worker):
+        if names and name not in names:
+            continue
+        result = measure(func, iterations, samples)
+        result['name'] = name
+        results.append(result)
+    return results
+
+
+def format_results(results):
+    """
+    Returns the results as a text table.
+    """
+    def number(value):
+        if value is None:
+            return 'n/a'
+        return '%.0f' % value
+
+    lines = ['%-24s %12s %10s %12s %14s %14s' % (
+        'case', 'ns/msg', 'objs/msg', 'kept objs/msg', 'peak B/msg',
+        'retained B/msg')]
+    for result in results:
+        lines.append('%-24s %12s %10s %12s %14s %14s' % (
+            result['name'],
+            number(result['ns_per_call']),
+            number(result['objects_per_call']),
+            number(result['retained_objects_per_call']),
+            number(result['peak_bytes_per_call']),
+            number(result['retained_bytes_per_call'])))
+    lines.append('(objects are the gc tracked ones alive after a message '
+                 'and after a collection)')
+    if tracemalloc is None:
+        lines.append(
+            '(tracemalloc is not available, bytes not measured; '
+            'stock Python 2.7 does not include it)')
+    return '\n'.join(lines)
+
+
+def main():  # pragma: no cover
+    """
+    Runs the benchmarks from the command line.
+    """
+    import argparse
+    import cProfile
+
+    parser = argparse.ArgumentParser(
+        description='Benchmark per message CPU and memory cost.')
+    parser.add_argument(
+        '--iterations', type=int, default=2000,
+        help='Timed calls per case (default: 2000)')
+    parser.add_argument(
+        '--only', action='append', default=None, metavar='CASE',
+        help='Only run this case, may be repeated')
+    parser.add_argument(
+        '--profile', metavar='PATH',
+        help='Write cProfile stats for the run to PATH')
+    parser.add_argument(
+        '--folded', metavar='PATH',
+        help='Write sampled stacks for flamegraph.pl to PATH')
+    parser.add_argument(
+        '--json', action='store_true', help='Print results as JSON')
+    args = parser.parse_args()
+
+    worker = make_worker()
+    profiler = sampler = None
+    if args.profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    if args.folded:
+        sampler = StackSampler(interval=0.001)
+        sampler.start()
+    try:
+        # Tracing allocations would skew the profiles
+        results = run_benchmarks(
+            worker, args.iterations, args.only,
+            samples=0 if (profiler or sampler) else 50)
+    finally:
+        if sampler:
+            sampler.stop()
+            sampler.write(args.folded)
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+
+    if args.json:
+        print json.dumps(results, indent=4)
+    else:
+        print format_results(results)
+
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
@@ -0,0 +1,596 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Number to sys_id caches. A cached number is a record known to exist.
+"""
+import binascii
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+from collections import OrderedDict
+
+
+class CacheBackend(object):
+    """
+    Interface of the sys_id caches. Maps record numbers to sys_ids per
+    table and keeps bookkeeping values such as sync watermarks.
+    """
+
+    def get(self, table, number):
+        """
+        Returns the cached sys_id for a record number or None.
+
+        *Parameters*:
+            * table: The ServiceNow table name.
+            * number: The record number.
+        """
+        raise NotImplementedError()
+
+    def get_many(self, keys):
+        """
+        Returns a dict of sys_ids by (table, number) for the keys which
+        are cached.
+
+        *Parameters*:
+            * keys: Iterable of (table, number) tuples.
+        """
+        result = {}
+        for table, number in keys:
+            sys_id = self.get(table, number)
+            if sys_id is not None:
+                result[(table, number)] = sys_id
+        return result
+
+    def set(self, table, number, sys_id):
+        """
+        Stores the sys_id for a record number.
+
+        *Parameters*:
+            * table: The ServiceNow table name.
+            * number: The record number.
+            * sys_id: The 32 character sys_id.
+        """
+        self.set_many(table, [(number, sys_id)])
+
+    def set_many(self, table, pairs):
+        """
+        Stores a list of (number, sys_id) pairs.
+
+        *Parameters*:
+            * table: The ServiceNow table name.
+            * pairs: Iterable of (number, sys_id) tuples.
+        """
+        raise NotImplementedError()
+
+    def delete(self, table, number):
+        """
+        Removes a record number from the cache.
+
+        *Parameters*:
+            * table: The ServiceNow table name.
+            * number: The record number.
+        """
+        raise NotImplementedError()
+
+    def get_meta(self, key):
+        """
+        Returns a stored bookkeeping value or None.
+
+        *Parameters*:
+            * key: The name of the value.
+        """
+        raise NotImplementedError()
+
+    def set_meta(self, key, value):
+        """
+        Stores a bookkeeping value.
+
+        *Parameters*:
+            * key: The name of the value.
+            * value: The string to store.
+        """
+        raise NotImplementedError()
+
+    def prune(self):
+        """
+        Drops entries past the cache's size limit.
+        """
+        pass
+
+
+class SysIdCache(CacheBackend):
+    """
+    Maps record numbers to sys_ids in a sqlite file. The file uses WAL
+    journaling so worker processes on the same host can share it with
+    concurrent readers.
+    """
+
+    #: Tables which may be cached
+    tables = ('change_request', 'change_task')
+
+    def __init__(self, path, max_entries=50000, timeout=5.0):
+        """
+        Creates a SysIdCache.
+
+        *Parameters*:
+            * path: Path to the sqlite file. Created if missing.
+            * max_entries: Entries to keep before the oldest are pruned.
+            * timeout: Seconds to wait on a locked database.
+        """
+        self.path = path
+        self.max_entries = int(max_entries)
+        self.timeout = float(timeout)
+        self._local = threading.local()
+        self._writes = 0
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        conn = self._connection()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS sys_ids ('
+            'tbl INTEGER NOT NULL, '
+            'number TEXT NOT NULL, '
+            'sys_id BLOB NOT NULL, '
+            'updated REAL NOT NULL, '
+            'PRIMARY KEY (tbl, number))')
+        conn.execute(
+            'CREATE INDEX IF NOT EXISTS sys_ids_updated ON sys_ids (updated)')
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS meta ('
+            'key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+        conn.commit()
+
+    def _connection(self):
+        """
+        Returns a connection for the current thread and process.
+        """
+        pid = os.getpid()
+        if getattr(self._local, 'pid', None) != pid:
+            self._local.conn = sqlite3.connect(
+                self.path, timeout=self.timeout)
+            self._local.pid = pid
+        return self._local.conn
+
+    def _table(self, table):
+        """
+        Returns the compact id used to store a table name.
+        """
+        return self.tables.index(table)
+
+    @staticmethod
+    def _pack(sys_id):
+        """
+        Packs a hex sys_id into half as many bytes. Anything which is
+        not hex is stored as is.
+        """
+        try:
+            return sqlite3.Binary(binascii.unhexlify(sys_id))
+        except (TypeError, ValueError):
+            return sys_id
+
+    @staticmethod
+    def _unpack(value):
+        """
+        Reverses _pack.
+        """
+        if isinstance(value, buffer):
+            return binascii.hexlify(value)
+        return value
+
+    def get(self, table, number):
+        """
+        Returns the cached sys_id for a record number or None.
+
+        *Parameters*:
+            * table: The ServiceNow table name.
+            * number: The record number.
+        """
+        row = self._connection().execute(
+            'SELECT sys_id FROM sys_ids WHERE tbl = ? AND number = ?',
+            (self._table(table), number)).fetchone()
+        if row is None:
+            return None
+        return self._unpack(row[0])
+
+    def get_many(self, keys):
+        """
+        Returns a dict of sys_ids by (table, number) for the keys which
+        are cached, with one query per table.
+
+        *Parameters*:
+            * keys: Iterable of (table, number) tuples.
+        """
+        by_table = {}
+        for table, number in keys:
+            by_table.setdefault(table, []).append(number)
+        result = {}
+        conn = self._connection()
+        for table, numbers in by_table.items():
+            # Stay well below sqlite's limit on bound parameters
+            for start in range(0, len(numbers), 500):
+                chunk = numbers[start:start + 500]
+                rows = conn.execute(
+                    'SELECT number, sys_id FROM sys_ids WHERE tbl = ? '
+                    'AND number IN (%s)' % ', '.join('?' * len(chunk)),
+                    [self._table(table)] + chunk).fetchall()
+                for number, sys_id in rows:
+                    result[(table, number)] = self._unpack(sys_id)
+        return result
+
+    def set_many(self, table, pairs):
+        """
+        Stores a list of (number, sys_id) pairs in a single transaction.
+
+        *Parameters*:
+            * table: The ServiceNow table name.
+            * pairs: Iterable of (number, sys_id) tuples.
+        """
+        tbl = self._table(table)
+        now = time.time()
+        rows = [(tbl, number, self._pack(sys_id), now)
+                for number, sys_id in pairs]
+        if not rows:
+            return
+        conn = self._connection()
+        with conn:
+            conn.executemany(
+                'INSERT OR REPLACE INTO sys_ids VALUES (?, ?, ?, ?)', rows)
+        self._writes += len(rows)
+        # Only check the size now and then to keep writes cheap
+        if self._writes >= max(1, self.max_entries / 10):
+            self._writes = 0
+            self.prune()
+
+    def delete(self, table, number):
+        """
+        Removes a record number from the cache.
+
+        *Parameters*:
+            * table: The ServiceNow table name.
+            * number: The record number.
+        """
+        conn = self._connection()
+        with conn:
+            conn.execute(
+                'DELETE FROM sys_ids WHERE tbl = ? AND number = ?',
+                (self._table(table), number))
+
+    def get_meta(self, key):
+        """
+        Returns a stored bookkeeping value such as a sync watermark.
+
+        *Parameters*:
+            * key: The name of the value.
+        """
+        row = self._connection().execute(
+            'SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def set_meta(self, key, value):
+        """
+        Stores a bookkeeping value which survives restarts.
+
+        *Parameters*:
+            * key: The name of the value.
+            * value: The string to store.
+        """
+        conn = self._connection()
+        with conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO meta VALUES (?, ?)', (key, value))
+
+    def prune(self):
+        """
+        Drops the oldest entries once the cache grows past max_entries.
+        """
+        conn = self._connection()
+        with conn:
+            count = conn.execute('SELECT COUNT(*) FROM sys_ids').fetchone()[0]
+            excess = count - self.max_entries
+            if excess > 0:
+                conn.execute(
+                    'DELETE FROM sys_ids WHERE rowid IN ('
+                    'SELECT rowid FROM sys_ids ORDER BY updated LIMIT ?)',
+                    (excess,))
+
+
+class MemorySysIdCache(CacheBackend):
+    """
+    In process version of SysIdCache for workers without a cache file.
+    Evicts the least recently stored entry past max_entries.
+    """
+
+    def __init__(self, max_entries=50000):
+        """
+        Creates a MemorySysIdCache.
+
+        *Parameters*:
+            * max_entries: Entries to keep before the oldest are evicted.
+        """
+        self.max_entries = int(max_entries)
+        self._data = OrderedDict()
+        self._meta = {}
+        self._lock = threading.Lock()
+
+    def get(self, table, number):
+        """
+        Returns the cached sys_id for a record number or None.
+        """
+        return self._data.get((table, number))
+
+    def set_many(self, table, pairs):
+        """
+        Stores a list of (number, sys_id) pairs.
+        """
+        with self._lock:
+            for number, sys_id in pairs:
+                self._data.pop((table, number), None)
+                self._data[(table, number)] = sys_id
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete(self, table, number):
+        """
+        Removes a record number from the cache.
+        """
+        with self._lock:
+            self._data.pop((table, number), None)
+
+    def get_meta(self, key):
+        """
+        Returns a stored bookkeeping value such as a sync watermark.
+        """
+        return self._meta.get(key)
+
+    def set_meta(self, key, value):
+        """
+        Stores a bookkeeping value for the life of the process.
+        """
+        self._meta[key] = value
+
+    def prune(self):
+        """
+        Entries are evicted as they are stored so there is nothing to do.
+        """
+        pass
+
+
+class RedisError(Exception):
+    """
+    An error reply from Redis.
+    """
+    pass
+
+
+class RedisSysIdCache(CacheBackend):
+    """
+    Keeps sys_ids in Redis, or anything speaking its protocol, so every
+    worker in a fleet shares them. Entries expire after ttl seconds.
+    Lookups for several records are sent as one MGET and writes are
+    pipelined. While Redis cannot be reached the fallback cache is
+    used and Redis is tried again after retry_after seconds.
+    """
+
+    def __init__(self, host='127.0.0.1', port=6379, db=0, password=None,
+                 ttl=86400, prefix='servicenow:', timeout=0.5,
+                 retry_after=30, fallback=None):
+        """
+        Creates a RedisSysIdCache. Connections are opened on first use.
+
+        *Parameters*:
+            * host: The Redis host.
+            * port: The Redis port.
+            * db: The database to select.
+            * password: Password to AUTH with, if any.
+            * ttl: Seconds entries live for, None to keep them.
+            * prefix: Prefix for every key.
+            * timeout: Socket timeout in seconds.
+            * retry_after: Seconds to use the fallback for once Redis
+              could not be reached.
+            * fallback: A CacheBackend to use while Redis is down. Writes
+              go to it as well so it is warm when needed.
+        """
+        self.host = host
+        self.port = int(port)
+        self.db = int(db or 0)
+        self.password = password
+        self.ttl = int(ttl) if ttl else None
+        self.prefix = prefix
+        self.timeout = float(timeout)
+        self.retry_after = float(retry_after)
+        self.fallback = fallback
+        self._local = threading.local()
+        self._down_until = 0
+        #: Times Redis could not be reached
+        self.unavailable = 0
+
+    def _key(self, table, number):
+        return '%s%s:%s' % (self.prefix, table, number)
+
+    @staticmethod
+    def _encode(*args):
+        """
+        Returns a command in the Redis protocol.
+        """
+        parts = ['*%d\r\n' % len(args)]
+        for arg in args:
+            if isinstance(arg, unicode):
+                arg = arg.encode('utf-8')
+            else:
+                arg = str(arg)
+            parts.append('$%d\r\n%s\r\n' % (len(arg), arg))
+        return ''.join(parts)
+
+    def _read(self, reader):
+        """
+        Reads one reply. Error replies are returned as RedisError.
+        """
+        line = reader.readline()
+        if not line.endswith('\r\n'):
+            raise socket.error('Connection closed by Redis')
+        kind, rest = line[0], line[1:-2]
+        if kind == '+':
+            return rest
+        if kind == '-':
+            return RedisError(rest)
+        if kind == ':':
+            return int(rest)
+        if kind == '$':
+            length = int(rest)
+            if length < 0:
+                return None
+            data = reader.read(length + 2)
+            if len(data) != length + 2:
+                raise socket.error('Connection closed by Redis')
+            return data[:-2]
+        if kind == '*':
+            count = int(rest)
+            if count < 0:
+                return None
+            return [self._read(reader) for _ in range(count)]
+        raise socket.error('Unexpected reply from Redis: %r' % line)
+
+    def _connection(self):
+        """
+        Returns the socket and reader for the current thread and process.
+        """
+        pid = os.getpid()
+        if getattr(self._local, 'pid', None) != pid or (
+                self._local.sock is None):
+            sock = socket.create_connection(
+                (self.host, self.port), self.timeout)
+            sock.settimeout(self.timeout)
+            self._local.sock = sock
+            self._local.reader = sock.makefile('rb')
+            self._local.pid = pid
+            setup = []
+            if self.password:
+                setup.append(('AUTH', self.password))
+            if self.db:
+                setup.append(('SELECT', self.db))
+            if setup:
+                self._send(setup)
+        return self._local.sock, self._local.reader
+
+    def _close(self):
+        sock = getattr(self._local, 'sock', None)
+        self._local.sock = None
+        if sock is not None:
+            try:
+                self._local.reader.close()
+                sock.close()
+            except socket.error:
+                pass
+
+    def _send(self, commands):
+        """
+        Sends commands in one write and reads their replies.
+        """
+        sock, reader = self._connection()
+        sock.sendall(''.join(self._encode(*command) for command in commands))
+        replies = [self._read(reader) for _ in commands]
+        for reply in replies:
+            if isinstance(reply, RedisError):
+                raise reply
+        return replies
+
+    def _pipeline(self, commands):
+        """
+        Returns the replies to commands, or None if Redis is down.
+        """
+        if time.time() < self._down_until:
+            return None
+        try:
+            return self._send(commands)
+        except (socket.error, RedisError):
+            self._close()
+            self._down_until = time.time() + self.retry_after
+            self.unavailable += 1
+            return None
+
+    def get(self, table, number):
+        """
+        Returns the cached sys_id for a record number or None.
+        """
+        return self.get_many([(table, number)]).get((table, number))
+
+    def get_many(self, keys):
+        """
+        Returns a dict of sys_ids by (table, number) for the keys which
+        are cached, fetched with a single MGET.
+        """
+        keys = list(keys)
+        if not keys:
+            return {}
+        replies = self._pipeline([
+            ['MGET'] + [self._key(table, number) for table, number in keys]])
+        if replies is None:
+            if self.fallback is None:
+                return {}
+            return self.fallback.get_many(keys)
+        return dict(
+            (key, value) for key, value in zip(keys, replies[0])
+            if value is not None)
+
+    def set_many(self, table, pairs):
+        """
+        Stores a list of (number, sys_id) pairs with one round trip.
+        """
+        pairs = list(pairs)
+        if not pairs:
+            return
+        if self.fallback is not None:
+            self.fallback.set_many(table, pairs)
+        commands = []
+        for number, sys_id in pairs:
+            command = ['SET', self._key(table, number), sys_id]
+            if self.ttl:
+                command.extend(['EX', self.ttl])
+            commands.append(command)
+        self._pipeline(commands)
+
+    def delete(self, table, number):
+        """
+        Removes a record number from the cache.
+        """
+        if self.fallback is not None:
+            self.fallback.delete(table, number)
+        self._pipeline([('DEL', self._key(table, number))])
+
+    def get_meta(self, key):
+        """
+        Returns a stored bookkeeping value such as a sync watermark.
+        """
+        replies = self._pipeline([('GET', self.prefix + 'meta:' + key)])
+        if replies is None:
+            if self.fallback is None:
+                return None
+            return self.fallback.get_meta(key)
+        return replies[0]
+
+    def set_meta(self, key, value):
+        """
+        Stores a bookkeeping value, without a ttl.
+        """
+        if self.fallback is not None:
+            self.fallback.set_meta(key, value)
+        self._pipeline([('SET', self.prefix + 'meta:' + key, value)])
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Capture of messages and ServiceNow traffic for later replay.
+"""
+import json
+import threading
+import time
+
+from urllib import urlencode
+from urlparse import parse_qsl, urlsplit, urlunsplit
+
+#: Substrings of keys whose values are never written to a capture
+SENSITIVE = ('password', 'secret', 'token', 'authorization', 'cookie')
+
+REDACTED = '<redacted>'
+
+
+def redact(value):
+    """
+    Returns a copy of value with anything under a sensitive key replaced.
+
+    *Parameters*:
+        * value: A dict, list or plain value.
+    """
+    if isinstance(value, dict):
+        result = {}
+        for key, item in value.items():
+            if any(s in str(key).lower() for s in SENSITIVE):
+                result[key] = REDACTED
+            else:
+                result[key] = redact(item)
+        return result
+    if isinstance(value, (list, tuple)):
+        return [redact(item) for item in value]
+    return value
+
+
+def redact_url(url):
+    """
+    Returns url without user info and with sensitive query values
+    replaced.
+
+    *Parameters*:
+        * url: The url to redact.
+    """
+    parts = urlsplit(url)
+    netloc = parts.netloc.rpartition('@')[2]
+    query = parts.query
+    if query:
+        query = urlencode([
+            (key, REDACTED if any(s in key.lower() for s in SENSITIVE)
+             else value)
+            for key, value in parse_qsl(query, keep_blank_values=True)])
+    return urlunsplit(
+        (parts.scheme, netloc, parts.path, query, parts.fragment))
+
+
+def _decode_body(data):
+    """
+    Returns a request or response body as JSON if possible so it can
+    be redacted, else as text.
+    """
+    if data is None:
+        return None
+    try:
+        return {'json': redact(json.loads(data))}
+    except (TypeError, ValueError):
+        return {'text': data if isinstance(data, unicode) else
+                data.decode('utf-8', 'replace')}
+
+
+class CaptureWriter(object):
+    """
+    Appends capture records to a file, one compact JSON object per line.
+    Records are written whole under a lock so concurrent writers never
+    interleave.
+    """
+
+    def __init__(self, path):
+        """
+        Creates a CaptureWriter.
+
+        *Parameters*:
+            * path: File to append to.
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(path, 'a')
+
+    def _write(self, record):
+        line = json.dumps(record, separators=(',', ':')) + '\n'
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+
+    def message(self, corr_id, body):
+        """
+        Records an incoming message body.
+
+        *Parameters*:
+            * corr_id: The message correlation id.
+            * body: The decoded message body.
+        """
+        self._write({
+            'type': 'message',
+            'time': time.time(),
+            'corr_id': corr_id,
+            'body': redact(body),
+        })
+
+    def http(self, corr_id, method, api, path, kwargs, response, elapsed):
+        """
+        Records a ServiceNow request and its response. Credentials and
+        cookies are never written.
+
+        *Parameters*:
+            * corr_id: Correlation id of the message the call was for.
+            * method: The lowercase HTTP method.
+            * api: Either root or import.
+            * path: Path the request went to.
+            * kwargs: The requests keyword arguments.
+            * response: The requests Response.
+            * elapsed: Seconds the call took.
+        """
+        data = kwargs.get('data')
+        headers = kwargs.get('headers') or {}
+        if headers.get('Content-Encoding') == 'gzip':
+            data = None
+        self._write({
+            'type': 'http',
+            'time': time.time() - elapsed,
+            'corr_id': corr_id,
+            'method': method,
+            'api': api,
+            'path': path,
+            'elapsed': elapsed,
+            'request': _decode_body(data),
+            'status': response.status_code,
+            'response_headers': redact(dict(response.headers)),
+            'response': _decode_body(response.content),
+        })
+
+    def close(self):
+        """
+        Closes the capture file.
+        """
+        with self._lock:
+            self._file.close()
+
+
+def read_capture(path):
+    """
+    Yields the records of a capture file in order.
+
+    *Parameters*:
+        * path: The capture file.
+    """
+    with open(path) as capture:
+        for line in capture:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
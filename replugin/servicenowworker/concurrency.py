@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Adaptive concurrency limiting.
+"""
+import threading
+
+
+class AIMDLimiter(object):
+    """
+    Additive increase, multiplicative decrease limit on in flight work.
+    Every window of samples the limit grows by increase if latency and
+    errors are within bounds, otherwise it is multiplied by decrease.
+    """
+
+    def __init__(self, initial=1, minimum=1, maximum=50, latency_target=1.0,
+                 error_threshold=0.1, increase=1, decrease=0.5, window=20):
+        """
+        Creates an AIMDLimiter.
+
+        *Parameters*:
+            * initial: Starting limit.
+            * minimum: Lowest the limit may go.
+            * maximum: Highest the limit may go.
+            * latency_target: Average seconds per call above which the
+              limit is cut.
+            * error_threshold: Error rate above which the limit is cut.
+            * increase: Amount added to the limit when healthy.
+            * decrease: Factor the limit is multiplied by when not.
+            * window: Samples per decision.
+        """
+        self.minimum = int(minimum)
+        self.maximum = int(maximum)
+        self.limit = max(self.minimum, min(self.maximum, int(initial)))
+        self.latency_target = float(latency_target)
+        self.error_threshold = float(error_threshold)
+        self.increase = int(increase)
+        self.decrease = float(decrease)
+        self.window = int(window)
+        self.in_flight = 0
+        self.last_decision = None
+        self._latency = 0.0
+        self._errors = 0
+        self._samples = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, timeout=None):
+        """
+        Takes a slot, waiting up to timeout seconds for one to free up.
+        Returns False if no slot was available in time.
+
+        *Parameters*:
+            * timeout: Seconds to wait or None to wait forever.
+        """
+        with self._cond:
+            if timeout is None:
+                while self.in_flight >= self.limit:
+                    self._cond.wait()
+            elif self.in_flight >= self.limit:
+                self._cond.wait(timeout)
+                if self.in_flight >= self.limit:
+                    return False
+            self.in_flight += 1
+            return True
+
+    def release(self):
+        """
+        Gives back a slot taken by acquire.
+        """
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify()
+
+    def record(self, latency, error=False):
+        """
+        Records the outcome of a call. Returns the new limit if this
+        sample completed a window and the limit changed, else None.
+
+        *Parameters*:
+            * latency: Seconds the call took.
+            * error: If the call failed.
+        """
+        with self._cond:
+            self._samples += 1
+            self._latency += latency
+            if error:
+                self._errors += 1
+            if self._samples < self.window:
+                return None
+
+            average = self._latency / self._samples
+            error_rate = float(self._errors) / self._samples
+            self._samples = 0
+            self._latency = 0.0
+            self._errors = 0
+
+            previous = self.limit
+            if average > self.latency_target or (
+                    error_rate > self.error_threshold):
+                self.limit = max(
+                    self.minimum, int(self.limit * self.decrease))
+                action = 'decrease'
+            else:
+                self.limit = min(self.maximum, self.limit + self.increase)
+                action = 'increase'
+            self.last_decision = {
+                'action': action,
+                'latency': average,
+                'error_rate': error_rate,
+                'limit': self.limit,
+            }
+            self._cond.notify_all()
+            if self.limit != previous:
+                return self.limit
+            return None
+
+    def status(self):
+        """
+        Returns the current limit, in flight count and last decision.
+        """
+        with self._cond:
+            return {
+                'limit': self.limit,
+                'in_flight': self.in_flight,
+                'last_decision': self.last_decision,
+            }
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Per message time budgets.
+"""
+import time
+
+
+class Deadline(object):
+    """
+    A time budget which HTTP calls made for a message are bounded by.
+    """
+
+    def __init__(self, budget):
+        """
+        Creates a Deadline.
+
+        *Parameters*:
+            * budget: Seconds from now until the deadline.
+        """
+        self.budget = float(budget)
+        self.expires = time.time() + self.budget
+
+    def remaining(self):
+        """
+        Returns the seconds left, never less than zero.
+        """
+        return max(0.0, self.expires - time.time())
+
+    def expired(self):
+        """
+        Returns True once the budget is spent.
+        """
+        return self.remaining() <= 0
+
+    def timeout(self, connect, read, share=None):
+        """
+        Returns a requests (connect, read) timeout tuple capped by the
+        time left.
+
+        *Parameters*:
+            * connect: The configured connect timeout.
+            * read: The configured read timeout.
+            * share: Fraction of the remaining budget this call may use.
+        """
+        remaining = self.remaining()
+        if share is not None:
+            remaining *= share
+        return (min(connect, remaining), min(read, remaining))
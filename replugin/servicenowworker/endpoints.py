@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Endpoint health tracking and latency-aware selection.
+"""
+import threading
+import time
+
+
+class Endpoint(object):
+    """
+    A single ServiceNow url along with its observed health and latency.
+    """
+
+    def __init__(self, url, index):
+        """
+        Creates an Endpoint.
+
+        *Parameters*:
+            * url: The base url requests are sent to.
+            * index: Position of the url in the configured list.
+        """
+        self.url = url
+        self.index = index
+        #: EWMA of observed latency in seconds, None until measured
+        self.latency = None
+        #: Consecutive failures since the last success
+        self.failures = 0
+        #: Epoch time the endpoint was last marked unhealthy
+        self.down_since = None
+
+    def __repr__(self):
+        return '<Endpoint %s latency=%s failures=%s>' % (
+            self.url, self.latency, self.failures)
+
+
+class EndpointPool(object):
+    """
+    Orders a list of endpoints for reads and writes based on health and
+    an exponentially weighted moving average of their latency.
+    """
+
+    def __init__(self, urls, ewma_alpha=0.3, failure_threshold=3,
+                 retry_after=30, pin_writes_to_primary=True):
+        """
+        Creates an EndpointPool.
+
+        *Parameters*:
+            * urls: A url or list of urls. The first one is the primary.
+            * ewma_alpha: Weight given to the newest latency sample.
+            * failure_threshold: Consecutive failures before an endpoint
+              is considered unhealthy.
+            * retry_after: Seconds before an unhealthy endpoint is tried
+              again.
+            * pin_writes_to_primary: If writes should only go to the primary.
+        """
+        if isinstance(urls, basestring):
+            urls = [urls]
+        if not urls:
+            raise ValueError('At least one endpoint url is required.')
+        self.endpoints = [Endpoint(url, i) for i, url in enumerate(urls)]
+        self.ewma_alpha = float(ewma_alpha)
+        self.failure_threshold = int(failure_threshold)
+        self.retry_after = float(retry_after)
+        self.pin_writes_to_primary = pin_writes_to_primary
+        self._lock = threading.Lock()
+
+    @property
+    def primary(self):
+        """
+        The first configured endpoint.
+        """
+        return self.endpoints[0]
+
+    def _healthy(self, endpoint, now):
+        """
+        Returns True if the endpoint is healthy or due for a retry.
+        """
+        if endpoint.failures < self.failure_threshold:
+            return True
+        return (now - endpoint.down_since) >= self.retry_after
+
+    def read_candidates(self):
+        """
+        Returns endpoints ordered fastest healthy first. Endpoints
+        without a latency sample yet sort first so they get measured.
+        Unhealthy endpoints are kept at the end as a last resort.
+        """
+        now = time.time()
+        with self._lock:
+            healthy = []
+            unhealthy = []
+            for endpoint in self.endpoints:
+                if self._healthy(endpoint, now):
+                    healthy.append(endpoint)
+                else:
+                    unhealthy.append(endpoint)
+            healthy.sort(key=lambda e: (e.latency or 0.0, e.index))
+            unhealthy.sort(key=lambda e: e.down_since)
+        return healthy + unhealthy
+
+    def write_candidates(self):
+        """
+        Returns endpoints in the order writes should use them.
+        """
+        if self.pin_writes_to_primary:
+            return [self.primary]
+        return self.read_candidates()
+
+    def record_success(self, endpoint, elapsed):
+        """
+        Records a successful call and folds its latency into the EWMA.
+
+        *Parameters*:
+            * endpoint: The Endpoint which answered.
+            * elapsed: Seconds the call took.
+        """
+        with self._lock:
+            if endpoint.latency is None:
+                endpoint.latency = elapsed
+            else:
+                endpoint.latency = (
+                    self.ewma_alpha * elapsed +
+                    (1 - self.ewma_alpha) * endpoint.latency)
+            endpoint.failures = 0
+            endpoint.down_since = None
+
+    def record_failure(self, endpoint):
+        """
+        Records a failed call against an endpoint.
+
+        *Parameters*:
+            * endpoint: The Endpoint which failed.
+        """
+        with self._lock:
+            endpoint.failures += 1
+            if endpoint.failures >= self.failure_threshold:
+                endpoint.down_since = time.time()
+
+    def status(self):
+        """
+        Returns a list of dicts describing each endpoint.
+        """
+        with self._lock:
+            return [{
+                'url': e.url,
+                'latency': e.latency,
+                'failures': e.failures,
+                'healthy': e.failures < self.failure_threshold,
+            } for e in self.endpoints]
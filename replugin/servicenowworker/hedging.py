@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Request hedging for idempotent reads.
+"""
+import sys
+import threading
+
+from collections import deque
+from Queue import Queue, Empty
+
+
+class HedgePolicy(object):
+    """
+    Decides when a duplicate request should be sent. The delay is a
+    percentile of recently observed latencies and hedges are paid for
+    from a budget which only grows as normal requests are made.
+    """
+
+    def __init__(self, percentile=95, min_delay=0.05, max_delay=5.0,
+                 window=200, min_samples=20, budget_ratio=0.05,
+                 max_budget=10):
+        """
+        Creates a HedgePolicy.
+
+        *Parameters*:
+            * percentile: Latency percentile to wait for before hedging.
+            * min_delay: Lower bound for the hedge delay in seconds.
+            * max_delay: Upper bound for the hedge delay in seconds.
+            * window: Number of latency samples to keep.
+            * min_samples: Samples required before hedging starts.
+            * budget_ratio: Hedges earned per request made.
+            * max_budget: Most hedges which may be saved up.
+        """
+        self.percentile = float(percentile)
+        self.min_delay = float(min_delay)
+        self.max_delay = float(max_delay)
+        self.min_samples = int(min_samples)
+        self.budget_ratio = float(budget_ratio)
+        self.max_budget = float(max_budget)
+        self._samples = deque(maxlen=int(window))
+        self._budget = 0.0
+        self._lock = threading.Lock()
+        self.hedged = 0
+        self.denied = 0
+
+    def record(self, elapsed):
+        """
+        Records the latency of a request and earns hedge budget.
+
+        *Parameters*:
+            * elapsed: Seconds the request took.
+        """
+        with self._lock:
+            self._samples.append(elapsed)
+            self._budget = min(
+                self.max_budget, self._budget + self.budget_ratio)
+
+    def delay(self):
+        """
+        Returns the seconds to wait before hedging or None if there are
+        not enough samples yet.
+        """
+        with self._lock:
+            if len(self._samples) < self.min_samples:
+                return None
+            ordered = sorted(self._samples)
+        index = int(round((self.percentile / 100) * (len(ordered) - 1)))
+        return min(self.max_delay, max(self.min_delay, ordered[index]))
+
+    def allow(self):
+        """
+        Spends one hedge from the budget. Returns False if there is
+        not enough budget left.
+        """
+        with self._lock:
+            if self._budget >= 1:
+                self._budget -= 1
+                self.hedged += 1
+                return True
+            self.denied += 1
+            return False
+
+
+def _close(result):
+    """
+    Releases the connection held by a response which lost the race.
+    """
+    close = getattr(result, 'close', None)
+    if close is not None:
+        try:
+            close()
+        except Exception:
+            pass
+
+
+def hedged_call(primary, backup, policy):
+    """
+    Calls primary and, if it has not answered within the policy delay,
+    backup as well. The first successful result wins and the loser's
+    response is closed once it arrives. If both fail the primary's
+    error is raised.
+
+    *Parameters*:
+        * primary: Callable for the first request.
+        * backup: Callable for the duplicate request.
+        * policy: The HedgePolicy to use.
+    """
+    delay = policy.delay()
+    if delay is None:
+        return primary()
+
+    results = Queue()
+    state = {'done': False}
+    lock = threading.Lock()
+
+    def run(name, func):
+        try:
+            outcome = (name, True, func())
+        except Exception:
+            outcome = (name, False, sys.exc_info())
+        with lock:
+            if state['done']:
+                if outcome[1]:
+                    _close(outcome[2])
+                return
+            results.put(outcome)
+
+    def start(name, func):
+        thread = threading.Thread(target=run, args=(name, func))
+        thread.daemon = True
+        thread.start()
+
+    start('primary', primary)
+    pending = 1
+    try:
+        outcome = results.get(timeout=delay)
+    except Empty:
+        if policy.allow():
+            start('backup', backup)
+            pending += 1
+        outcome = results.get()
+    pending -= 1
+
+    errors = {}
+    while True:
+        name, ok, value = outcome
+        if ok:
+            with lock:
+                state['done'] = True
+            # Close anything which finished while we held the winner
+            while not results.empty():
+                late = results.get()
+                if late[1]:
+                    _close(late[2])
+            return value
+        errors[name] = value
+        if not pending:
+            break
+        outcome = results.get()
+        pending -= 1
+
+    exc_info = errors.get('primary', errors.get('backup'))
+    raise exc_info[0], exc_info[1], exc_info[2]
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Append only write-ahead journal.
+"""
+import errno
+import fcntl
+import json
+import os
+import threading
+import uuid
+
+from collections import OrderedDict
+
+
+class JournalLocked(Exception):
+    """
+    The journal is open in another process.
+    """
+    pass
+
+
+class Journal(object):
+    """
+    Keeps entries which still have to be delivered in a file of JSON
+    lines. An entry is fsynced before append returns, so it survives a
+    crash once accepted. Confirmed entries are marked in the file and
+    dropped from it when the journal is compacted. Only one process at a
+    time may have a journal open.
+    """
+
+    def __init__(self, path):
+        """
+        Opens the journal at path, creating it if missing. Entries left
+        unconfirmed by an earlier run are pending again. Raises
+        JournalLocked if another process has it open.
+
+        *Parameters*:
+            * path: Path to the journal file.
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._pending = OrderedDict()
+        #: Entries confirmed since the last compaction
+        self.confirmed = 0
+        self._file = None
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        # Compacting replaces the journal file, so the lock is held on
+        # a file of its own
+        self._lock_file = open(path + '.lock', 'a')
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError, ex:
+            self._lock_file.close()
+            if ex.errno in (errno.EAGAIN, errno.EACCES):
+                raise JournalLocked('%s is open in another process' % path)
+            raise
+        if os.path.exists(path):
+            self._replay()
+        # Also gets rid of a line cut short by a crash
+        self.compact()
+
+    def _replay(self):
+        with open(self.path) as journal:
+            for line in journal:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Torn write, the entry was never acknowledged
+                    continue
+                if record.get('done'):
+                    self._pending.pop(record['id'], None)
+                else:
+                    self._pending[record['id']] = record['entry']
+
+    def _write(self, record, sync):
+        self._file.write(json.dumps(record) + '\n')
+        self._file.flush()
+        if sync:
+            os.fsync(self._file.fileno())
+
+    def append(self, entry):
+        """
+        Writes entry to the journal and returns its id once it is on
+        disk.
+
+        *Parameters*:
+            * entry: A dict which can be serialized as JSON.
+        """
+        entry_id = uuid.uuid4().hex
+        with self._lock:
+            self._write({'id': entry_id, 'entry': entry}, True)
+            self._pending[entry_id] = entry
+        return entry_id
+
+    def confirm(self, entry_id):
+        """
+        Marks an entry as delivered.
+
+        *Parameters*:
+            * entry_id: The id append returned.
+        """
+        with self._lock:
+            if self._pending.pop(entry_id, None) is None:
+                return
+            # Losing this only means delivering the entry again
+            self._write({'id': entry_id, 'done': True}, False)
+            self.confirmed += 1
+
+    def pending(self):
+        """
+        Returns (id, entry) pairs not yet confirmed, oldest first.
+        """
+        with self._lock:
+            return self._pending.items()
+
+    def compact(self):
+        """
+        Rewrites the journal with only the pending entries.
+        """
+        with self._lock:
+            temporary = self.path + '.tmp'
+            with open(temporary, 'w') as journal:
+                for entry_id, entry in self._pending.items():
+                    journal.write(
+                        json.dumps({'id': entry_id, 'entry': entry}) + '\n')
+                journal.flush()
+                os.fsync(journal.fileno())
+            os.rename(temporary, self.path)
+            directory = os.open(
+                os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+            try:
+                os.fsync(directory)
+            finally:
+                os.close(directory)
+            if self._file is not None:
+                self._file.close()
+            self._file = open(self.path, 'a')
+            self.confirmed = 0
+
+    def close(self):
+        """
+        Closes the journal file and lets other processes open it.
+        """
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            if not self._lock_file.closed:
+                # Closing releases the lock
+                self._lock_file.close()
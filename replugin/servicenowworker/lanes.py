@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Lanes of worker threads so different kinds of work do not queue behind
+each other.
+"""
+import threading
+import time
+
+from Queue import Queue
+
+
+class Lane(object):
+    """
+    A named pool of threads running submitted tasks in the order they
+    were submitted. The number of threads is the lane's concurrency
+    limit, tasks beyond it wait in the lane's own queue.
+    """
+
+    def __init__(self, name, workers=1, metrics=None):
+        """
+        Creates a Lane and starts its threads.
+
+        *Parameters*:
+            * name: Name of the lane, used for threads and metrics.
+            * workers: Number of tasks run at once.
+            * metrics: Metrics instance to record queue and run times in.
+        """
+        self.name = name
+        self.workers = max(1, int(workers))
+        self.metrics = metrics
+        self._queue = Queue()
+        self._lock = threading.Lock()
+        #: Tasks running right now
+        self.active = 0
+        #: Tasks which raised
+        self.errors = 0
+        self._threads = []
+        for number in range(self.workers):
+            thread = threading.Thread(
+                target=self._run, name='lane-%s-%s' % (name, number))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    @property
+    def queued(self):
+        """
+        Tasks waiting for a thread.
+        """
+        return self._queue.qsize()
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Queues func to be called with args and kwargs on a lane thread.
+        """
+        self._queue.put((time.time(), func, args, kwargs))
+
+    def status(self):
+        """
+        Returns a dict with the lane's workers, active and queued tasks.
+        """
+        return {
+            'workers': self.workers,
+            'active': self.active,
+            'queued': self.queued,
+        }
+
+    def stop(self, timeout=None):
+        """
+        Lets the threads finish the tasks already queued and exit.
+
+        *Parameters*:
+            * timeout: Seconds to wait for each thread.
+        """
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def _run(self):
+        while True:
+            task = self._queue.get()
+            if task is None:
+                return
+            submitted, func, args, kwargs = task
+            started = time.time()
+            self._timing('wait', started - submitted)
+            with self._lock:
+                self.active += 1
+            try:
+                func(*args, **kwargs)
+            except Exception:
+                # Tasks handle their own errors, keep the thread alive
+                with self._lock:
+                    self.errors += 1
+            finally:
+                with self._lock:
+                    self.active -= 1
+                self._timing('run', time.time() - started)
+
+    def _timing(self, name, seconds):
+        if self.metrics is not None:
+            self.metrics.timing('lanes.%s.%s' % (self.name, name), seconds)
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+In process worker metrics.
+"""
+import json
+import os
+import threading
+import time
+
+
+class Metrics(object):
+    """
+    Thread safe counters, gauges and timings which can be written to a
+    file for a supervisor or monitoring to pick up.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.timings = {}
+        self.started = time.time()
+
+    def incr(self, name, value=1):
+        """
+        Adds value to a counter.
+
+        *Parameters*:
+            * name: The counter name.
+            * value: Amount to add.
+        """
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def gauge(self, name, value):
+        """
+        Sets a gauge to its current value.
+
+        *Parameters*:
+            * name: The gauge name.
+            * value: The current value.
+        """
+        with self._lock:
+            self.gauges[name] = value
+
+    def timing(self, name, seconds):
+        """
+        Records a duration.
+
+        *Parameters*:
+            * name: The timing name.
+            * seconds: The duration in seconds.
+        """
+        with self._lock:
+            timing = self.timings.setdefault(
+                name, {'count': 0, 'total': 0.0, 'max': 0.0})
+            timing['count'] += 1
+            timing['total'] += seconds
+            timing['max'] = max(timing['max'], seconds)
+
+    def snapshot(self):
+        """
+        Returns a copy of all metrics as a dict.
+        """
+        with self._lock:
+            return {
+                'pid': os.getpid(),
+                'time': time.time(),
+                'uptime': time.time() - self.started,
+                'counters': dict(self.counters),
+                'gauges': dict(self.gauges),
+                'timings': dict(
+                    (k, dict(v)) for k, v in self.timings.items()),
+            }
+
+    def dump(self, path):
+        """
+        Atomically writes a snapshot to path as JSON.
+
+        *Parameters*:
+            * path: The file to write.
+        """
+        tmp = '%s.%s.tmp' % (path, os.getpid())
+        with open(tmp, 'w') as out:
+            json.dump(self.snapshot(), out)
+        os.rename(tmp, path)
+
+
+def aggregate(snapshots):
+    """
+    Combines snapshots from several processes. Counters and gauges are
+    summed, timings are summed with the largest max kept.
+
+    *Parameters*:
+        * snapshots: Iterable of dicts from Metrics.snapshot.
+    """
+    result = {'processes': 0, 'counters': {}, 'gauges': {}, 'timings': {}}
+    for snapshot in snapshots:
+        result['processes'] += 1
+        for key in ('counters', 'gauges'):
+            for name, value in snapshot.get(key, {}).items():
+                result[key][name] = result[key].get(name, 0) + value
+        for name, timing in snapshot.get('timings', {}).items():
+            total = result['timings'].setdefault(
+                name, {'count': 0, 'total': 0.0, 'max': 0.0})
+            total['count'] += timing['count']
+            total['total'] += timing['total']
+            total['max'] = max(total['max'], timing['max'])
+    return result
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Wrappers around the output of messages.
+"""
+import threading
+import time
+
+
+class BufferedOutput(object):
+    """
+    Wraps a message's output and emits its lines as a single batch when
+    flushed or when a size or age threshold is hit. Errors flush what is
+    pending and are emitted right away.
+    """
+
+    def __init__(self, output, max_lines=20, max_age=2.0):
+        """
+        Creates a BufferedOutput.
+
+        *Parameters*:
+            * output: The output instance to write batches to.
+            * max_lines: Lines to collect before flushing.
+            * max_age: Seconds the oldest line may wait before flushing.
+        """
+        self._output = output
+        self.max_lines = int(max_lines)
+        self.max_age = float(max_age)
+        self._lines = []
+        self._first = None
+        self._lock = threading.Lock()
+
+    def _add(self, line):
+        """
+        Buffers a line and flushes if a threshold has been reached.
+        """
+        with self._lock:
+            if not self._lines:
+                self._first = time.time()
+            self._lines.append(line)
+            full = (
+                len(self._lines) >= self.max_lines or
+                time.time() - self._first >= self.max_age)
+        if full:
+            self.flush()
+
+    def debug(self, message):
+        self._add('DEBUG: %s' % message)
+
+    def info(self, message):
+        self._add(message)
+
+    def warn(self, message):
+        self._add('WARNING: %s' % message)
+
+    warning = warn
+
+    def error(self, message):
+        self.flush()
+        self._output.error(message)
+
+    def flush(self):
+        """
+        Emits all buffered lines as one output call.
+        """
+        with self._lock:
+            lines = self._lines
+            self._lines = []
+        if lines:
+            self._output.info('\n'.join(lines))
+
+    def __getattr__(self, name):
+        return getattr(self._output, name)
+
+
+class IoloopOutput(object):
+    """
+    Wraps a message's output for use from a thread other than the one
+    running the ioloop. Every call is handed to call_on_ioloop, which
+    runs it on the ioloop thread in the order calls were made.
+    """
+
+    def __init__(self, output, call_on_ioloop):
+        """
+        Creates an IoloopOutput.
+
+        *Parameters*:
+            * output: The output instance to write to.
+            * call_on_ioloop: Callable taking a function and its
+              arguments and calling it on the ioloop thread.
+        """
+        self._output = output
+        self._call_on_ioloop = call_on_ioloop
+
+    def __getattr__(self, name):
+        attribute = getattr(self._output, name)
+        if not callable(attribute):
+            return attribute
+
+        def call(*args, **kwargs):
+            self._call_on_ioloop(attribute, *args, **kwargs)
+        return call
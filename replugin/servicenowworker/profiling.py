@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Profiling helpers.
+"""
+import os
+import signal
+import sys
+import threading
+
+from collections import defaultdict
+
+
+class StackSampler(object):
+    """
+    Statistical profiler which samples stacks and counts the stacks
+    seen. By default the main thread is sampled on SIGPROF, every
+    interval of CPU time. With all_threads a daemon thread samples every
+    thread through sys._current_frames() every interval of wall time,
+    as SIGPROF is only handled in the main thread and only between its
+    bytecodes. Output is in the folded format read by flamegraph.pl and
+    speedscope.
+    """
+
+    def __init__(self, interval=0.005, tag=None, all_threads=False):
+        """
+        Creates a StackSampler.
+
+        *Parameters*:
+            * interval: Seconds between samples.
+            * tag: Callable taking a thread ident and returning a list
+              of names to put at the root of that thread's stacks, or
+              None to leave the thread out.
+            * all_threads: If every thread is sampled rather than only
+              the main thread.
+        """
+        self.interval = float(interval)
+        self.tag = tag
+        self.all_threads = all_threads
+        self.stacks = defaultdict(int)
+        self.samples = 0
+        self._previous = None
+        self._thread = None
+        self._stop = threading.Event()
+
+    def _sample(self, signum, frame):
+        # The handler always runs in the main thread
+        self._record(threading.current_thread().ident, frame)
+
+    def _sample_all(self):
+        """
+        Samples every thread but the sampler's own.
+        """
+        own = threading.current_thread().ident
+        for ident, frame in sys._current_frames().items():
+            if ident != own:
+                self._record(ident, frame)
+
+    def _run(self):
+        """
+        Body of the sampling thread.
+        """
+        while not self._stop.wait(self.interval):
+            self._sample_all()
+
+    def _record(self, ident, frame):
+        """
+        Counts the stack of a thread.
+        """
+        prefix = []
+        if self.tag is not None:
+            prefix = self.tag(ident)
+            if prefix is None:
+                return
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append('%s (%s:%s)' % (
+                code.co_name, os.path.basename(code.co_filename),
+                code.co_firstlineno))
+            frame = frame.f_back
+        stack.reverse()
+        self.stacks[';'.join(prefix + stack)] += 1
+        self.samples += 1
+
+    @property
+    def running(self):
+        """
+        True while sampling.
+        """
+        return self._previous is not None or self._thread is not None
+
+    def start(self):
+        """
+        Starts sampling. Without all_threads it must be called from the
+        main thread.
+        """
+        if self.all_threads:
+            self._stop.clear()
+            self._thread = threading.Thread(
+                target=self._run, name='stack-sampler')
+            self._thread.daemon = True
+            self._thread.start()
+            return
+        if threading.current_thread().name != 'MainThread':
+            raise RuntimeError('StackSampler must be started in the main thread')
+        self._previous = signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        """
+        Stops sampling.
+        """
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+            return
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        if self._previous is not None:
+            signal.signal(signal.SIGPROF, self._previous)
+            self._previous = None
+
+    def folded(self):
+        """
+        Returns the samples as folded stack lines.
+        """
+        return ''.join(
+            '%s %s\n' % (stack, count)
+            for stack, count in sorted(self.stacks.items()))
+
+    def write(self, path):
+        """
+        Writes the folded stacks to path.
+        """
+        with open(path, 'w') as out:
+            out.write(self.folded())
@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Replays captured traffic through ServiceNowWorker.process against a
+local stand-in for ServiceNow.
+"""
+import json
+import logging
+import threading
+import time
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from collections import deque
+
+from replugin.servicenowworker import ServiceNowWorker
+from replugin.servicenowworker.capture import read_capture
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class StandIn(object):
+    """
+    A local HTTP server which answers requests with the responses from
+    a capture, in the order they were captured, after the captured
+    delay scaled by speed.
+    """
+
+    def __init__(self, records, speed=1.0, host='127.0.0.1', port=0):
+        """
+        Creates a StandIn.
+
+        *Parameters*:
+            * records: Iterable of capture records.
+            * speed: Divides the captured response times. 0 means no delay.
+            * host: Address to listen on.
+            * port: Port to listen on, 0 picks a free one.
+        """
+        self.speed = float(speed)
+        self._responses = {}
+        self._lock = threading.Lock()
+        for record in records:
+            if record['type'] != 'http':
+                continue
+            for key in self._keys(
+                    record['method'], record['api'], record['path']):
+                self._responses.setdefault(key, deque()).append(record)
+        self._server = _Server((host, port), self._handler())
+        self._thread = None
+
+    @staticmethod
+    def _keys(method, api, path):
+        """
+        Returns the exact key and the key without a query string.
+        """
+        return ((method, api, path), (method, api, path.split('?')[0]))
+
+    @property
+    def url(self):
+        """
+        Base url of the stand-in.
+        """
+        host, port = self._server.server_address
+        return 'http://%s:%s' % (host, port)
+
+    def lookup(self, method, api, path):
+        """
+        Returns the next captured exchange for a request or None. An
+        exact match is preferred over one which ignores the query. The
+        last exchange for a key is reused once the others are used up.
+        """
+        with self._lock:
+            for key in self._keys(method, api, path):
+                queue = self._responses.get(key)
+                if queue:
+                    if len(queue) > 1:
+                        return queue.popleft()
+                    return queue[0]
+        return None
+
+    def _handler(self):
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def _answer(self):
+                length = int(self.headers.getheader('Content-Length') or 0)
+                if length:
+                    self.rfile.read(length)
+                api, _, path = self.path.lstrip('/').partition('/')
+                record = stand_in.lookup(
+                    self.command.lower(), api, '/' + path if path else '')
+                if record is None:
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                if stand_in.speed:
+                    time.sleep(record['elapsed'] / stand_in.speed)
+                response = record.get('response') or {}
+                if 'json' in response:
+                    payload = json.dumps(response['json'])
+                else:
+                    payload = (response.get('text') or u'').encode('utf-8')
+                self.send_response(record['status'])
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            do_GET = do_PUT = do_POST = do_DELETE = _answer
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        """
+        Serves requests from a background thread.
+        """
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops serving.
+        """
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class ReplayWorker(ServiceNowWorker):
+    """
+    A ServiceNowWorker without a bus connection. Replies are kept in
+    replies instead of being published.
+    """
+
+    def __init__(self, config, logger=None):
+        """
+        Creates a ReplayWorker.
+
+        *Parameters*:
+            * config: The worker config.
+            * logger: Logger to use as app_logger.
+        """
+        self._config = config
+        self.app_logger = logger or logging.getLogger('replay')
+        self._channel = None
+        self.replies = []
+        self._setup()
+
+    def ack(self, basic_deliver):
+        pass
+
+    def send(self, topic, corr_id, message_struct, exchange=''):
+        self.replies.append((corr_id, message_struct))
+
+    def notify(self, *args, **kwargs):
+        pass
+
+
+class _Deliver(object):
+    delivery_tag = None
+
+
+class _Properties(object):
+
+    def __init__(self, corr_id):
+        self.correlation_id = corr_id
+        self.reply_to = 'replay'
+
+
+def replay(records, worker, speed=1.0, output=None):
+    """
+    Feeds captured messages through worker.process keeping their
+    original spacing divided by speed. Returns a summary dict.
+
+    *Parameters*:
+        * records: List of capture records.
+        * worker: The worker to replay through.
+        * speed: Divides the gaps between messages. 0 means no gaps.
+        * output: Output instance passed to process.
+    """
+    output = output or logging.getLogger('replay.output')
+    messages = [r for r in records if r['type'] == 'message']
+    timings = {}
+    if not messages:
+        return {'messages': 0, 'failures': 0, 'elapsed': 0, 'subcommands': {}}
+
+    first = messages[0]['time']
+    start = time.time()
+    for message in messages:
+        if speed:
+            wait = (message['time'] - first) / speed - (time.time() - start)
+            if wait > 0:
+                time.sleep(wait)
+        subcommand = message['body'].get(
+            'parameters', {}).get('subcommand', 'unknown')
+        began = time.time()
+        worker.process(
+            None, _Deliver(), _Properties(message['corr_id']),
+            message['body'], output)
+        timings.setdefault(subcommand, []).append(time.time() - began)
+
+    failures = sum(
+        1 for _, reply in worker.replies if reply.get('status') == 'failed')
+    summary = {
+        'messages': len(messages),
+        'failures': failures,
+        'elapsed': time.time() - start,
+        'subcommands': {},
+    }
+    for subcommand, values in timings.items():
+        values.sort()
+        summary['subcommands'][subcommand] = {
+            'count': len(values),
+            'p50': values[int(0.5 * (len(values) - 1))],
+            'p95': values[int(0.95 * (len(values) - 1))],
+            'max': values[-1],
+        }
+    return summary
+
+
+def main():  # pragma: no cover
+    """
+    Entry point for re-worker-servicenow-replay.
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Replay a capture through ServiceNowWorker.')
+    parser.add_argument('capture', help='Capture file to replay')
+    parser.add_argument(
+        '--config', required=True, help='Worker config to replay with')
+    parser.add_argument(
+        '--speed', type=float, default=1.0,
+        help='Speed up factor, 0 for no delays (default: 1)')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARN)
+    records = list(read_capture(args.capture))
+    stand_in = StandIn(records, speed=args.speed)
+    stand_in.start()
+
+    with open(args.config) as config_file:
+        config = json.load(config_file)
+    config['api_root_url'] = stand_in.url + '/root'
+    config['api_import_url'] = stand_in.url + '/import'
+    # Never capture or drain while replaying
+    config.pop('capture', None)
+    config.pop('shutdown', None)
+
+    try:
+        summary = replay(records, ReplayWorker(config), speed=args.speed)
+    finally:
+        stand_in.stop()
+    print json.dumps(summary, indent=4)
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+In process DNS cache for the ServiceNow hosts.
+"""
+import itertools
+import socket
+import threading
+import time
+
+from urllib3.util.connection import allowed_gai_family
+
+try:
+    import dns.resolver
+except ImportError:  # pragma: no cover
+    # Without dnspython record TTLs are unknown and the configured
+    # ttl is used as is
+    dns = None
+
+
+class _Entry(object):
+
+    def __init__(self, addresses, ttl):
+        self.addresses = addresses
+        self.ttl = ttl
+        self.resolved = time.time()
+        self.rotation = itertools.count()
+
+    def age(self, now):
+        return now - self.resolved
+
+
+class Resolver(object):
+    """
+    Caches the addresses of hosts for their TTL and resolves them again
+    in the background before they expire, so connections rarely wait on
+    DNS. If a refresh fails the old addresses are kept until it works.
+    """
+
+    def __init__(self, ttl=60, min_ttl=5, refresh_ahead=0.75, spread=False,
+                 metrics=None):
+        """
+        Creates a Resolver.
+
+        *Parameters*:
+            * ttl: Seconds to keep addresses. With dnspython installed
+              a shorter record TTL wins.
+            * min_ttl: Shortest time to keep addresses for.
+            * refresh_ahead: Fraction of the TTL after which an entry is
+              refreshed in the background.
+            * spread: Rotate the addresses on each lookup so new
+              connections are spread over all of a host's A records.
+            * metrics: Metrics instance to record lookups in.
+        """
+        self.ttl = float(ttl)
+        self.min_ttl = float(min_ttl)
+        self.refresh_ahead = float(refresh_ahead)
+        self.spread = spread
+        self.metrics = metrics
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _record_ttl(self, host):
+        """
+        Returns the TTL of the host's A record or None if unknown.
+        """
+        if dns is None:
+            return None
+        try:
+            # resolve replaced query in dnspython 2
+            query = getattr(dns.resolver, 'resolve', dns.resolver.query)
+            return query(host, 'A').rrset.ttl
+        except Exception:
+            return None
+
+    def lookup(self, host, port=None):
+        """
+        Resolves host without the cache and stores the result. Returns
+        the addresses.
+
+        *Parameters*:
+            * host: The hostname.
+            * port: Port passed on to getaddrinfo.
+        """
+        start = time.time()
+        try:
+            addresses = []
+            for info in socket.getaddrinfo(
+                    host, port, allowed_gai_family(), socket.SOCK_STREAM):
+                if info[4][0] not in addresses:
+                    addresses.append(info[4][0])
+        except socket.gaierror:
+            self._incr('dns.errors')
+            raise
+        finally:
+            self._timing('dns.lookup', time.time() - start)
+        ttl = self.ttl
+        record_ttl = self._record_ttl(host)
+        if record_ttl is not None:
+            ttl = min(ttl, record_ttl)
+        with self._lock:
+            self._entries[host] = _Entry(addresses, max(self.min_ttl, ttl))
+        return addresses
+
+    def resolve(self, host, port=None):
+        """
+        Returns the addresses for host, from the cache while its entry
+        is fresh.
+
+        *Parameters*:
+            * host: The hostname.
+            * port: Port passed on to getaddrinfo on a miss.
+        """
+        with self._lock:
+            entry = self._entries.get(host)
+        if entry is None or entry.age(time.time()) >= entry.ttl:
+            self._incr('dns.misses')
+            try:
+                addresses = self.lookup(host, port)
+            except socket.gaierror:
+                if entry is None:
+                    raise
+                # Better an old address than none at all
+                self._incr('dns.stale')
+                addresses = entry.addresses
+            else:
+                with self._lock:
+                    entry = self._entries[host]
+            if not self.spread:
+                return list(addresses)
+        else:
+            self._incr('dns.hits')
+        if not self.spread or len(entry.addresses) < 2:
+            return list(entry.addresses)
+        shift = next(entry.rotation) % len(entry.addresses)
+        return entry.addresses[shift:] + entry.addresses[:shift]
+
+    def refresh(self):
+        """
+        Resolves again every entry past refresh_ahead of its TTL.
+        Returns the number refreshed.
+        """
+        now = time.time()
+        with self._lock:
+            due = [host for host, entry in self._entries.items()
+                   if entry.age(now) >= entry.ttl * self.refresh_ahead]
+        refreshed = 0
+        for host in due:
+            try:
+                self.lookup(host)
+            except socket.gaierror:
+                # Keep serving what we had, try again next time
+                continue
+            refreshed += 1
+        return refreshed
+
+    def start(self, hosts=(), interval=1.0):
+        """
+        Resolves hosts and then refreshes entries every interval
+        seconds from a background thread.
+
+        *Parameters*:
+            * hosts: Hostnames to resolve up front.
+            * interval: Seconds between refresh passes.
+        """
+        def run():
+            for host in hosts:
+                try:
+                    self.lookup(host)
+                except socket.gaierror:
+                    pass
+            while not self._stop.wait(interval):
+                self.refresh()
+
+        self._thread = threading.Thread(target=run, name='servicenow-dns')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops the background refresh.
+        """
+        self._stop.set()
+
+    def _incr(self, name):
+        if self.metrics is not None:
+            self.metrics.incr(name)
+
+    def _timing(self, name, seconds):
+        if self.metrics is not None:
+            self.metrics.timing(name, seconds)
@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Runs several ServiceNowWorker consumer processes from one parent.
+"""
+import errno
+import glob
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import sys
+import time
+import traceback
+
+from replugin.servicenowworker.metrics import aggregate
+
+#: Environment variable children write their metrics directory from
+METRICS_DIR_ENV = 'SERVICENOW_WORKER_METRICS_DIR'
+#: Environment variable holding a child's slot number
+SLOT_ENV = 'SERVICENOW_WORKER_SLOT'
+
+
+class Supervisor(object):
+    """
+    Forks consumer processes, restarts them when they die and combines
+    their metrics.
+    """
+
+    def __init__(self, target, processes, metrics_dir=None,
+                 metrics_interval=10, restart_delay=1.0,
+                 max_restart_delay=60.0, logger=None):
+        """
+        Creates a Supervisor.
+
+        *Parameters*:
+            * target: Callable run in each child.
+            * processes: Number of children to keep running.
+            * metrics_dir: Directory children write metrics to.
+            * metrics_interval: Seconds between metric aggregations.
+            * restart_delay: Seconds to wait before restarting a child
+              which died quickly. Doubles up to max_restart_delay.
+            * max_restart_delay: Longest wait between restarts.
+            * logger: Logger to use.
+        """
+        self.target = target
+        self.processes = int(processes)
+        self.metrics_dir = metrics_dir
+        self.metrics_interval = float(metrics_interval)
+        self.restart_delay = float(restart_delay)
+        self.max_restart_delay = float(max_restart_delay)
+        self.logger = logger or logging.getLogger(__name__)
+        #: pid -> slot
+        self.children = {}
+        #: slot -> (start time, current restart delay)
+        self._starts = {}
+        #: slot -> time its restart is due
+        self._restarts = {}
+        self._stopping = False
+
+    def spawn(self, slot):
+        """
+        Forks a child for a slot. Never returns in the child.
+
+        *Parameters*:
+            * slot: The slot number the child fills.
+        """
+        pid = os.fork()
+        if pid:
+            self.children[pid] = slot
+            delay = self._starts.get(slot, (0, self.restart_delay))[1]
+            self._starts[slot] = (time.time(), delay)
+            self.logger.info('Started child %s in slot %s' % (pid, slot))
+            if self._stopping:
+                # SIGTERM arrived while forking, after stop went through
+                # the children
+                os.kill(pid, signal.SIGTERM)
+            return pid
+
+        # Child
+        status = 0
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            os.environ[SLOT_ENV] = str(slot)
+            if self.metrics_dir:
+                os.environ[METRICS_DIR_ENV] = self.metrics_dir
+            self.target()
+        except SystemExit, ex:
+            status = ex.code if isinstance(ex.code, int) else 1
+        except:
+            traceback.print_exc()
+            status = 1
+        finally:
+            os._exit(status)
+
+    def _restart(self, slot):
+        """
+        Schedules the restart of a slot, backing off if its child keeps
+        dying quickly. run spawns it once it is due so the wait blocks
+        neither reaping nor the other slots.
+        """
+        started, delay = self._starts[slot]
+        now = time.time()
+        if now - started < delay * 10:
+            self.logger.warn('Slot %s is crashing, waiting %ss' % (
+                slot, delay))
+            self._restarts[slot] = now + delay
+            delay = min(self.max_restart_delay, delay * 2)
+        else:
+            self._restarts[slot] = now
+            delay = self.restart_delay
+        self._starts[slot] = (started, delay)
+
+    def _spawn_due(self):
+        """
+        Spawns the slots whose restart is due.
+        """
+        now = time.time()
+        for slot, due in sorted(self._restarts.items()):
+            if self._stopping:
+                return
+            if due <= now:
+                del self._restarts[slot]
+                self.spawn(slot)
+
+    def stop(self, signum=None, frame=None):
+        """
+        Forwards SIGTERM to all children and stops restarting them.
+        """
+        self._stopping = True
+        self._restarts.clear()
+        for pid in self.children.keys():
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    def collect_metrics(self):
+        """
+        Combines the metrics files of live children into aggregate.json
+        in the metrics directory and returns the result.
+        """
+        if not self.metrics_dir:
+            return None
+        snapshots = []
+        for path in glob.glob(os.path.join(self.metrics_dir, '*.json')):
+            name = os.path.basename(path)[:-len('.json')]
+            if not name.isdigit():
+                continue
+            if int(name) not in self.children:
+                # Left behind by a child which is gone
+                os.unlink(path)
+                continue
+            try:
+                with open(path) as metrics_file:
+                    snapshots.append(json.load(metrics_file))
+            except (IOError, ValueError):
+                continue
+        result = aggregate(snapshots)
+        tmp = os.path.join(self.metrics_dir, 'aggregate.json.tmp')
+        with open(tmp, 'w') as out:
+            json.dump(result, out)
+        os.rename(tmp, os.path.join(self.metrics_dir, 'aggregate.json'))
+        return result
+
+    def run(self):
+        """
+        Starts the children and supervises them until stopped.
+        """
+        if self.metrics_dir and not os.path.isdir(self.metrics_dir):
+            os.makedirs(self.metrics_dir)
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for slot in range(self.processes):
+            self.spawn(slot)
+
+        last_metrics = 0
+        while self.children or self._restarts:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError, ex:
+                if ex.errno == errno.EINTR:
+                    continue
+                if ex.errno != errno.ECHILD:
+                    raise
+                # Every slot is waiting to be restarted
+                pid = 0
+            if pid:
+                slot = self.children.pop(pid)
+                self.logger.info('Child %s in slot %s exited with %s' % (
+                    pid, slot, status))
+                if not self._stopping:
+                    self._restart(slot)
+                continue
+            self._spawn_due()
+            if time.time() - last_metrics >= self.metrics_interval:
+                self.collect_metrics()
+                last_metrics = time.time()
+            time.sleep(0.5)
+
+
+def main():  # pragma: no cover
+    """
+    Entry point for re-worker-servicenow-supervisor. Takes the same
+    arguments as re-worker-servicenow plus --processes and --metrics-dir.
+    """
+    import argparse
+    from reworker.worker import runner
+    from replugin.servicenowworker import ServiceNowWorker
+
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument(
+        '--processes', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--metrics-dir', default=None)
+    args, remaining = parser.parse_known_args()
+    # Leave the worker's own arguments for runner to parse in children
+    sys.argv = sys.argv[:1] + remaining
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s %(name)s %(levelname)s %(message)s')
+    supervisor = Supervisor(
+        lambda: runner(ServiceNowWorker),
+        args.processes,
+        metrics_dir=args.metrics_dir)
+    supervisor.run()
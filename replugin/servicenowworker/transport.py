@@ -0,0 +1,343 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+A requests Session whose connections time each phase of a request and
+are kept warm.
+"""
+import socket
+import time
+
+import requests
+
+from Queue import Empty
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import (
+    ConnectTimeoutError, NewConnectionError, ProtocolError)
+from urllib3.util.connection import allowed_gai_family, is_connection_dropped
+from urllib3.util.retry import Retry
+
+#: Phases timed by the connections, in the order they happen
+PHASES = ('dns', 'connect', 'tls', 'send', 'ttfb')
+
+
+class _TimedConnection(object):
+    """
+    Mixin for urllib3 connections which records how long each phase of
+    a request took in phases. The phases are handed to the response
+    and reset for the next request. dns, connect and tls stay at 0 when
+    a kept alive connection is reused.
+    """
+
+    #: A Resolver to look hosts up through, None to ask the system
+    resolver = None
+
+    def __init__(self, *args, **kwargs):
+        super(_TimedConnection, self).__init__(*args, **kwargs)
+        self._reset_phases()
+        #: When the connection last answered or was opened
+        self.last_used = time.time()
+
+    def _reset_phases(self):
+        self.phases = dict.fromkeys(PHASES, 0.0)
+        self.phases['reused'] = True
+
+    def _setup_time(self):
+        return self.phases['dns'] + self.phases['connect'] + self.phases['tls']
+
+    def resolve(self, host, port):
+        """
+        Returns the addresses to try for host in order.
+        """
+        if self.resolver is not None:
+            return self.resolver.resolve(host, port)
+        addresses = []
+        for info in socket.getaddrinfo(
+                host, port, allowed_gai_family(), socket.SOCK_STREAM):
+            if info[4][0] not in addresses:
+                addresses.append(info[4][0])
+        return addresses
+
+    def _new_conn(self):
+        host = self._dns_host
+        start = time.time()
+        try:
+            addresses = self.resolve(host, self.port)
+        except socket.gaierror, ex:
+            raise NewConnectionError(
+                self, 'Failed to resolve %s: %s' % (host, ex))
+        self.phases['dns'] = time.time() - start
+        self.phases['reused'] = False
+        self.last_used = time.time()
+
+        start = time.time()
+        error = None
+        try:
+            for address in addresses:
+                # Connect to the resolved address, TLS still uses self.host
+                self._dns_host = address
+                try:
+                    return super(_TimedConnection, self)._new_conn()
+                except (NewConnectionError, ConnectTimeoutError), error:
+                    continue
+            raise error or NewConnectionError(
+                self, 'No addresses found for %s' % host)
+        finally:
+            self._dns_host = host
+            self.phases['connect'] = time.time() - start
+
+    def request(self, *args, **kwargs):
+        # Plain http connects lazily inside request
+        setup = self._setup_time()
+        start = time.time()
+        try:
+            return super(_TimedConnection, self).request(*args, **kwargs)
+        finally:
+            self.phases['send'] = (
+                time.time() - start - (self._setup_time() - setup))
+
+    def request_chunked(self, *args, **kwargs):
+        setup = self._setup_time()
+        start = time.time()
+        try:
+            return super(_TimedConnection, self).request_chunked(
+                *args, **kwargs)
+        finally:
+            self.phases['send'] = (
+                time.time() - start - (self._setup_time() - setup))
+
+    def getresponse(self, *args, **kwargs):
+        start = time.time()
+        try:
+            response = super(_TimedConnection, self).getresponse(
+                *args, **kwargs)
+            self.phases['ttfb'] = time.time() - start
+            self.last_used = time.time()
+            response.phases = self.phases
+            return response
+        finally:
+            self._reset_phases()
+
+
+class TimedHTTPConnection(_TimedConnection, HTTPConnection):
+    """
+    An HTTPConnection which times each phase of a request.
+    """
+    pass
+
+
+class TimedHTTPSConnection(_TimedConnection, HTTPSConnection):
+    """
+    An HTTPSConnection which times each phase of a request, including
+    the TLS handshake.
+    """
+
+    def connect(self):
+        start = time.time()
+        try:
+            return HTTPSConnection.connect(self)
+        finally:
+            self.phases['tls'] = max(0.0, time.time() - start - (
+                self.phases['dns'] + self.phases['connect']))
+
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+class StaleRetry(Retry):
+    """
+    Retries idempotent requests whose connection was closed under them,
+    which is how a kept alive connection dropped by a load balancer
+    shows up. Anything else fails the way requests' default does, so
+    timeouts are left to the worker's failover and deadlines.
+    """
+
+    def increment(self, method=None, url=None, response=None, error=None,
+                  _pool=None, _stacktrace=None):
+        if error is not None and not isinstance(error, ProtocolError):
+            return Retry(0, read=False).increment(
+                method, url, response, error, _pool, _stacktrace)
+        return Retry.increment(
+            self, method, url, response, error, _pool, _stacktrace)
+
+
+class TimedAdapter(HTTPAdapter):
+    """
+    An HTTPAdapter whose pools use the timed connections.
+    """
+
+    def __init__(self, resolver=None, **kwargs):
+        """
+        Creates a TimedAdapter.
+
+        *Parameters*:
+            * resolver: A Resolver for the connections to use.
+            * kwargs: Passed on to HTTPAdapter.
+        """
+        # init_poolmanager runs from HTTPAdapter.__init__
+        self.resolver = resolver
+        HTTPAdapter.__init__(self, **kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        HTTPAdapter.init_poolmanager(self, *args, **kwargs)
+        pool_classes = {
+            'http': TimedHTTPConnectionPool,
+            'https': TimedHTTPSConnectionPool,
+        }
+        if self.resolver is not None:
+            # Pools build their connections from ConnectionCls alone
+            for scheme, pool_class in pool_classes.items():
+                connection_class = type(
+                    pool_class.ConnectionCls.__name__,
+                    (pool_class.ConnectionCls,), {'resolver': self.resolver})
+                pool_classes[scheme] = type(
+                    pool_class.__name__, (pool_class,),
+                    {'ConnectionCls': connection_class})
+        self.poolmanager.pool_classes_by_scheme = pool_classes
+
+
+class TimedSession(requests.Session):
+    """
+    A Session which keeps connections alive and times the phases of
+    each request. Use response_phases to read them back.
+    """
+
+    def __init__(self, pool_connections=10, pool_maxsize=10, retries=1,
+                 resolver=None):
+        """
+        Creates a TimedSession.
+
+        *Parameters*:
+            * pool_connections: Number of hosts to keep pools for.
+            * pool_maxsize: Connections to keep per host.
+            * retries: Times to retry a request on a stale connection.
+            * resolver: A Resolver to look hosts up through.
+        """
+        requests.Session.__init__(self)
+        for scheme in ('http://', 'https://'):
+            self.mount(scheme, TimedAdapter(
+                resolver=resolver,
+                pool_connections=pool_connections,
+                pool_maxsize=pool_maxsize,
+                max_retries=StaleRetry(
+                    total=retries, connect=0, read=retries, status=0,
+                    other=0)))
+
+    def prewarm(self, url, count, timeout=5):
+        """
+        Opens up to count connections to the host of url and leaves them
+        in its pool. Returns the number of connections opened.
+
+        *Parameters*:
+            * url: Any url on the host.
+            * count: Connections wanted in the pool.
+            * timeout: Connect timeout in seconds.
+        """
+        adapter = self.get_adapter(url)
+        pool = adapter.get_connection(url)
+        adapter.cert_verify(pool, url, self.verify, self.cert)
+        taken = []
+        opened = 0
+        try:
+            for _ in range(min(count, pool.pool.maxsize)):
+                conn = pool._get_conn()
+                taken.append(conn)
+                if conn.sock is None:
+                    conn.timeout = timeout
+                    conn.connect()
+                    # The first request should not report our setup
+                    conn._reset_phases()
+                    opened += 1
+        finally:
+            for conn in reversed(taken):
+                pool._put_conn(conn)
+        return opened
+
+    def refresh_idle(self, max_idle, timeout=5):
+        """
+        Reconnects pooled connections which have been idle for max_idle
+        seconds or were closed by the server, so a request never finds
+        a connection a load balancer has dropped. Returns the number of
+        connections refreshed.
+
+        *Parameters*:
+            * max_idle: Seconds a connection may sit idle.
+            * timeout: Connect timeout in seconds.
+        """
+        refreshed = 0
+        for adapter in set(self.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is None or pool.pool is None:
+                    continue
+                # Take them all out first, the queue is last in first out
+                taken = []
+                while True:
+                    try:
+                        taken.append(pool.pool.get(block=False))
+                    except Empty:
+                        break
+                now = time.time()
+                try:
+                    for conn in taken:
+                        if conn is None or conn.sock is None:
+                            continue
+                        if (now - conn.last_used < max_idle and
+                                not is_connection_dropped(conn)):
+                            continue
+                        conn.close()
+                        conn.timeout = timeout
+                        try:
+                            conn.connect()
+                        except Exception:
+                            # Left closed, the next request reconnects
+                            conn.close()
+                            continue
+                        conn._reset_phases()
+                        refreshed += 1
+                finally:
+                    for conn in reversed(taken):
+                        pool._put_conn(conn)
+        return refreshed
+
+
+def response_phases(response, elapsed=None):
+    """
+    Returns the phase timings of a response made through a TimedSession
+    or None. When elapsed is given, transfer is set to whatever part of
+    it the other phases do not account for.
+
+    *Parameters*:
+        * response: A requests.Response.
+        * elapsed: Seconds from sending the request to reading the body.
+    """
+    original = getattr(
+        getattr(response, 'raw', None), '_original_response', None)
+    phases = getattr(original, 'phases', None)
+    if phases is None:
+        return None
+    phases = dict(phases)
+    if elapsed is not None:
+        phases['transfer'] = max(
+            0.0, elapsed - sum(phases[name] for name in PHASES))
+    return phases
@@ -38,6 +38,10 @@ setup(
     entry_points={
         'console_scripts': [
             're-worker-servicenow = replugin.servicenowworker:main',
+            're-worker-servicenow-supervisor = '
+            'replugin.servicenowworker.supervisor:main',
+            're-worker-servicenow-replay = '
+            'replugin.servicenowworker.replay:main',
         ],
     }
 )
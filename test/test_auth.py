@@ -0,0 +1,219 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Unittests for session and OAuth token reuse.
+"""
+
+import json
+import threading
+import time
+import urlparse
+
+import requests
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+from . import TestCase
+
+from replugin.servicenowworker.auth import OAuthTokenAuth, SessionCookieAuth
+
+BASIC = 'Basic dXNlcjpwYXNz'
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, *args, **kwargs):
+        HTTPServer.__init__(self, *args, **kwargs)
+        #: Authorization or Cookie header of each table request
+        self.seen = []
+        self.sessions = set(['abc'])
+        self.tokens = set()
+        self.token_requests = []
+        self.token_status = 200
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def _reply(self, status, body, headers=()):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for header in headers:
+            self.send_header(*header)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        authorization = self.headers.get('Authorization', '')
+        cookie = self.headers.get('Cookie', '')
+        server.seen.append(authorization or cookie)
+        if authorization == BASIC:
+            self._reply(200, '{"result": []}', [
+                ('Set-Cookie', 'JSESSIONID=abc; Path=/'),
+                ('Set-Cookie', 'glide_user_route=route; Path=/')])
+        elif authorization.startswith('Bearer ') and (
+                authorization[7:] in server.tokens):
+            self._reply(200, '{"result": []}')
+        elif cookie and cookie.split(';')[0].split('=')[1] in server.sessions:
+            self._reply(200, '{"result": []}')
+        else:
+            self._reply(401, '{"error": "unauthorized"}')
+
+    def do_POST(self):
+        server = self.server
+        form = dict(urlparse.parse_qsl(
+            self.rfile.read(int(self.headers['Content-Length']))))
+        server.token_requests.append(form)
+        if server.token_status != 200:
+            self._reply(server.token_status, '{}')
+            return
+        token = 'token%s' % len(server.token_requests)
+        server.tokens.add(token)
+        self._reply(200, json.dumps({
+            'access_token': token,
+            'refresh_token': 'refresh',
+            'expires_in': 1800}))
+
+    def log_message(self, *args):
+        pass
+
+
+class TestAuth(TestCase):
+
+    def setUp(self):
+        """
+        Start a local HTTP server which checks credentials.
+        """
+        TestCase.setUp(self)
+        self.server = _Server(('127.0.0.1', 0), _Handler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        base = 'http://127.0.0.1:%s' % self.server.server_address[1]
+        self.url = base + '/api/now/table/change_request'
+        self.token_url = base + '/oauth_token.do'
+
+    def tearDown(self):
+        """
+        Stop the server.
+        """
+        TestCase.tearDown(self)
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_session_cookie_reuse(self):
+        """
+        After one Basic call the session cookies should be sent instead
+        and a rejected session should fall back to Basic.
+        """
+        auth = SessionCookieAuth('user', 'pass')
+        for _ in range(3):
+            assert requests.get(self.url, auth=auth).status_code == 200
+        assert self.server.seen == [
+            BASIC,
+            'JSESSIONID=abc; glide_user_route=route',
+            'JSESSIONID=abc; glide_user_route=route']
+        assert auth.refreshes == 1
+        assert auth.fallbacks == 0
+
+        # The instance expired the session
+        self.server.sessions.clear()
+        self.server.seen[:] = []
+        response = requests.get(self.url, auth=auth)
+        assert response.status_code == 200
+        assert response.history[0].status_code == 401
+        assert self.server.seen == [
+            'JSESSIONID=abc; glide_user_route=route', BASIC]
+        assert auth.fallbacks == 1
+        assert auth.refreshes == 2
+
+    def test_session_refresh_before_expiry(self):
+        """
+        A session within refresh_margin of its lifetime should be
+        replaced by a Basic call.
+        """
+        auth = SessionCookieAuth('user', 'pass', lifetime=30, refresh_margin=10)
+        requests.get(self.url, auth=auth)
+        host = urlparse.urlsplit(self.url).netloc
+        auth._sessions[host] = (auth._sessions[host][0], time.time() + 5)
+        requests.get(self.url, auth=auth)
+        assert self.server.seen == [BASIC, BASIC]
+        assert auth.refreshes == 2
+
+    def test_session_per_host(self):
+        """
+        A session learned from one host should not be sent to another.
+        """
+        auth = SessionCookieAuth('user', 'pass')
+        other = self.url.replace('127.0.0.1', 'localhost')
+        for url in (self.url, other, other, self.url):
+            assert requests.get(url, auth=auth).status_code == 200
+        assert self.server.seen == [
+            BASIC,
+            BASIC,
+            'JSESSIONID=abc; glide_user_route=route',
+            'JSESSIONID=abc; glide_user_route=route']
+        assert auth.refreshes == 2
+        assert auth.fallbacks == 0
+
+    def test_oauth_token(self):
+        """
+        A bearer token should be fetched once, refreshed before it
+        expires and replaced after a 401.
+        """
+        auth = OAuthTokenAuth(
+            'user', 'pass', 'client', 'secret', self.token_url)
+        for _ in range(2):
+            assert requests.get(self.url, auth=auth).status_code == 200
+        assert self.server.seen == ['Bearer token1', 'Bearer token1']
+        assert self.server.token_requests == [{
+            'grant_type': 'password', 'username': 'user', 'password': 'pass',
+            'client_id': 'client', 'client_secret': 'secret'}]
+
+        # Close to expiry the refresh token is used
+        auth._expires = time.time() + 30
+        requests.get(self.url, auth=auth)
+        assert self.server.seen[-1] == 'Bearer token2'
+        assert self.server.token_requests[-1]['grant_type'] == 'refresh_token'
+        assert self.server.token_requests[-1]['refresh_token'] == 'refresh'
+
+        # A revoked token falls back to Basic, the next call gets a new one
+        self.server.tokens.clear()
+        response = requests.get(self.url, auth=auth)
+        assert response.status_code == 200
+        assert self.server.seen[-2:] == ['Bearer token2', BASIC]
+        assert auth.fallbacks == 1
+        requests.get(self.url, auth=auth)
+        assert self.server.seen[-1] == 'Bearer token3'
+        assert auth.refreshes == 3
+
+    def test_oauth_unavailable(self):
+        """
+        Without a token Basic auth should be used and the token endpoint
+        left alone for retry_after seconds.
+        """
+        self.server.token_status = 401
+        auth = OAuthTokenAuth(
+            'user', 'pass', 'client', 'secret', self.token_url,
+            retry_after=60)
+        for _ in range(2):
+            assert requests.get(self.url, auth=auth).status_code == 200
+        assert self.server.seen == [BASIC, BASIC]
+        assert len(self.server.token_requests) == 1
+        assert auth.refreshes == 0
@@ -0,0 +1,133 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Unittests for batching.
+"""
+
+import threading
+import time
+
+from . import TestCase
+
+from replugin.servicenowworker.batching import Batcher
+
+
+def submit_all(batcher, items):
+    """
+    Submits each item from its own thread. Returns the results or
+    raised exceptions by item.
+    """
+    results = {}
+
+    def run(item):
+        try:
+            results[item] = batcher.submit(item)
+        except Exception, ex:
+            results[item] = ex
+
+    threads = [threading.Thread(target=run, args=(item,)) for item in items]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    return results
+
+
+class TestBatcher(TestCase):
+
+    def test_single_caller(self):
+        """
+        A lone caller should be sent without waiting for others.
+        """
+        sent = []
+
+        def send(items):
+            sent.append(list(items))
+            return [item * 2 for item in items]
+
+        batcher = Batcher(send, max_items=10, max_wait=10)
+        start = time.time()
+        assert batcher.submit(3) == 6
+        assert time.time() - start < 1
+        assert sent == [[3]]
+        assert batcher.batches == 1
+
+    def test_concurrent_callers(self):
+        """
+        Callers arriving while a batch is in flight should share batches
+        of max_items and each get its own result back.
+        """
+        sent = []
+        release = threading.Event()
+
+        def send(items):
+            sent.append(list(items))
+            if items == ['first']:
+                release.wait(5)
+            return ['r%s' % item for item in items]
+
+        batcher = Batcher(send, max_items=4, max_wait=0.5)
+        first = threading.Thread(target=batcher.submit, args=('first',))
+        first.start()
+        while not sent:
+            time.sleep(0.001)
+        results = submit_all(batcher, range(8))
+        release.set()
+        first.join(5)
+        assert results == dict((item, 'r%s' % item) for item in range(8))
+        assert sorted(len(batch) for batch in sent) == [1, 4, 4]
+        assert batcher.batches == 3
+        assert batcher.items == 9
+
+    def test_errors(self):
+        """
+        An exception result should only reach its own caller and a
+        failed send should reach every caller in the batch.
+        """
+        def send(items):
+            return [ValueError(item) if item == 1 else item
+                    for item in items]
+
+        batcher = Batcher(send, max_items=3, max_wait=0.5)
+        results = submit_all(batcher, [0, 1, 2])
+        assert results[0] == 0
+        assert results[2] == 2
+        assert isinstance(results[1], ValueError)
+
+        def broken(items):
+            raise IOError('down')
+
+        batcher = Batcher(broken, max_items=2, max_wait=0.5)
+        results = submit_all(batcher, [0, 1])
+        assert all(isinstance(r, IOError) for r in results.values())
+
+        # A send which loses results fails the batch
+        batcher = Batcher(lambda items: items[1:], max_items=2, max_wait=0.5)
+        results = submit_all(batcher, [0, 1])
+        assert all(isinstance(r, ValueError) for r in results.values())
+
+    def test_send_all(self):
+        """
+        send_all should chunk by max_items without waiting.
+        """
+        sent = []
+
+        def send(items):
+            sent.append(list(items))
+            return list(items)
+
+        batcher = Batcher(send, max_items=2, max_wait=10)
+        assert batcher.send_all([1, 2, 3, 4, 5]) == [1, 2, 3, 4, 5]
+        assert sent == [[1, 2], [3, 4], [5]]
@@ -0,0 +1,129 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Unittests for the microbenchmarks and profiling helpers.
+"""
+
+import threading
+import time
+
+from . import TestCase
+
+from replugin.servicenowworker import bench
+from replugin.servicenowworker.profiling import StackSampler
+
+
+class TestBench(TestCase):
+
+    def test_fake_transport(self):
+        """
+        Routes should answer by method and url fragment, others 404.
+        """
+        transport = bench.FakeTransport()
+        response = transport.get(
+            'https://bench/api/now/v1/table/change_request?sysparm_limit=1')
+        assert response.status_code == 200
+        assert response.json()['result'][0]['number'] == 'CHG0000001'
+        assert transport.post(
+            'https://bench/api/now/import').status_code == 201
+        assert transport.get('https://bench/nope').status_code == 404
+        assert transport.calls == 3
+
+    def test_run_benchmarks(self):
+        """
+        Every case should run through the fake transport without failing.
+        """
+        worker = bench.make_worker()
+        results = bench.run_benchmarks(worker, iterations=5, samples=2)
+        names = [result['name'] for result in results]
+        # Every subcommand is benchmarked through process
+        assert sorted(bench.MESSAGES) == sorted(worker.subcommands)
+        for subcommand in bench.MESSAGES:
+            assert subcommand in names
+        assert '_make_start_end_dates' in names
+        for result in results:
+            assert result['ns_per_call'] > 0
+            # Counted through gc on any interpreter
+            assert result['objects_per_call'] is not None
+            assert result['retained_objects_per_call'] is not None
+        assert 'failures' not in worker.metrics.counters
+        assert worker._transport.calls > 0
+
+        assert len(bench.run_benchmarks(
+            worker, iterations=1, names=['UpdateStartTime'])) == 1
+        assert 'UpdateStartTime' in bench.format_results(results)
+
+    def test_count_objects(self):
+        """
+        Objects left for the collector and objects kept alive should be
+        counted per call.
+        """
+        kept = []
+
+        def allocate():
+            cycle = {}
+            cycle['self'] = cycle
+            kept.append([])
+
+        counts = bench.count_objects(allocate, 4)
+        # The dict cycle is left for the collector, the list is kept
+        assert counts['objects_per_call'] == 2
+        assert counts['retained_objects_per_call'] == 1
+
+    def test_stack_sampler_folded(self):
+        """
+        Folded output should be one stack and count per line.
+        """
+        sampler = StackSampler()
+        sampler.stacks['main (a.py:1);work (a.py:5)'] = 3
+        sampler.stacks['main (a.py:1)'] = 1
+        assert sampler.folded() == (
+            'main (a.py:1) 1\nmain (a.py:1);work (a.py:5) 3\n')
+
+    def test_stack_sampler_all_threads(self):
+        """
+        With all_threads a busy thread other than the main one should be
+        sampled about every interval, and the threads the tag drops left
+        out.
+        """
+        started = threading.Event()
+        release = threading.Event()
+
+        def lane_work():
+            started.set()
+            while not release.is_set():
+                sum(range(100))
+
+        thread = threading.Thread(target=lane_work)
+        thread.start()
+        try:
+            assert started.wait(5)
+            sampler = StackSampler(
+                interval=0.005,
+                tag=lambda ident: ['lane'] if ident == thread.ident else None,
+                all_threads=True)
+            sampler.start()
+            assert sampler.running
+            time.sleep(0.5)
+            sampler.stop()
+            assert not sampler.running
+        finally:
+            release.set()
+            thread.join(5)
+        # 100 samples at most, many fewer would mean a blind sampler
+        assert sampler.samples > 30
+        for stack in sampler.stacks:
+            assert stack.startswith('lane;')
+            assert 'lane_work (test_bench.py:' in stack
@@ -0,0 +1,280 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Unittests for the sys_id cache.
+"""
+
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+
+from SocketServer import StreamRequestHandler, ThreadingTCPServer
+
+from . import TestCase
+
+from replugin.servicenowworker.cache import (
+    MemorySysIdCache, RedisSysIdCache, SysIdCache)
+
+SYS_ID = 'd6e68a52fd5f31ff296db3236d1f6bfb'
+
+
+class TestSysIdCache(TestCase):
+
+    def setUp(self):
+        """
+        Create a scratch directory for the cache file.
+        """
+        TestCase.setUp(self)
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'sys_ids.db')
+
+    def tearDown(self):
+        """
+        Remove the scratch directory.
+        """
+        TestCase.tearDown(self)
+        shutil.rmtree(self.tmpdir)
+
+    def test_get_set_delete(self):
+        """
+        Values should round trip and survive reopening the file.
+        """
+        cache = SysIdCache(self.path)
+        assert cache.get('change_request', 'CHG0001') is None
+        cache.set('change_request', 'CHG0001', SYS_ID)
+        assert cache.get('change_request', 'CHG0001') == SYS_ID
+        # Tables are kept apart
+        assert cache.get('change_task', 'CHG0001') is None
+
+        reopened = SysIdCache(self.path)
+        assert reopened.get('change_request', 'CHG0001') == SYS_ID
+
+        reopened.delete('change_request', 'CHG0001')
+        assert cache.get('change_request', 'CHG0001') is None
+
+    def test_meta(self):
+        """
+        Bookkeeping values should survive reopening the file.
+        """
+        cache = SysIdCache(self.path)
+        assert cache.get_meta('watermark:change_request') is None
+        cache.set_meta('watermark:change_request', '2014-06-01 10:00:00')
+        reopened = SysIdCache(self.path)
+        assert reopened.get_meta(
+            'watermark:change_request') == '2014-06-01 10:00:00'
+
+    def test_non_hex_sys_id(self):
+        """
+        Values which are not hex should still be stored.
+        """
+        cache = SysIdCache(self.path)
+        cache.set('change_task', 'CTASK0001', 'not-hex')
+        assert cache.get('change_task', 'CTASK0001') == 'not-hex'
+
+    def test_prune(self):
+        """
+        The cache should not grow past max_entries.
+        """
+        cache = SysIdCache(self.path, max_entries=10)
+        cache.set_many('change_request', [
+            ('CHG%04d' % i, SYS_ID) for i in range(25)])
+        cache.prune()
+        conn = cache._connection()
+        assert conn.execute('SELECT COUNT(*) FROM sys_ids').fetchone()[0] == 10
+
+    def test_get_many(self):
+        """
+        get_many should return only the cached keys across tables.
+        """
+        cache = SysIdCache(self.path)
+        cache.set_many('change_request', [
+            ('CHG%04d' % i, SYS_ID) for i in range(600)])
+        cache.set('change_task', 'CTASK0001', 'abc')
+        keys = [('change_request', 'CHG%04d' % i) for i in range(0, 700, 7)]
+        keys.append(('change_task', 'CTASK0001'))
+        keys.append(('change_task', 'CTASK0002'))
+        found = cache.get_many(keys)
+        assert len(found) == 600 / 7 + 1 + 1
+        assert found[('change_request', 'CHG0007')] == SYS_ID
+        assert found[('change_task', 'CTASK0001')] == 'abc'
+        assert ('change_task', 'CTASK0002') not in found
+
+
+class TestMemorySysIdCache(TestCase):
+
+    def test_get_set_evict(self):
+        """
+        The in process cache should evict the oldest entries.
+        """
+        cache = MemorySysIdCache(max_entries=2)
+        cache.set('change_request', 'CHG0001', SYS_ID)
+        cache.set_many('change_request', [('CHG0002', 'a'), ('CHG0003', 'b')])
+        assert cache.get('change_request', 'CHG0001') is None
+        assert cache.get('change_request', 'CHG0003') == 'b'
+        cache.delete('change_request', 'CHG0003')
+        assert cache.get('change_request', 'CHG0003') is None
+
+    def test_get_many(self):
+        """
+        get_many should return only the cached keys.
+        """
+        cache = MemorySysIdCache()
+        cache.set('change_request', 'CHG0001', SYS_ID)
+        assert cache.get_many([
+            ('change_request', 'CHG0001'), ('change_task', 'CHG0001')]) == {
+                ('change_request', 'CHG0001'): SYS_ID}
+
+
+class _RedisHandler(StreamRequestHandler):
+    """
+    Answers the few Redis commands the cache uses.
+    """
+
+    def handle(self):
+        server = self.server
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            args = []
+            for _ in range(int(line[1:])):
+                length = int(self.rfile.readline()[1:])
+                args.append(self.rfile.read(length + 2)[:-2])
+            server.commands.append(args)
+            command = args[0].upper()
+            if command == 'AUTH':
+                if args[1] == 'secret':
+                    self.wfile.write('+OK\r\n')
+                else:
+                    self.wfile.write('-ERR invalid password\r\n')
+            elif command in ('SELECT', 'SET'):
+                if command == 'SET':
+                    server.data[args[1]] = args[2]
+                    if len(args) > 3:
+                        server.ttls[args[1]] = int(args[4])
+                self.wfile.write('+OK\r\n')
+            elif command in ('GET', 'MGET'):
+                values = [server.data.get(key) for key in args[1:]]
+                replies = ['$-1\r\n' if value is None else
+                           '$%d\r\n%s\r\n' % (len(value), value)
+                           for value in values]
+                if command == 'MGET':
+                    replies.insert(0, '*%d\r\n' % len(values))
+                self.wfile.write(''.join(replies))
+            elif command == 'DEL':
+                found = server.data.pop(args[1], None) is not None
+                self.wfile.write(':%d\r\n' % found)
+            else:
+                self.wfile.write('-ERR unknown command\r\n')
+
+
+class _RedisServer(ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        ThreadingTCPServer.__init__(self, ('127.0.0.1', 0), _RedisHandler)
+        self.data = {}
+        self.ttls = {}
+        self.commands = []
+
+
+class TestRedisSysIdCache(TestCase):
+
+    def setUp(self):
+        """
+        Start a local stand-in for Redis.
+        """
+        TestCase.setUp(self)
+        self.server = _RedisServer()
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.port = self.server.server_address[1]
+
+    def tearDown(self):
+        """
+        Stop the stand-in.
+        """
+        TestCase.tearDown(self)
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_get_set_delete(self):
+        """
+        Values should round trip with a ttl, lookups should be a single
+        MGET and writes a single pipelined round trip.
+        """
+        cache = RedisSysIdCache(
+            port=self.port, db=2, password='secret', ttl=60)
+        assert cache.get('change_request', 'CHG0001') is None
+        cache.set_many('change_request', [
+            ('CHG0001', SYS_ID), (u'CHG0002', 'abc')])
+        assert self.server.data['servicenow:change_request:CHG0001'] == SYS_ID
+        assert self.server.ttls['servicenow:change_request:CHG0002'] == 60
+        del self.server.commands[:]
+        found = cache.get_many([
+            ('change_request', 'CHG0001'), ('change_request', 'CHG0002'),
+            ('change_task', 'CHG0001')])
+        assert found == {
+            ('change_request', 'CHG0001'): SYS_ID,
+            ('change_request', 'CHG0002'): 'abc'}
+        assert len(self.server.commands) == 1
+        assert self.server.commands[0][0] == 'MGET'
+
+        cache.delete('change_request', 'CHG0001')
+        assert cache.get('change_request', 'CHG0001') is None
+        cache.set_meta('watermark:change_request', '2014-01-01 00:00:00')
+        assert cache.get_meta(
+            'watermark:change_request') == '2014-01-01 00:00:00'
+        assert 'servicenow:meta:watermark:change_request' not in (
+            self.server.ttls)
+        assert cache.unavailable == 0
+
+    def test_unreachable(self):
+        """
+        An unreachable server should fall back to the in process cache
+        quickly and be tried again after retry_after.
+        """
+        # Find a port nothing listens on
+        probe = socket.socket()
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+        probe.close()
+
+        fallback = MemorySysIdCache()
+        cache = RedisSysIdCache(
+            port=port, retry_after=0.2, fallback=fallback)
+        start = time.time()
+        cache.set('change_request', 'CHG0001', SYS_ID)
+        assert cache.get('change_request', 'CHG0001') == SYS_ID
+        assert cache.get_meta('missing') is None
+        assert time.time() - start < 1
+        # Only the first call waited on the connection
+        assert cache.unavailable == 1
+
+        # Back after retry_after
+        cache.port = self.port
+        time.sleep(0.25)
+        cache.set('change_request', 'CHG0002', 'abc')
+        assert self.server.data['servicenow:change_request:CHG0002'] == 'abc'
+
+        # A bad password also counts as unavailable
+        cache = RedisSysIdCache(port=self.port, password='wrong')
+        assert cache.get('change_request', 'CHG0002') is None
+        assert cache.unavailable == 1
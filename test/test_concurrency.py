@@ -0,0 +1,66 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Unittests for adaptive concurrency.
+"""
+
+from . import TestCase
+
+from replugin.servicenowworker.concurrency import AIMDLimiter
+
+
+class TestAIMDLimiter(TestCase):
+
+    def test_additive_increase(self):
+        """
+        Healthy windows should grow the limit by increase.
+        """
+        limiter = AIMDLimiter(initial=2, window=2, latency_target=1.0)
+        assert limiter.record(0.1) is None
+        assert limiter.record(0.1) == 3
+        assert limiter.last_decision['action'] == 'increase'
+
+    def test_multiplicative_decrease(self):
+        """
+        Slow or failing windows should cut the limit.
+        """
+        limiter = AIMDLimiter(initial=8, window=2, latency_target=1.0)
+        limiter.record(2.0)
+        assert limiter.record(2.0) == 4
+        limiter.record(0.1, error=True)
+        assert limiter.record(0.1) == 2
+        assert limiter.last_decision['error_rate'] == 0.5
+
+    def test_bounds(self):
+        """
+        The limit should stay within minimum and maximum.
+        """
+        limiter = AIMDLimiter(initial=2, minimum=2, maximum=3, window=1)
+        assert limiter.record(5.0) is None
+        assert limiter.limit == 2
+        limiter.record(0.1)
+        assert limiter.record(0.1) is None
+        assert limiter.limit == 3
+
+    def test_acquire_release(self):
+        """
+        No more than limit slots should be handed out.
+        """
+        limiter = AIMDLimiter(initial=1)
+        assert limiter.acquire(timeout=0) is True
+        assert limiter.acquire(timeout=0.01) is False
+        limiter.release()
+        assert limiter.acquire(timeout=0) is True
+        assert limiter.status()['in_flight'] == 1
@@ -0,0 +1,42 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Unittests for message deadlines.
+"""
+
+import mock
+
+from . import TestCase
+
+from replugin.servicenowworker.deadline import Deadline
+
+
+class TestDeadline(TestCase):
+
+    def test_timeout_is_capped(self):
+        """
+        Timeouts should never be longer than the time left.
+        """
+        with mock.patch('time.time') as now:
+            now.return_value = 100
+            deadline = Deadline(10)
+            assert deadline.timeout(5, 30) == (5, 10)
+            assert deadline.timeout(5, 30, share=0.5) == (5, 5)
+            now.return_value = 108
+            assert deadline.timeout(5, 30) == (2, 2)
+            assert not deadline.expired()
+            now.return_value = 111
+            assert deadline.remaining() == 0
+            assert deadline.expired()
@@ -0,0 +1,72 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Unittests for endpoint selection.
+"""
+
+import mock
+
+from . import TestCase
+
+from replugin.servicenowworker.endpoints import EndpointPool
+
+
+class TestEndpointPool(TestCase):
+
+    def test_single_url(self):
+        """
+        A plain string should become a single primary endpoint.
+        """
+        pool = EndpointPool('http://127.0.0.1/api')
+        assert len(pool.endpoints) == 1
+        assert pool.primary.url == 'http://127.0.0.1/api'
+
+    def test_reads_prefer_fastest(self):
+        """
+        Reads should go to the endpoint with the lowest latency.
+        """
+        pool = EndpointPool(['http://a', 'http://b'])
+        pool.record_success(pool.endpoints[0], 0.5)
+        pool.record_success(pool.endpoints[1], 0.1)
+        assert pool.read_candidates()[0].url == 'http://b'
+        # Writes stay on the primary
+        assert [e.url for e in pool.write_candidates()] == ['http://a']
+
+    def test_failover(self):
+        """
+        Endpoints that keep failing should be moved to the back until
+        retry_after has passed.
+        """
+        pool = EndpointPool(
+            ['http://a', 'http://b'], failure_threshold=2, retry_after=30)
+        pool.record_success(pool.endpoints[0], 0.1)
+        pool.record_success(pool.endpoints[1], 0.5)
+        with mock.patch('time.time') as now:
+            now.return_value = 1000
+            pool.record_failure(pool.endpoints[0])
+            assert pool.read_candidates()[0].url == 'http://a'
+            pool.record_failure(pool.endpoints[0])
+            assert pool.read_candidates()[0].url == 'http://b'
+            now.return_value = 1031
+            assert pool.read_candidates()[0].url == 'http://a'
+
+    def test_ewma(self):
+        """
+        Latency should be an exponentially weighted moving average.
+        """
+        pool = EndpointPool('http://a', ewma_alpha=0.5)
+        pool.record_success(pool.primary, 1.0)
+        pool.record_success(pool.primary, 0.0)
+        self.assertAlmostEqual(pool.primary.latency, 0.5)
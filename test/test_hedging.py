@@ -0,0 +1,120 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Unittests for request hedging.
+"""
+
+import threading
+
+import mock
+
+from . import TestCase
+
+from replugin.servicenowworker.hedging import HedgePolicy, hedged_call
+
+
+def warmed_policy(**kwargs):
+    """
+    Returns a policy with enough samples and budget to hedge.
+    """
+    policy = HedgePolicy(min_samples=5, min_delay=0.01, **kwargs)
+    for _ in range(40):
+        policy.record(0.01)
+    return policy
+
+
+class TestHedgePolicy(TestCase):
+
+    def test_delay_needs_samples(self):
+        """
+        No hedging should happen until enough samples are seen.
+        """
+        policy = HedgePolicy(min_samples=3)
+        assert policy.delay() is None
+        for elapsed in (0.1, 0.2, 0.3):
+            policy.record(elapsed)
+        self.assertAlmostEqual(policy.delay(), 0.3)
+
+    def test_budget(self):
+        """
+        Hedges should only be allowed as budget is earned.
+        """
+        policy = HedgePolicy(budget_ratio=0.5, max_budget=1)
+        assert policy.allow() is False
+        policy.record(0.1)
+        policy.record(0.1)
+        policy.record(0.1)
+        assert policy.allow() is True
+        assert policy.allow() is False
+        assert policy.hedged == 1
+        assert policy.denied == 2
+
+
+class TestHedgedCall(TestCase):
+
+    def test_fast_primary(self):
+        """
+        A fast primary should not trigger a hedge.
+        """
+        backup = mock.Mock()
+        result = hedged_call(lambda: 'primary', backup, warmed_policy())
+        assert result == 'primary'
+        assert backup.call_count == 0
+
+    def test_backup_wins(self):
+        """
+        A slow primary should lose to the backup and be closed.
+        """
+        release = threading.Event()
+        slow = mock.Mock()
+
+        def primary():
+            release.wait(5)
+            return slow
+
+        result = hedged_call(primary, lambda: 'backup', warmed_policy())
+        assert result == 'backup'
+        release.set()
+        for _ in range(100):
+            if slow.close.called:
+                break
+            threading.Event().wait(0.01)
+        assert slow.close.call_count == 1
+
+    def test_primary_error_falls_back(self):
+        """
+        If the primary fails the backup result should still be used.
+        """
+        release = threading.Event()
+
+        def primary():
+            release.wait(5)
+            raise ValueError('boom')
+
+        def backup():
+            release.set()
+            return 'backup'
+
+        assert hedged_call(primary, backup, warmed_policy()) == 'backup'
+
+    def test_both_fail(self):
+        """
+        The primary error should be raised when both calls fail.
+        """
+        def primary():
+            raise ValueError('primary')
+
+        with self.assertRaises(ValueError):
+            hedged_call(primary, primary, warmed_policy())
@@ -0,0 +1,120 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Unittests for the write-ahead journal.
+"""
+
+import os
+import shutil
+import tempfile
+
+from . import TestCase
+
+from replugin.servicenowworker.journal import Journal, JournalLocked
+
+
+class TestJournal(TestCase):
+
+    def setUp(self):
+        """
+        Make a directory for the journal.
+        """
+        TestCase.setUp(self)
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'sub', 'test.journal')
+
+    def tearDown(self):
+        """
+        Remove the journal.
+        """
+        TestCase.tearDown(self)
+        shutil.rmtree(self.directory)
+
+    def test_replay(self):
+        """
+        Unconfirmed entries should be pending again after reopening,
+        in the order they were added.
+        """
+        journal = Journal(self.path)
+        first = journal.append({'n': 1})
+        journal.append({'n': 2})
+        journal.append({'n': 3})
+        journal.confirm(first)
+        journal.close()
+
+        journal = Journal(self.path)
+        assert [entry for _, entry in journal.pending()] == [
+            {'n': 2}, {'n': 3}]
+        journal.close()
+
+    def test_torn_write(self):
+        """
+        A line cut short by a crash should be skipped and not spoil
+        entries appended after it.
+        """
+        journal = Journal(self.path)
+        journal.append({'n': 1})
+        journal.close()
+        with open(self.path, 'a') as out:
+            out.write('{"id": "abc", "entry": {"n"')
+
+        journal = Journal(self.path)
+        journal.append({'n': 2})
+        journal.close()
+        journal = Journal(self.path)
+        assert [entry for _, entry in journal.pending()] == [
+            {'n': 1}, {'n': 2}]
+        journal.close()
+
+    def test_compact(self):
+        """
+        Compacting should leave only pending entries in the file.
+        """
+        journal = Journal(self.path)
+        ids = [journal.append({'n': n}) for n in range(10)]
+        for entry_id in ids[:9]:
+            journal.confirm(entry_id)
+        # Confirming twice is harmless
+        journal.confirm(ids[0])
+        assert journal.confirmed == 9
+        journal.compact()
+        assert journal.confirmed == 0
+        with open(self.path) as journal_file:
+            lines = journal_file.readlines()
+        assert len(lines) == 1
+        assert ids[9] in lines[0]
+        # Appends still go to the compacted file
+        journal.append({'n': 10})
+        journal.close()
+        journal = Journal(self.path)
+        assert [entry for _, entry in journal.pending()] == [
+            {'n': 9}, {'n': 10}]
+        journal.close()
+
+    def test_single_process(self):
+        """
+        A journal open elsewhere should not be opened again until it is
+        closed.
+        """
+        journal = Journal(self.path)
+        journal.append({'n': 1})
+        self.assertRaises(JournalLocked, Journal, self.path)
+        # Compacting must not hand the lock out either
+        journal.compact()
+        self.assertRaises(JournalLocked, Journal, self.path)
+        journal.close()
+        journal = Journal(self.path)
+        assert [entry for _, entry in journal.pending()] == [{'n': 1}]
+        journal.close()
@@ -0,0 +1,100 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Unittests for lanes.
+"""
+
+import threading
+import time
+
+from . import TestCase
+
+from replugin.servicenowworker.lanes import Lane
+from replugin.servicenowworker.metrics import Metrics
+
+
+class TestLane(TestCase):
+
+    def test_concurrency_limit(self):
+        """
+        No more than workers tasks should run at once.
+        """
+        lane = Lane('test', workers=2)
+        lock = threading.Lock()
+        running = [0, 0]
+        done = threading.Semaphore(0)
+
+        def task():
+            with lock:
+                running[0] += 1
+                running[1] = max(running[1], running[0])
+            time.sleep(0.02)
+            with lock:
+                running[0] -= 1
+            done.release()
+
+        for _ in range(6):
+            lane.submit(task)
+        for _ in range(6):
+            done.acquire()
+        assert running[1] == 2
+        lane.stop(1)
+
+    def test_errors_and_metrics(self):
+        """
+        A task which raises should be counted and not stop the lane.
+        Queue and run times should be recorded.
+        """
+        metrics = Metrics()
+        lane = Lane('test', workers=1, metrics=metrics)
+        results = []
+
+        def broken():
+            raise ValueError('broken')
+
+        lane.submit(broken)
+        lane.submit(results.append, 1)
+        lane.stop(1)
+        assert results == [1]
+        assert lane.errors == 1
+        assert lane.status() == {'workers': 1, 'active': 0, 'queued': 0}
+        snapshot = metrics.snapshot()
+        assert 'lanes.test.wait' in snapshot['timings']
+        assert 'lanes.test.run' in snapshot['timings']
+
+    def test_lanes_are_independent(self):
+        """
+        A busy lane should not hold up tasks in another lane.
+        """
+        slow = Lane('slow', workers=1)
+        fast = Lane('fast', workers=1)
+        release = threading.Event()
+        started = threading.Event()
+        finished = threading.Event()
+
+        def hold():
+            started.set()
+            release.wait(5)
+
+        slow.submit(hold)
+        slow.submit(hold)
+        assert started.wait(1)
+        fast.submit(finished.set)
+        assert finished.wait(1)
+        assert slow.status()['active'] == 1
+        assert slow.status()['queued'] == 1
+        release.set()
+        slow.stop(1)
+        fast.stop(1)
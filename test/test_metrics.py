@@ -0,0 +1,72 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Unittests for metrics.
+"""
+
+import json
+import os
+import shutil
+import tempfile
+
+from . import TestCase
+
+from replugin.servicenowworker.metrics import Metrics, aggregate
+
+
+class TestMetrics(TestCase):
+
+    def test_snapshot_and_dump(self):
+        """
+        Metrics should be recorded and written out as JSON.
+        """
+        metrics = Metrics()
+        metrics.incr('messages')
+        metrics.incr('messages', 2)
+        metrics.gauge('limit', 4)
+        metrics.timing('process', 0.5)
+        metrics.timing('process', 1.5)
+
+        snapshot = metrics.snapshot()
+        assert snapshot['counters'] == {'messages': 3}
+        assert snapshot['gauges'] == {'limit': 4}
+        assert snapshot['timings']['process'] == {
+            'count': 2, 'total': 2.0, 'max': 1.5}
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'metrics.json')
+            metrics.dump(path)
+            with open(path) as metrics_file:
+                assert json.load(metrics_file)['counters'] == {'messages': 3}
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_aggregate(self):
+        """
+        Snapshots from several processes should be combined.
+        """
+        one = Metrics()
+        one.incr('messages')
+        one.timing('process', 1.0)
+        two = Metrics()
+        two.incr('messages', 2)
+        two.timing('process', 3.0)
+
+        result = aggregate([one.snapshot(), two.snapshot()])
+        assert result['processes'] == 2
+        assert result['counters'] == {'messages': 3}
+        assert result['timings']['process'] == {
+            'count': 2, 'total': 4.0, 'max': 3.0}
@@ -0,0 +1,101 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Unittests for the output wrappers.
+"""
+
+import mock
+
+from . import TestCase
+
+from replugin.servicenowworker.output import BufferedOutput, IoloopOutput
+
+
+class TestBufferedOutput(TestCase):
+
+    def test_lines_are_batched(self):
+        """
+        Lines should be held until flushed and emitted together.
+        """
+        output = mock.Mock()
+        buffered = BufferedOutput(output)
+        buffered.info('one')
+        buffered.info('two')
+        assert output.info.call_count == 0
+        buffered.flush()
+        output.info.assert_called_once_with('one\ntwo')
+        # Nothing left to flush
+        buffered.flush()
+        assert output.info.call_count == 1
+
+    def test_max_lines(self):
+        """
+        Reaching max_lines should flush.
+        """
+        output = mock.Mock()
+        buffered = BufferedOutput(output, max_lines=2)
+        buffered.info('one')
+        buffered.info('two')
+        output.info.assert_called_once_with('one\ntwo')
+
+    def test_max_age(self):
+        """
+        Lines older than max_age should be flushed on the next write.
+        """
+        output = mock.Mock()
+        buffered = BufferedOutput(output, max_age=1)
+        with mock.patch('time.time') as now:
+            now.return_value = 100
+            buffered.info('one')
+            assert output.info.call_count == 0
+            now.return_value = 102
+            buffered.info('two')
+        output.info.assert_called_once_with('one\ntwo')
+
+    def test_errors_are_immediate(self):
+        """
+        Errors should flush pending lines and go out right away.
+        """
+        output = mock.Mock()
+        buffered = BufferedOutput(output)
+        buffered.info('one')
+        buffered.error('bad')
+        output.info.assert_called_once_with('one')
+        output.error.assert_called_once_with('bad')
+
+
+class TestIoloopOutput(TestCase):
+
+    def test_calls_are_handed_over(self):
+        """
+        Every call should go through call_on_ioloop, in order.
+        """
+        output = mock.Mock()
+        output.name = 'bus'
+        queued = []
+        wrapped = IoloopOutput(
+            output, lambda func, *args, **kwargs: queued.append(
+                (func, args, kwargs)))
+        wrapped.info('one')
+        wrapped.error('two', extra=True)
+        assert output.info.call_count == 0
+        assert [(args, kwargs) for _, args, kwargs in queued] == [
+            (('one',), {}), (('two',), {'extra': True})]
+        for func, args, kwargs in queued:
+            func(*args, **kwargs)
+        output.info.assert_called_once_with('one')
+        output.error.assert_called_once_with('two', extra=True)
+        # Plain attributes are read straight through
+        assert wrapped.name == 'bus'
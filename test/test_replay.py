@@ -0,0 +1,70 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Unittests for replaying captures.
+"""
+
+import json
+
+import mock
+import requests
+
+from . import TestCase
+
+from replugin.servicenowworker.replay import ReplayWorker, StandIn, replay
+
+RECORDS = [
+    {'type': 'message', 'time': 100.0, 'corr_id': '1', 'body': {
+        'parameters': {'subcommand': 'DoesChangeRecordExist'},
+        'dynamic': {'change_record': 'CHG0001'}}},
+    {'type': 'http', 'time': 100.1, 'corr_id': '1', 'method': 'get',
+     'api': 'root',
+     'path': '/table/change_request?sysparm_query=number%3DCHG0001'
+             '&sysparm_fields=number&sysparm_limit=2',
+     'elapsed': 0.5, 'status': 200, 'request': None,
+     'response': {'json': {'result': [{'number': 'CHG0001'}]}}},
+]
+
+
+class TestReplay(TestCase):
+
+    def test_stand_in_and_replay(self):
+        """
+        Captured messages should be replayed against the stand-in.
+        """
+        stand_in = StandIn(RECORDS, speed=0)
+        stand_in.start()
+        try:
+            response = requests.get(stand_in.url + '/root' + RECORDS[1]['path'])
+            assert response.status_code == 200
+            assert response.json()['result'][0]['number'] == 'CHG0001'
+            # Unknown requests get a 404
+            assert requests.get(stand_in.url + '/root/nope').status_code == 404
+
+            with open('conf/example.json') as config_file:
+                config = json.load(config_file)
+            config['api_root_url'] = stand_in.url + '/root'
+            config['api_import_url'] = stand_in.url + '/import'
+            worker = ReplayWorker(config, logger=mock.MagicMock())
+
+            summary = replay(RECORDS, worker, speed=0, output=mock.Mock())
+        finally:
+            stand_in.stop()
+
+        assert summary['messages'] == 1
+        assert summary['failures'] == 0
+        assert summary['subcommands']['DoesChangeRecordExist']['count'] == 1
+        assert worker.replies[-1] == ('1', {
+            'status': 'completed', 'data': {'exists': True}})
@@ -0,0 +1,92 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Unittests for the DNS cache.
+"""
+
+import socket
+
+import mock
+
+from . import TestCase
+
+from replugin.servicenowworker.metrics import Metrics
+from replugin.servicenowworker.resolver import Resolver
+
+
+def _answers(*addresses):
+    return [(socket.AF_INET, socket.SOCK_STREAM, 6, '', (address, 443))
+            for address in addresses]
+
+
+class TestResolver(TestCase):
+
+    def test_cache_and_expiry(self):
+        """
+        Lookups should be served from the cache until the TTL runs out.
+        """
+        metrics = Metrics()
+        resolver = Resolver(ttl=60, metrics=metrics)
+        with mock.patch('socket.getaddrinfo') as getaddrinfo:
+            getaddrinfo.return_value = _answers('10.0.0.1', '10.0.0.1')
+            assert resolver.resolve('example.com', 443) == ['10.0.0.1']
+            assert resolver.resolve('example.com', 443) == ['10.0.0.1']
+            assert getaddrinfo.call_count == 1
+            assert metrics.counters['dns.misses'] == 1
+            assert metrics.counters['dns.hits'] == 1
+            assert metrics.timings['dns.lookup']['count'] == 1
+
+            resolver._entries['example.com'].resolved -= 61
+            getaddrinfo.return_value = _answers('10.0.0.2')
+            assert resolver.resolve('example.com', 443) == ['10.0.0.2']
+            assert getaddrinfo.call_count == 2
+
+    def test_refresh_and_stale(self):
+        """
+        Entries near expiry should be refreshed and a failed lookup
+        should fall back to the old addresses.
+        """
+        metrics = Metrics()
+        resolver = Resolver(ttl=60, refresh_ahead=0.5, metrics=metrics)
+        with mock.patch('socket.getaddrinfo') as getaddrinfo:
+            getaddrinfo.return_value = _answers('10.0.0.1')
+            resolver.resolve('example.com', 443)
+            assert resolver.refresh() == 0
+
+            resolver._entries['example.com'].resolved -= 31
+            getaddrinfo.return_value = _answers('10.0.0.2')
+            assert resolver.refresh() == 1
+            assert resolver.resolve('example.com') == ['10.0.0.2']
+
+            resolver._entries['example.com'].resolved -= 61
+            getaddrinfo.side_effect = socket.gaierror('no resolver')
+            assert resolver.refresh() == 0
+            assert resolver.resolve('example.com') == ['10.0.0.2']
+            assert metrics.counters['dns.stale'] == 1
+            assert metrics.counters['dns.errors'] == 2
+            self.assertRaises(
+                socket.gaierror, resolver.resolve, 'other.example.com')
+
+    def test_spread(self):
+        """
+        With spread set each lookup should start at the next address.
+        """
+        resolver = Resolver(spread=True)
+        with mock.patch('socket.getaddrinfo') as getaddrinfo:
+            getaddrinfo.return_value = _answers('10.0.0.1', '10.0.0.2')
+            first = resolver.resolve('example.com')
+            second = resolver.resolve('example.com')
+            assert sorted(first) == sorted(second) == ['10.0.0.1', '10.0.0.2']
+            assert first[0] != second[0]
@@ -0,0 +1,135 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Unittests for the multi-process supervisor.
+"""
+
+import errno
+import json
+import os
+import shutil
+import tempfile
+
+import mock
+
+from contextlib import nested
+
+from . import TestCase
+
+from replugin.servicenowworker.supervisor import Supervisor
+
+
+class TestSupervisor(TestCase):
+
+    def setUp(self):
+        """
+        Create a scratch metrics directory.
+        """
+        TestCase.setUp(self)
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """
+        Remove the scratch metrics directory.
+        """
+        TestCase.tearDown(self)
+        shutil.rmtree(self.tmpdir)
+
+    def test_crashed_children_are_restarted(self):
+        """
+        A child which exits should be replaced once its back-off is over
+        until the supervisor is stopped.
+        """
+        supervisor = Supervisor(mock.Mock(), 2, logger=mock.Mock())
+        pids = iter([100, 101, 102])
+        clock = [1000.0]
+        exits = iter([(100, 256), (0, 0), (0, 0), (0, 0), (101, 0), (102, 0)])
+
+        def waitpid(pid, options):
+            result = next(exits)
+            if result[0] == 101:
+                # Stop before the second child is reaped
+                supervisor.stop()
+            return result
+
+        def sleep(seconds):
+            clock[0] += seconds
+
+        with nested(
+                mock.patch('os.fork', side_effect=lambda: next(pids)),
+                mock.patch('os.waitpid', side_effect=waitpid),
+                mock.patch('os.kill'),
+                mock.patch('signal.signal'),
+                mock.patch('time.time', side_effect=lambda: clock[0]),
+                mock.patch('time.sleep', side_effect=sleep)) as (
+                    fork, _, kill, _, _, _):
+            supervisor.run()
+
+        # Two initial children plus one restart after a 1s back-off
+        assert fork.call_count == 3
+        assert supervisor.children == {}
+        assert kill.call_count == 2
+
+    def test_stop_during_back_off(self):
+        """
+        A slot waiting to be restarted should not be restarted once the
+        supervisor is stopped and run should return.
+        """
+        supervisor = Supervisor(mock.Mock(), 1, logger=mock.Mock())
+        clock = [1000.0]
+
+        def waitpid(pid, options):
+            if supervisor.children:
+                return (100, 256)
+            # SIGTERM arrives during the back-off
+            supervisor.stop()
+            raise OSError(errno.ECHILD, 'No child processes')
+
+        def sleep(seconds):
+            clock[0] += seconds
+
+        with nested(
+                mock.patch('os.fork', return_value=100),
+                mock.patch('os.waitpid', side_effect=waitpid),
+                mock.patch('os.kill'),
+                mock.patch('signal.signal'),
+                mock.patch('time.time', side_effect=lambda: clock[0]),
+                mock.patch('time.sleep', side_effect=sleep)) as (
+                    fork, _, kill, _, _, _):
+            supervisor.run()
+
+        assert fork.call_count == 1
+        assert supervisor.children == {}
+        assert supervisor._restarts == {}
+        assert kill.call_count == 0
+
+    def test_collect_metrics(self):
+        """
+        Metrics from live children should be combined and stale files
+        removed.
+        """
+        supervisor = Supervisor(
+            mock.Mock(), 1, metrics_dir=self.tmpdir, logger=mock.Mock())
+        supervisor.children = {100: 0}
+        for pid in (100, 200):
+            with open(os.path.join(self.tmpdir, '%s.json' % pid), 'w') as f:
+                json.dump({'counters': {'messages': 5}}, f)
+
+        result = supervisor.collect_metrics()
+        assert result['processes'] == 1
+        assert result['counters'] == {'messages': 5}
+        assert not os.path.exists(os.path.join(self.tmpdir, '200.json'))
+        with open(os.path.join(self.tmpdir, 'aggregate.json')) as f:
+            assert json.load(f)['counters'] == {'messages': 5}
@@ -0,0 +1,164 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Unittests for the timed HTTP transport.
+"""
+
+import threading
+import time
+
+import requests
+
+from urllib3.exceptions import ProtocolError, ReadTimeoutError
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+from . import TestCase
+
+from replugin.servicenowworker.metrics import Metrics
+from replugin.servicenowworker.resolver import Resolver
+from replugin.servicenowworker.transport import (
+    PHASES, StaleRetry, TimedSession, response_phases)
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.served = getattr(self, 'served', 0) + 1
+        if self.path.endswith('/stale') and self.served > 1:
+            # Drop a kept alive connection the way a load balancer does
+            self.close_connection = 1
+            return
+        time.sleep(0.05)
+        body = '{"result": []}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestTransport(TestCase):
+
+    def setUp(self):
+        """
+        Start a local keep-alive HTTP server.
+        """
+        TestCase.setUp(self)
+        self.server = _Server(('127.0.0.1', 0), _Handler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = 'http://localhost:%s/api/now/table/change_request' % (
+            self.server.server_address[1])
+
+    def tearDown(self):
+        """
+        Stop the server.
+        """
+        TestCase.tearDown(self)
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_phases(self):
+        """
+        A new connection should time dns and connect, a reused one
+        should not, and the server's delay should land in ttfb.
+        """
+        session = TimedSession()
+        start = time.time()
+        response = session.get(self.url)
+        assert response.json() == {'result': []}
+        phases = response_phases(response, time.time() - start)
+        assert phases['reused'] is False
+        for name in PHASES + ('transfer',):
+            assert phases[name] >= 0
+        assert phases['dns'] > 0
+        assert phases['connect'] > 0
+        assert phases['tls'] == 0
+        assert phases['ttfb'] >= 0.05
+
+        phases = response_phases(session.get(self.url))
+        assert phases['reused'] is True
+        assert phases['dns'] == phases['connect'] == 0
+        assert 'transfer' not in phases
+
+        # Responses from plain requests have no phases
+        assert response_phases(requests.get(self.url)) is None
+
+    def test_prewarm_and_refresh(self):
+        """
+        Pre-warmed connections should be used without a new connect and
+        idle ones should be reconnected.
+        """
+        session = TimedSession(pool_maxsize=4)
+        assert session.prewarm(self.url, 2) == 2
+        # Already warm
+        assert session.prewarm(self.url, 2) == 0
+
+        phases = response_phases(session.get(self.url))
+        assert phases['reused'] is True
+        assert phases['dns'] == phases['connect'] == 0
+
+        assert session.refresh_idle(60) == 0
+        pool = session.get_adapter(self.url).get_connection(self.url)
+        for conn in pool.pool.queue:
+            if conn is not None:
+                conn.last_used = 0
+        assert session.refresh_idle(60) == 2
+        assert session.get(self.url).status_code == 200
+
+    def test_stale_connection_retry(self):
+        """
+        A request on a connection the server dropped should be retried
+        on a new one, but only for idempotent methods.
+        """
+        url = self.url + '/stale'
+        session = TimedSession()
+        assert session.get(url).status_code == 200
+        # The kept alive connection is dropped when it is used again
+        assert session.get(url).status_code == 200
+
+        retry = StaleRetry(total=1, connect=0, read=1, status=0, other=0)
+        assert isinstance(
+            retry.increment('GET', url, error=ProtocolError('reset')),
+            StaleRetry)
+        self.assertRaises(
+            ProtocolError, retry.increment, 'POST', url,
+            error=ProtocolError('reset'))
+        self.assertRaises(
+            ReadTimeoutError, retry.increment, 'GET', url,
+            error=ReadTimeoutError(None, url, 'slow'))
+
+    def test_resolver(self):
+        """
+        Connections should look their host up through the resolver.
+        """
+        metrics = Metrics()
+        session = TimedSession(resolver=Resolver(metrics=metrics))
+        assert session.get(self.url).status_code == 200
+        session.close()
+        assert session.get(self.url).status_code == 200
+        assert metrics.counters['dns.misses'] == 1
+        assert metrics.counters['dns.hits'] == 1